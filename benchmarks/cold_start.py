@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Benchmark of the cold start of short ms2csv.py invocations: listing the symbols
+and extracting a single symbol, with and without the symbol catalog.
+
+Every run is a new Python process, like the calls of a watcher script.
+"""
+
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+MS2CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'ms2csv.py')
+
+Usage = """usage: %prog [options] -i <path-to-ms-dir> [symbol]
+
+Examples:
+    %prog -i /data/ms           time ms2csv.py -l
+    %prog -i /data/ms -n 50 PTT time ms2csv.py -l and ms2csv.py PTT, 50 runs each
+"""
+
+
+def timed(command, runs):
+    """
+    Run `command` `runs` times, return the wall times in seconds, sorted
+    """
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - started)
+    return sorted(times)
+
+
+def main():
+    parser = OptionParser(usage=Usage)
+    parser.add_option('-i', '--input', type='string', dest='input_dir',
+                      help='input directory')
+    parser.add_option('-n', '--runs', type='int', dest='runs', default=20,
+                      help='runs of every command (default: 20)')
+    (options, args) = parser.parse_args()
+    if not options.input_dir:
+        parser.print_help()
+        sys.exit(0)
+
+    output_dir = tempfile.mkdtemp(prefix='ms2csv-bench-')
+    try:
+        base = [sys.executable, MS2CSV, '-i', os.path.realpath(options.input_dir), '-o', output_dir]
+        commands = [('python startup', [sys.executable, '-c', 'pass'])]
+        commands.append(('-l --no-catalog', base + ['-l', '--no-catalog']))
+        commands.append(('-l', base + ['-l']))
+        for symbol in args:
+            commands.append(('%s --no-catalog' % symbol, base + ['--no-catalog', symbol]))
+            commands.append((symbol, base + [symbol]))
+
+        # the first call builds the catalog (--list only writes it when it is given), the timed ones only check it
+        subprocess.run(base + ['-l', '--catalog', os.path.join(output_dir, '.ms2csv-catalog.json')],
+                       stdout=subprocess.DEVNULL, check=True)
+        print('%-24s %10s %10s' % ('command', 'min ms', 'median ms'))
+        for name, command in commands:
+            times = timed(command, options.runs)
+            print('%-24s %10.1f %10.1f' % (name, times[0] * 1000, times[len(times) // 2] * 1000))
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == '__main__':
+    main()
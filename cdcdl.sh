@@ -5,4 +5,5 @@
 mkdir -p ${WORKDIR}/ms-data/
 chmod 400 ${WORKDIR}/rsync_pass
 chown jenkins ${WORKDIR}/rsync_pass
-/usr/bin/rsync --password-file=${WORKDIR}/rsync_pass -avz rsync://darthvader@176.32.89.130/msd/SET/ ${WORKDIR}/ms-data/SET/
+# keep the itemized change list so ms2csv.py --changes converts only what rsync updated
+/usr/bin/rsync --password-file=${WORKDIR}/rsync_pass -avz --itemize-changes rsync://darthvader@176.32.89.130/msd/SET/ ${WORKDIR}/ms-data/SET/ | tee ${WORKDIR}/ms-data/SET.changes
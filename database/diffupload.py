@@ -0,0 +1,176 @@
+"""
+Diff mode of rdsupload.py: deltas computed in worker processes, uploaded in batches.
+"""
+
+import csv
+import difflib
+import os
+import os.path
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+
+from metastock.compress import open_text
+from metastock.stats import RunStats
+
+
+def compute_delta(symbol, new_path, old_path):
+    """
+    Rows of `new_path` missing from `old_path`, runs in a worker process
+
+    The rows are the lines difflib.Differ marks as added, like
+    RLTraderConnector._diff_csv. When `old_path` does not exist, every row
+    of `new_path` but the header is returned and 'full' is True.
+
+    Returns
+    -------
+    dict
+        'symbol', 'full', 'rows' (symbol, date, open, high, low, close, volume)
+        with the date already parsed, 'seconds' and 'nbytes' read
+
+    """
+    started = time.perf_counter()
+    full = not os.path.isfile(old_path)
+    with open_text(new_path, newline='') as f:
+        new_lines = f.read().splitlines()
+    nbytes = os.path.getsize(new_path)
+    if full:
+        lines = new_lines[1:]
+    else:
+        with open_text(old_path, newline='') as f:
+            old_lines = f.read().splitlines()
+        nbytes += os.path.getsize(old_path)
+        lines = [line[2:] for line in difflib.Differ().compare(old_lines, new_lines) if line.startswith('+ ')]
+    rows = [(row[0], datetime.strptime(row[1], '%Y%m%d').date(), row[2], row[3], row[4], row[5], row[6])
+            for row in csv.reader(lines, delimiter=',')]
+    return {'symbol': symbol, 'full': full, 'rows': rows,
+            'seconds': time.perf_counter() - started, 'nbytes': nbytes}
+
+
+class DeltaUploader(object):
+    """
+    Compute the deltas of many symbols in parallel while this process uploads them
+
+    A pool of worker processes reads both versions of the csv files and
+    compares them; at most `depth` files are in flight. The deltas are
+    uploaded as they complete, the rows of several symbols going to the
+    database in one REPLACE and one commit once `batch_rows` rows are
+    waiting. The uploads run while the workers compare the next files.
+
+    Private Variables
+    ----------
+    connector : RLTraderConnector
+        Connection used by the upload stage, its market must be set
+
+    workers : int
+        Number of worker processes
+
+    depth : int
+        Maximum number of files being compared or waiting for upload
+
+    batch_rows : int
+        Rows sent in one REPLACE and commit (default: BATCH_ROWS)
+
+    stats : RunStats
+        Collect per-stage timing: 'diff' (in the workers), 'diff_wait' (upload stage
+        waiting for a delta), 'db_query', 'db_write', 'db_commit', and the counters
+        'files_unchanged', 'files_changed', 'files_new', 'files_skipped', 'rows_added'
+
+    """
+    BATCH_ROWS = 5000
+
+    def __init__(self, connector, workers=None, depth=None, batch_rows=None, stats=None):
+        self.connector = connector
+        self.workers = workers or os.cpu_count() or 1
+        self.depth = depth or 2 * self.workers
+        self.batch_rows = max(batch_rows or self.BATCH_ROWS, 1)
+        self.stats = stats or RunStats()
+        self.batch = []
+        self.executor = None
+
+    def _submit(self, new_dir, old_dir, market, filename):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.workers)
+        return self.executor.submit(compute_delta, self.connector._symbol(filename),
+                                    os.path.join(new_dir, market, filename), os.path.join(old_dir, market, filename))
+
+    def _flush(self):
+        if self.batch:
+            self.connector.upload_payload = self.batch
+            self.connector._process_end(None)
+            self.stats.count('batches')
+            self.batch = []
+
+    def _upload(self, delta):
+        """
+        Queue the rows of a delta for the next batch
+        """
+        symbol = delta['symbol']
+        self.stats.add('diff', symbol, delta['seconds'], len(delta['rows']), delta['nbytes'])
+        print('Loading %s...' % symbol)
+        if not delta['full'] and not delta['rows']:
+            print('No update')
+            self.stats.count('files_unchanged')
+            return
+        # like _read_csv, a file without old version is skipped when the symbol already exists
+        if delta['full'] and not self.connector.get_symbol(symbol)['is_new'] and not self.connector.force:
+            print('Skipped!')
+            self.stats.count('files_skipped')
+            return
+        self.stats.count(delta['full'] and 'files_new' or 'files_changed')
+        self.stats.count('rows_added', len(delta['rows']))
+        for row in delta['rows']:
+            self.batch.append((self.connector._cache_symbol_id(row[0]),) + row[1:])
+        if len(self.batch) >= self.batch_rows:
+            self._flush()
+
+    def upload(self, new_dir, old_dir, market, filenames):
+        """
+        Upload the delta of every file of `market`, return when all of them are committed
+
+        Parameters
+        ----------
+        new_dir : str
+            Directory of the current csv files, <new_dir>/<market>/<filename>
+
+        old_dir : str
+            Directory of the previous csv files, <old_dir>/<market>/<filename>
+
+        market : str
+
+        filenames : list(str)
+
+        """
+        todo = iter(filenames)
+        pending = set()
+        for filename in todo:
+            pending.add(self._submit(new_dir, old_dir, market, filename))
+            if len(pending) >= self.depth:
+                break
+        while pending:
+            with self.stats.measure('diff_wait'):
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            # keep the workers busy while the completed deltas are uploaded
+            for filename in todo:
+                pending.add(self._submit(new_dir, old_dir, market, filename))
+                if len(pending) >= self.depth:
+                    break
+            for future in done:
+                self._upload(future.result())
+        self._flush()
+
+    def close(self):
+        """
+        Stop the worker processes and print the run summary
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        stages = dict((entry['stage'], entry['seconds']) for entry in self.stats.entries() if entry['type'] == 'stage')
+        counters = self.stats.counters
+        print('Diff: %d unchanged, %d changed, %d new, %d skipped files, %d rows added'
+              % (counters.get('files_unchanged', 0), counters.get('files_changed', 0), counters.get('files_new', 0),
+                 counters.get('files_skipped', 0), counters.get('rows_added', 0)))
+        print('Stages: diff %.1fs (in %d workers), waited for deltas %.1fs, db query %.1fs, write %.1fs, commit %.1fs'
+              % (stages.get('diff', 0.0), self.workers, stages.get('diff_wait', 0.0), stages.get('db_query', 0.0),
+                 stages.get('db_write', 0.0), stages.get('db_commit', 0.0)))
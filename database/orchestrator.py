@@ -0,0 +1,268 @@
+"""
+Convert MetaStock markets and upload every symbol as soon as its CSV is written.
+"""
+
+import os
+import os.path
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from optparse import Values
+
+from metastock.files import MSEMasterFile, MSXMasterFile
+from metastock.stats import RunStats
+from metastock.verify import Quarantine
+from database.rltrader import RLTraderConnector
+
+# tells a stage worker that no more work will come
+_DONE = object()
+
+# master files parsed by a conversion process, kept for the symbols that follow
+_masters = {}
+
+
+def convert_unit(input_dir, subdir, name, file_num, output_dir, precision, read_options):
+    """
+    Write the CSV of one symbol, runs in a conversion process
+
+    The master file is parsed once per process and kept in _masters.
+
+    Returns
+    -------
+    dict
+        'converted' True when the output has been written, 'stages' the
+        ((symbol, stage), [count, records, nbytes, seconds]) timings of the conversion
+
+    """
+    key = (input_dir, subdir, name)
+    master = _masters.get(key)
+    if master is None:
+        options = Values({'input_dir': input_dir, 'precision': precision})
+        master = _masters[key] = (name == 'EMASTER' and MSEMasterFile or MSXMasterFile)(options, subdir)
+    stock = next(stock for stock in master.stocks if stock.file_num == file_num)
+    stats = RunStats()
+    converted = stock.convert2ascii(master.input_dir, output_dir, stats, **read_options)
+    return {'converted': converted, 'stages': list(stats.symbols.items())}
+
+
+class ConvertUploadPipeline(object):
+    """
+    Run ms2csv.py and rdsupload.py as one pipeline over (market, symbol) units
+
+    Conversion processes write <output_dir>/<market>/<SYMBOL>.TXT (decoding is
+    pure Python, threads would be serialized by the GIL), the main thread hands
+    every converted symbol over to the upload threads through a queue holding
+    at most `depth` symbols. Each upload thread has its own RLTraderConnector
+    (database connection). When uploads fall behind, the queue fills up and
+    no more conversions are submitted. The run then takes about as long as the
+    slower stage instead of the sum of both.
+
+    Private Variables
+    ----------
+    options
+        Command line options (input_dir, output_dir, config_path, force, precision, ...)
+
+    convert_workers : int
+        Number of conversion processes, 2 x convert_workers symbols are converted at a time
+
+    upload_workers : int
+        Number of upload threads, each with its own database connection
+
+    depth : int
+        Maximum number of converted symbols waiting to be uploaded
+
+    stats : RunStats
+        Collect per-stage timing, 'handoff_put' is the time conversions waited
+        for room in the queue (backpressure), 'handoff_get' the time uploads
+        waited for a converted symbol
+
+    connector_factory : callable
+        Called with the options to create the connector of an upload worker
+
+    """
+    def __init__(self, options, convert_workers=2, upload_workers=2, depth=8, stats=None,
+                 connector_factory=RLTraderConnector):
+        self.options = options
+        self.convert_workers = max(convert_workers, 1)
+        self.upload_workers = max(upload_workers, 1)
+        self.depth = max(depth, 1)
+        self.stats = stats or RunStats()
+        self.connector_factory = connector_factory
+        self.total = 0
+        self.progress = {'converted': 0, 'uploaded': 0, 'failed': 0, 'quarantined': 0, 'queue_max': 0}
+        self._handoff = queue.Queue(self.depth)
+        self._lock = threading.Lock()
+
+    def _masters(self, markets=None):
+        """
+        Yield the market name and the master files of every MetaStock directory
+        whose name is in `markets` (all of them when None)
+        """
+        for dirpath, dirnames, filenames in os.walk(self.options.input_dir):
+            dirnames.sort()
+            market = os.path.basename(os.path.normpath(dirpath))
+            if markets is not None and market not in markets:
+                continue
+            subdir = os.path.relpath(dirpath, self.options.input_dir)
+            if 'EMASTER' in filenames:
+                yield market, MSEMasterFile(self.options, subdir)
+            if 'XMASTER' in filenames:
+                yield market, MSXMasterFile(self.options, subdir)
+
+    def units(self, markets=None, symbols=None):
+        """
+        List the (market, master, stock) units to convert and upload
+
+        Symbols listed in the quarantine of the market output directory
+        (see `ms2csv.py --verify`) are left out
+
+        Parameters
+        ----------
+        markets : list(str), optional
+            Markets (MetaStock directory names) to process, all when None
+
+        symbols : list(str), optional
+            Symbols to process, all when None
+
+        """
+        units = []
+        for market, master in self._masters(markets):
+            path = os.path.join(self.options.output_dir, market, Quarantine.FILENAME)
+            quarantined = os.path.isfile(path) and Quarantine(path).symbols() or set()
+            for stock in master.stocks:
+                if symbols is not None and stock.stock_symbol not in symbols:
+                    continue
+                if stock.stock_symbol in quarantined:
+                    print('Quarantined %s, skipped' % stock.stock_symbol)
+                    self.progress['quarantined'] += 1
+                    continue
+                units.append((market, master, stock))
+        return units
+
+    def _report(self, event):
+        with self._lock:
+            self.progress[event] += 1
+            print('Progress: converted %d/%d, uploaded %d/%d, failed %d, queue %d/%d'
+                  % (self.progress['converted'], self.total, self.progress['uploaded'], self.total,
+                     self.progress['failed'], self._handoff.qsize(), self.depth))
+
+    def _submit(self, executor, unit):
+        market, master, stock = unit
+        return executor.submit(convert_unit, self.options.input_dir,
+                               os.path.relpath(master.input_dir, self.options.input_dir),
+                               isinstance(master, MSEMasterFile) and 'EMASTER' or 'XMASTER', stock.file_num,
+                               os.path.join(self.options.output_dir, market), self.options.precision,
+                               master.read_options())
+
+    def _converted(self, unit, future):
+        """
+        Hand a converted unit over to the upload threads, waits while the queue is full
+        """
+        market, master, stock = unit
+        output_dir = os.path.join(self.options.output_dir, market)
+        try:
+            result = future.result()
+        except Exception:
+            print('Error while converting symbol', stock.stock_symbol)
+            traceback.print_exc()
+            result = {'converted': False, 'stages': []}
+        for (symbol, stage), (count, records, nbytes, seconds) in result['stages']:
+            self.stats.add(stage, symbol, seconds, records, nbytes)
+        if not result['converted']:
+            self.stats.count('convert_failed')
+            self._report('failed')
+            return
+        self.stats.count('converted')
+        with self.stats.measure('handoff_put', stock.stock_symbol):
+            self._handoff.put((market, output_dir, os.path.basename(stock.output_filename(output_dir))))
+        with self._lock:
+            self.progress['queue_max'] = max(self.progress['queue_max'], self._handoff.qsize())
+        self._report('converted')
+
+    def _upload(self, connector):
+        """
+        Upload worker: send every converted symbol to the database
+        """
+        market_id = {}
+        current = None
+        while True:
+            with self.stats.measure('handoff_get'):
+                item = self._handoff.get()
+            if item is _DONE:
+                return
+            market, output_dir, filename = item
+            symbol = connector._symbol(filename)
+            try:
+                if market != current:
+                    if market not in market_id:
+                        connector.set_market(market)
+                        market_id[market] = connector.market_id
+                    connector.market_id = market_id[market]
+                    current = market
+                connector._read_csv(output_dir, filename)
+            except Exception:
+                print('Error while uploading symbol', symbol)
+                traceback.print_exc()
+                self.stats.count('upload_failed')
+                self._report('failed')
+                continue
+            self.stats.count('uploaded')
+            self._report('uploaded')
+
+    def run(self, markets=None, symbols=None):
+        """
+        Convert and upload all units, return when every upload is done
+
+        Parameters are the same as units
+
+        Returns
+        -------
+        dict
+            Progress counters (converted, uploaded, failed, quarantined, queue_max)
+
+        """
+        units = self.units(markets, symbols)
+        self.total = len(units)
+        for market in sorted(set(market for market, _, _ in units)):
+            os.makedirs(os.path.join(self.options.output_dir, market), exist_ok=True)
+        # connect first, a database error stops the run before anything is converted
+        connectors = [self.connector_factory(self.options) for _ in range(self.upload_workers)]
+
+        started = time.perf_counter()
+        self._handoff = queue.Queue(self.depth)
+        uploaders = [threading.Thread(target=self._upload, args=(connector,), name='ms-upload-%d' % i, daemon=True)
+                     for i, connector in enumerate(connectors)]
+        for thread in uploaders:
+            thread.start()
+        try:
+            with ProcessPoolExecutor(self.convert_workers) as executor:
+                todo = iter(units)
+                pending = {}
+                while True:
+                    # keep every conversion process busy while the main thread waits for room in the queue
+                    for unit in todo:
+                        pending[self._submit(executor, unit)] = unit
+                        if len(pending) >= 2 * self.convert_workers:
+                            break
+                    if not pending:
+                        break
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._converted(pending.pop(future), future)
+        finally:
+            for _ in uploaders:
+                self._handoff.put(_DONE)
+            for thread in uploaders:
+                thread.join()
+
+        stages = dict((entry['stage'], entry['seconds']) for entry in self.stats.entries() if entry['type'] == 'stage')
+        print('Done in %.1fs: converted %d/%d, uploaded %d, failed %d, quarantined %d'
+              % (time.perf_counter() - started, self.progress['converted'], self.total, self.progress['uploaded'],
+                 self.progress['failed'], self.progress['quarantined']))
+        print('Backpressure: conversions waited %.1fs for the queue (max %d/%d), uploads waited %.1fs for symbols'
+              % (stages.get('handoff_put', 0.0), self.progress['queue_max'], self.depth,
+                 stages.get('handoff_get', 0.0)))
+        self.stats.count('queue_max', self.progress['queue_max'])
+        return self.progress
@@ -5,9 +5,51 @@ Upload data to RLTrader data set
 import csv
 import os
 import json
-import pymysql.cursors
 import difflib
 from datetime import datetime
+from metastock.stats import RunStats
+from metastock.compress import open_text, strip_suffix
+
+
+def shard_weights(input_dir, filters=None):
+    """
+    Map the 'market/symbol' key of every symbol walk_market would upload to the size of its data,
+    the <SYMBOL>.TXT file or the block of the symbol in a <market>.MSS store
+
+    Parameters
+    ----------
+    input_dir : str
+
+    filters : list(str), optional
+        List of market that will be process, see RLTraderConnector.walk_market
+
+    """
+    from metastock.resample import PERIODS
+    from metastock.shard import unit_key
+    from metastock.store import MarketStore
+    from metastock.verify import Quarantine
+    weights = {}
+    for dirpath, dirnames, filenames in os.walk(input_dir):
+        dirnames[:] = [name for name in dirnames if name not in PERIODS.values()]
+        market = os.path.basename(dirpath)
+        quarantined = set()
+        if Quarantine.FILENAME in filenames:
+            quarantined = Quarantine(os.path.join(dirpath, Quarantine.FILENAME)).symbols()
+        if filters is None or market in filters:
+            for filename in filenames:
+                if strip_suffix(filename).endswith('.TXT') and not filename.startswith('$'):
+                    symbol = RLTraderConnector._symbol(filename)
+                    if symbol not in quarantined:
+                        weights[unit_key(market, symbol)] = os.path.getsize(os.path.join(dirpath, filename))
+        for filename in filenames:
+            store_market = os.path.splitext(filename)[0]
+            if filename.endswith('.MSS') and (filters is None or store_market in filters):
+                with MarketStore(os.path.join(dirpath, filename)) as store:
+                    for symbol in store.symbols():
+                        if symbol not in quarantined:
+                            key = unit_key(store_market, symbol)
+                            weights[key] = weights.get(key, 0) + store.index[symbol]['length']
+    return weights
 
 
 class RLTraderConnector(object):
@@ -16,6 +58,7 @@ class RLTraderConnector(object):
     connection = None
     force = None
     market_id = None
+    quarantined = set()
     upload_payload = []
 
     def __init__(self, options):
@@ -32,6 +75,9 @@ class RLTraderConnector(object):
         options.force : bool, optional
             Force upload to replace existing price data on symbol that recognized
 
+        options.stats : RunStats, optional
+            Collect database round trip and commit timing
+
         Private Variables
         ----------
         cache_symbol : str
@@ -49,6 +95,9 @@ class RLTraderConnector(object):
         market_id : int
             Store current market_id
 
+        quarantined : set(str)
+            Symbols `ms2csv.py --verify` quarantined in the directory being walked, they are not uploaded
+
         upload_payload : list(tuple)
             Buffer rows for bulk REPLACE(INSERT) operation
 
@@ -58,6 +107,9 @@ class RLTraderConnector(object):
 
         self.options = options
         self.force = options.force
+        self.stats = getattr(options, 'stats', None) or RunStats()
+        # imported here so that loading this module (f.e. rdsupload.py --check-shards) does not load the driver
+        import pymysql.cursors
         self.connection = pymysql.connect(
             host=self.config['host'],
             user=self.config['user'],
@@ -92,7 +144,7 @@ class RLTraderConnector(object):
         MarketSQLRow
 
         """
-        with self.connection.cursor() as cursor:
+        with self.stats.measure('db_query'), self.connection.cursor() as cursor:
             sql = "SELECT * FROM `market` WHERE name=%s"
             cursor.execute(sql, (symbol,))
             row = cursor.fetchone()
@@ -114,7 +166,7 @@ class RLTraderConnector(object):
         SymbolSQLRow
 
         """
-        with self.connection.cursor() as cursor:
+        with self.stats.measure('db_query', symbol), self.connection.cursor() as cursor:
             sql = "SELECT * FROM `symbol` WHERE name=%s and market_id=%s"
             cursor.execute(sql, (symbol, self.market_id))
             row = cursor.fetchone()
@@ -145,7 +197,7 @@ class RLTraderConnector(object):
         int
 
         """
-        with self.connection.cursor() as cursor:
+        with self.stats.measure('db_query'), self.connection.cursor() as cursor:
             sql = "SELECT count(*) as COUNT FROM `price` WHERE symbol_id=%s"
             cursor.execute(sql, (symbol_id,))
             row = cursor.fetchone()
@@ -219,17 +271,25 @@ class RLTraderConnector(object):
         size = len(self.upload_payload)
         print('Uploaded row count:  %d' % size)
         if size > 0:
-            with self.connection.cursor() as cursor:
+            with self.stats.measure('db_write', symbol) as m, self.connection.cursor() as cursor:
                 sql = ("REPLACE INTO `price`(symbol_id,date,open,high,low,close,volume) "
                        "VALUES(%s,%s,%s,%s,%s,%s,%s)")
                 cursor.executemany(sql, self.upload_payload)
-            self.connection.commit()
+                m.records = size
+            with self.stats.measure('db_commit', symbol):
+                self.connection.commit()
             print('Committed')
 
     def walk_market(self, filters=None):
         """
         Scan through all file in path. If market symbol found in filters then proceed read csv from that directory
-        File in directory need to end with .TXT and not start with '$' (funky data from CDCDL)
+        File in directory need to end with .TXT and not start with '$' (funky data from CDCDL),
+        gzip/zstd compressed .TXT.gz/.TXT.zst files are read transparently.
+        Symbols listed in the directory quarantine (see `ms2csv.py --verify`) are skipped,
+        so are the weekly/monthly/quarterly bars written by `ms2csv.py --resample`
+        and, with options.shard, the symbols of the other shards.
+        With options.diff_dir and options.diff_workers the csv files of a market are
+        compared in worker processes and uploaded in batches (see DeltaUploader)
 
         Parameters
         ----------
@@ -242,18 +302,75 @@ class RLTraderConnector(object):
         """
         if isinstance(filters, str):
             filters = (filters,)
+        shard = getattr(self.options, 'shard', None)
+        uploader = None
+        if self.options.diff_dir is not None and getattr(self.options, 'diff_workers', 0):
+            # imported here, like pymysql, it loads the process pool machinery
+            from database.diffupload import DeltaUploader
+            uploader = DeltaUploader(self, self.options.diff_workers, batch_rows=getattr(self.options, 'batch_rows', None),
+                                     stats=self.stats)
+        try:
+            self._walk_market(filters, shard, uploader)
+        finally:
+            if uploader is not None:
+                uploader.close()
+
+    def _walk_market(self, filters, shard, uploader):
+        """
+        Upload every market directory and store, see walk_market
+        """
+        from metastock.resample import PERIODS
+        from metastock.verify import Quarantine
         for dirpath, dirnames, filenames in os.walk(self.options.input_dir):
+            dirnames[:] = [name for name in dirnames if name not in PERIODS.values()]
             market = os.path.basename(dirpath)
+            self.quarantined = set()
+            if Quarantine.FILENAME in filenames:
+                self.quarantined = Quarantine(os.path.join(dirpath, Quarantine.FILENAME)).symbols()
             if filters is None or market in filters:
                 self.set_market(market)
 
-                # Only grab csv file with extension .TXT
-                csv_list = sorted([f for f in filenames if f.endswith('.TXT') and not f.startswith('$')])
+                # Only grab csv file with extension .TXT (optionally compressed .TXT.gz/.TXT.zst)
+                csv_list = sorted([f for f in filenames
+                                   if strip_suffix(f).endswith('.TXT') and not f.startswith('$')])
+                delta_list = []
                 for filename in csv_list:
-                    if self.options.diff_dir is None:
+                    if self._symbol(filename) in self.quarantined:
+                        print('Quarantined %s, skipped' % self._symbol(filename))
+                        continue
+                    if shard is not None and not shard.owns(market, self._symbol(filename)):
+                        continue
+                    if uploader is not None:
+                        delta_list.append(filename)
+                    elif self.options.diff_dir is None:
                         self._read_csv(dirpath, filename)
                     else:
                         self._diff_csv(self.options.input_dir, self.options.diff_dir, market, filename)
+                    if shard is not None and uploader is None:
+                        shard.complete(market, self._symbol(filename))
+                if delta_list:
+                    uploader.upload(self.options.input_dir, self.options.diff_dir, market, delta_list)
+                    for filename in delta_list:
+                        if shard is not None:
+                            shard.complete(market, self._symbol(filename))
+
+            # Packed market stores written by `ms2csv.py -f store`, one <market>.MSS per market
+            for filename in sorted(f for f in filenames if f.endswith('.MSS')):
+                store_market = os.path.splitext(filename)[0]
+                if filters is None or store_market in filters:
+                    self.set_market(store_market)
+                    old_path = None
+                    if self.options.diff_dir is not None:
+                        old_path = os.path.join(self.options.diff_dir,
+                                                os.path.relpath(os.path.join(dirpath, filename), self.options.input_dir))
+                    self._read_store(os.path.join(dirpath, filename), old_path)
+
+    @staticmethod
+    def _symbol(filename):
+        """
+        Symbol name of a <SYMBOL>.TXT file written by ms2csv.py
+        """
+        return os.path.splitext(strip_suffix(filename))[0].replace('_', '/')
 
     def _read_csv(self, dirpath, filename):
         """
@@ -269,22 +386,101 @@ class RLTraderConnector(object):
         filename : str
 
         """
-        symbol = os.path.splitext(filename)[0].replace('_','/')
+        symbol = self._symbol(filename)
 
         # Skip if already uploaded
         if not self._process_start(symbol) and not self.force:
             print('Skipped!')
             return
 
-        with open(os.path.join(dirpath, filename), 'r', newline='') as f:
-            reader = csv.reader(f, delimiter=',')
-            # Skip Header
-            next(reader)
-
-            for i, line in enumerate(reader):
-                self._process_row(i, line)
+        csv_path = os.path.join(dirpath, filename)
+        with open_text(csv_path, newline='') as f:
+            with self.stats.measure('csv_read', symbol) as m:
+                reader = csv.reader(f, delimiter=',')
+                # Skip Header
+                next(reader)
+
+                for i, line in enumerate(reader):
+                    self._process_row(i, line)
+                m.records = len(self.upload_payload)
+                m.nbytes = os.path.getsize(csv_path)
             self._process_end(symbol)
 
+    def _read_store(self, path, old_path=None):
+        """
+        Read every symbol of a market store
+
+        Without `old_path` a symbol is skipped when it already exists (unless force),
+        like _read_csv. With `old_path` only the rows missing from the old store are
+        uploaded, like _diff_csv.
+        Process row using self._process_row(i, line)
+        Commit rows using self._process_end(symbol)
+
+        Parameters
+        ----------
+        path : str
+            Store file
+
+        old_path : str, optional
+            Previous version of the store file
+
+        """
+        from metastock.store import MarketStore
+        old_store = None
+        if old_path is not None and os.path.isfile(old_path):
+            old_store = MarketStore(old_path)
+        try:
+            with MarketStore(path) as store:
+                price_format = '%%.%df' % store.precision
+                market = os.path.splitext(os.path.basename(path))[0]
+                shard = getattr(self.options, 'shard', None)
+                for symbol in store.symbols():
+                    if symbol in self.quarantined:
+                        print('Quarantined %s, skipped' % symbol)
+                        continue
+                    if shard is not None and not shard.owns(market, symbol):
+                        continue
+                    self._store_symbol(store, symbol, old_store, old_path, price_format)
+                    if shard is not None:
+                        shard.complete(market, symbol)
+        finally:
+            if old_store is not None:
+                old_store.close()
+
+    def _store_symbol(self, store, symbol, old_store, old_path, price_format):
+        """
+        Upload one symbol of a market store, see _read_store
+        """
+        old_rows = set()
+        if old_store is not None and symbol in old_store.index:
+            old_rows = set(self._store_rows(old_store, symbol, price_format))
+        elif old_path is None and not self._process_start(symbol) and not self.force:
+            print('Skipped!')
+            return
+
+        rows = [row for row in self._store_rows(store, symbol, price_format) if row not in old_rows]
+        if old_path is not None:
+            if not rows:
+                print('Loading %s...' % symbol)
+                print('No update')
+                return
+            self._process_start(symbol)
+        for i, row in enumerate(rows):
+            self._process_row(i, list(row))
+        self._process_end(symbol)
+
+    @staticmethod
+    def _store_rows(store, symbol, price_format):
+        """
+        Yield the rows of `symbol` formatted like the columns of a csv file
+        """
+        columns = dict(store.read(symbol))
+        for date, open_, high, low, close, volume in zip(columns['Date'], columns['Open'], columns['High'],
+                                                         columns['Low'], columns['Close'], columns['Volume']):
+            yield (symbol, '%d' % date, price_format % open_, price_format % high,
+                   price_format % low, price_format % close, '%d' % volume)
+        columns.clear()
+
     def _diff_csv(self, new_dir, old_dir, market, filename):
         """
         Diff csv file
@@ -309,13 +505,13 @@ class RLTraderConnector(object):
             return self._read_csv(os.path.join(new_dir, market), filename)
 
         diff = []
-        with open(old_csv_path, 'r') as f1, open(new_csv_path, 'r') as f2:
+        with open_text(old_csv_path) as f1, open_text(new_csv_path) as f2:
             differ = difflib.Differ()
             for line in differ.compare(f1.read().splitlines(), f2.read().splitlines()):
                 if line.startswith('+ '):
                     diff.append(line[2:])
 
-        symbol = os.path.splitext(filename)[0].replace('_', '/')
+        symbol = self._symbol(filename)
         if len(diff) > 0:
             self._process_start(symbol)
             reader = csv.reader(diff, delimiter=',')
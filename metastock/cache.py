@@ -0,0 +1,152 @@
+"""
+Conversion cache used to skip symbols whose inputs did not change.
+"""
+
+import json
+import os.path
+import zlib
+
+
+class ConversionCache(object):
+    """
+    Remember, for every converted symbol, the fingerprint of its DAT/DOP files,
+    the conversion settings and the output path.
+
+    A symbol is skipped when all of them are the same as in the previous run
+    and the output file still exists. The fingerprint recorded for a converted
+    symbol is the one is_fresh took before its files were read, a file
+    rewritten during the conversion is then converted again in the next run.
+
+    Private Variables
+    ----------
+    path : str
+        JSON file where the cache is stored
+
+    use_hash : bool
+        Add a CRC32 of the file content to the fingerprint (size and mtime only otherwise)
+
+    entries : dict
+        Mapping '<input_dir>:<file_num>' -> entry
+
+    pending : dict
+        Mapping '<input_dir>:<file_num>' -> fingerprint taken by is_fresh, used by update
+
+    skipped : int
+        Number of symbols skipped in this run
+
+    converted : int
+        Number of symbols converted in this run
+
+    """
+    FILENAME = '.ms2csv-cache.json'
+
+    def __init__(self, path, use_hash=False):
+        self.path = path
+        self.use_hash = use_hash
+        self.entries = {}
+        self.pending = {}
+        self.skipped = 0
+        self.converted = 0
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                print('Ignoring unreadable conversion cache %s' % path)
+
+    @staticmethod
+    def key(input_dir, stock):
+        return '%s:%d' % (input_dir, stock.file_num)
+
+    def _file_fingerprint(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        fingerprint = [st.st_size, st.st_mtime_ns]
+        if self.use_hash:
+            crc = 0
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    crc = zlib.crc32(chunk, crc)
+            fingerprint.append(crc)
+        return fingerprint
+
+    def fingerprint(self, input_dir, stock):
+        """
+        Return the fingerprint of the DAT/MWD and DOP files of a symbol
+        """
+        ext = (stock.file_num <= 255) and 'DAT' or 'MWD'
+        return {
+            'dat': self._file_fingerprint(os.path.join(input_dir, 'F%d.%s' % (stock.file_num, ext))),
+            'dop': self._file_fingerprint(os.path.join(input_dir, 'F%d.DOP' % stock.file_num)),
+        }
+
+    def is_fresh(self, input_dir, stock, settings, output):
+        """
+        Check whether the symbol output is up to date
+
+        Parameters
+        ----------
+        input_dir : str
+            Path of MetaStock directory input
+
+        stock : DataFileInfo
+
+        settings : dict
+            Conversion options that change the output (f.e. precision)
+
+        output : str
+            Path of the output file
+
+        Returns
+        -------
+        bool
+            True when the conversion can be skipped
+
+        """
+        key = self.key(input_dir, stock)
+        fingerprint = self.fingerprint(input_dir, stock)
+        entry = self.entries.get(key)
+        fresh = entry is not None and \
+            entry['output'] == output and \
+            entry['settings'] == settings and \
+            os.path.isfile(output) and \
+            entry['fingerprint'] == fingerprint
+        if fresh:
+            self.skipped += 1
+        else:
+            self.pending[key] = fingerprint
+        return fresh
+
+    def update(self, input_dir, stock, settings, output, fingerprint=None):
+        """
+        Record a successful conversion
+
+        Parameters
+        ----------
+        fingerprint : dict, optional
+            Fingerprint of the files taken before they were read (default: the one
+            taken by is_fresh, a new one when is_fresh was not called)
+
+        """
+        key = self.key(input_dir, stock)
+        if fingerprint is None:
+            fingerprint = self.pending.pop(key, None) or self.fingerprint(input_dir, stock)
+        self.converted += 1
+        self.entries[key] = {
+            'symbol': stock.stock_symbol,
+            'fingerprint': fingerprint,
+            'settings': settings,
+            'output': output,
+        }
+
+    def save(self):
+        """
+        Write the cache file, replacing the previous one atomically
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+        print('Symbols converted: %d, skipped (unchanged): %d' % (self.converted, self.skipped))
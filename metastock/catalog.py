@@ -0,0 +1,174 @@
+"""
+Catalog of the symbols under an input directory, used by list and single-symbol
+commands instead of walking the tree and parsing every master file.
+"""
+
+import json
+import os
+import os.path
+
+MASTERS = ('EMASTER', 'XMASTER')
+
+
+def print_symbols(rows):
+    """
+    Print (symbol, name, file number) rows like MasterFile.list_all_symbols
+    """
+    print("List of available symbols:")
+    for symbol, name, file_num in rows:
+        print("symbol: %s, name: %s, file number: %s" % (symbol, name, file_num))
+
+
+class SymbolCatalog(object):
+    """
+    Remember the directories ms2csv.py scans and the symbols of their master files
+
+    Checking the catalog costs one stat per directory and master file: a
+    directory whose modification time changed (entries added or removed)
+    rebuilds the whole catalog, a master file whose size or modification
+    time changed is parsed again. The directory holding the catalog itself
+    is compared by its sub directory names, since saving the catalog and
+    writing outputs change its modification time.
+
+    Private Variables
+    ----------
+    path : str
+        JSON file where the catalog is stored
+
+    input_dir : str
+        Directory the catalog describes
+
+    entries : dict
+        'tree' mapping every directory (relative to input_dir) -> mtime_ns (or sub directory names),
+        'subdirs' the sub directory names scanned by ms2csv.py, in walk order,
+        'masters' mapping '<subdir>/<EMASTER|XMASTER>' -> 'stat' [size, mtime_ns] and
+        'symbols' [[symbol, name, file number], ...]
+
+    updated : bool
+        The catalog changed and has to be saved
+
+    """
+    FILENAME = '.ms2csv-catalog.json'
+
+    def __init__(self, path, input_dir):
+        self.path = path
+        self.input_dir = input_dir
+        self.entries = None
+        self.updated = False
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    entries = json.load(f)
+            except ValueError:
+                print('Ignoring unreadable symbol catalog %s' % path)
+            else:
+                if entries.get('input_dir') == input_dir:
+                    self.entries = entries
+
+    def _own_directory(self):
+        """
+        Directory holding the catalog relative to input_dir, None when it is outside
+        """
+        relpath = os.path.relpath(os.path.dirname(os.path.realpath(self.path)), self.input_dir)
+        return not relpath.startswith(os.pardir) and relpath or None
+
+    @staticmethod
+    def _subdir_names(path):
+        return sorted(entry.name for entry in os.scandir(path) if entry.is_dir())
+
+    @staticmethod
+    def _stat(path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def _tree_changed(self):
+        own = self._own_directory()
+        try:
+            for relpath, state in self.entries['tree'].items():
+                path = os.path.join(self.input_dir, relpath)
+                if relpath == own:
+                    if self._subdir_names(path) != state:
+                        return True
+                elif os.stat(path).st_mtime_ns != state:
+                    return True
+        except OSError:
+            return True
+        return False
+
+    def _read_master(self, options, subdirname, name):
+        # imported here, a valid catalog answers without loading the conversion code
+        from .files import MSEMasterFile, MSXMasterFile
+        master = (name == 'EMASTER' and MSEMasterFile or MSXMasterFile)(options, subdirname)
+        return [[stock.stock_symbol, stock.stock_name, stock.file_num] for stock in master.stocks]
+
+    def _rebuild(self, options):
+        own = self._own_directory()
+        self.entries = {'input_dir': self.input_dir, 'tree': {}, 'subdirs': [], 'masters': {}}
+        # same directories as the walk of ms2csv.py
+        for dirpath, dirnames, filenames in os.walk(self.input_dir):
+            relpath = os.path.relpath(dirpath, self.input_dir)
+            self.entries['tree'][relpath] = sorted(dirnames) if relpath == own else os.stat(dirpath).st_mtime_ns
+            self.entries['subdirs'].extend(dirnames)
+        for subdirname in self.entries['subdirs']:
+            for name in MASTERS:
+                path = os.path.join(self.input_dir, subdirname, name)
+                if os.path.isfile(path):
+                    self.entries['masters'][os.path.join(subdirname, name)] = {
+                        'stat': self._stat(path), 'symbols': self._read_master(options, subdirname, name)}
+        self.updated = True
+
+    def refresh(self, options):
+        """
+        Check the catalog against the input directory and update what changed
+
+        Parameters
+        ----------
+        options
+            Command line options given to the master files parsed again
+
+        """
+        if self.entries is None or self._tree_changed():
+            self._rebuild(options)
+            return
+        for key, entry in self.entries['masters'].items():
+            try:
+                stat = self._stat(os.path.join(self.input_dir, key))
+            except OSError:
+                self._rebuild(options)
+                return
+            if stat != entry['stat']:
+                subdirname, name = os.path.split(key)
+                entry['stat'] = stat
+                entry['symbols'] = self._read_master(options, subdirname, name)
+                self.updated = True
+
+    def subdirs(self):
+        return list(self.entries['subdirs'])
+
+    def symbols(self, subdirname, name):
+        """
+        Rows (symbol, name, file number) of a master file
+        """
+        entry = self.entries['masters'].get(os.path.join(subdirname, name))
+        return entry is not None and entry['symbols'] or []
+
+    def locate(self, symbols):
+        """
+        Sub directories whose master files hold any of `symbols`, in walk order
+        """
+        symbols = set(symbols)
+        found = []
+        for subdirname in self.entries['subdirs']:
+            if subdirname not in found and any(row[0] in symbols for name in MASTERS
+                                               for row in self.symbols(subdirname, name)):
+                found.append(subdirname)
+        return found
+
+    def save(self):
+        if not self.updated:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+        self.updated = False
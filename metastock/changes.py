@@ -0,0 +1,104 @@
+"""
+Map a list of changed files (rsync --itemize-changes output or plain paths) to symbols.
+"""
+
+import os.path
+import re
+import sys
+
+
+class ChangeSet(object):
+    """
+    Symbols affected by a set of changed files, grouped by MetaStock directory
+
+    Accepted lines:
+        >f.st...... STOCK/F12.DAT                       rsync --itemize-changes
+        2020/01/02 18:00:01 [42] >f+++++++++ F1.DOP     rsync --log-file
+        /data/ms-data/SET/STOCK/EMASTER                 plain path
+    Relative paths are resolved against the input directory, lines that
+    do not name a MetaStock data or master file are ignored.
+
+    Private Variables
+    ----------
+    directories : dict
+        Mapping directory -> set of changed file numbers
+
+    masters : set(str)
+        Directories whose EMASTER/XMASTER changed, every symbol there is affected
+
+    """
+    itemize_reg = re.compile(r'^(?:\S+ \S+ \[\d+\] )?([<>ch.][fL][^ ]{9}|\*deleting) +(.+)$')
+    data_reg = re.compile(r'^F(\d+)\.(DAT|MWD|DOP)$', re.IGNORECASE)
+    master_reg = re.compile(r'^(E|X)?MASTER$', re.IGNORECASE)
+
+    def __init__(self, input_dir):
+        self.input_dir = input_dir
+        self.directories = {}
+        self.masters = set()
+
+    @classmethod
+    def load(cls, path, input_dir):
+        """
+        Read the change list from `path` ('-' means stdin)
+        """
+        changes = cls(input_dir)
+        if path == '-':
+            changes.parse(sys.stdin)
+        else:
+            with open(path, 'r', errors='replace') as f:
+                changes.parse(f)
+        return changes
+
+    def parse(self, lines):
+        """
+        Add every changed file listed in `lines`
+        """
+        for line in lines:
+            line = line.rstrip('\r\n')
+            match = self.itemize_reg.match(line)
+            if match is not None:
+                if match.group(1) == '*deleting':
+                    continue
+                line = match.group(2)
+            self.add(line.strip())
+
+    def add(self, path):
+        """
+        Mark the symbol stored in `path` as changed
+
+        Returns
+        -------
+        bool
+            False when `path` is not a MetaStock data or master file
+
+        """
+        dirname, filename = os.path.split(path)
+        dirname = os.path.realpath(os.path.join(self.input_dir, dirname))
+        if self.master_reg.match(filename):
+            self.masters.add(dirname)
+            self.directories.setdefault(dirname, set())
+            return True
+        match = self.data_reg.match(filename)
+        if match is None:
+            return False
+        self.directories.setdefault(dirname, set()).add(int(match.group(1)))
+        return True
+
+    def affected(self, input_dir):
+        """
+        Return the changed file numbers in `input_dir`
+
+        Returns
+        -------
+        set(int)
+            Changed file numbers, empty when nothing changed in that directory.
+            None means every symbol of the directory is affected.
+
+        """
+        input_dir = os.path.realpath(input_dir)
+        if input_dir in self.masters:
+            return None
+        return self.directories.get(input_dir, set())
+
+    def __len__(self):
+        return len(self.directories)
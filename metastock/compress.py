@@ -0,0 +1,206 @@
+"""
+Compressed outputs: gzip (stdlib) and zstd (optional `zstandard` module).
+"""
+
+import gzip
+import io
+import os
+import os.path
+import threading
+
+from .stats import RunStats
+
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def _zstandard():
+    """
+    Import the optional zstandard module when zstd is first used, None when it is not installed
+    """
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def check_method(method):
+    """
+    Raise ValueError when `method` is unknown or its module is not installed
+    """
+    if method not in SUFFIXES:
+        raise ValueError('unknown compression %r, expected one of %s' % (method, ', '.join(sorted(SUFFIXES))))
+    if method == 'zstd' and _zstandard() is None:
+        raise ValueError('zstd compression requires the zstandard module')
+
+
+def compress(method, data, level=None):
+    """
+    Compress `data` bytes, zlib and zstd release the GIL so this runs in parallel in threads
+    """
+    if method == 'gzip':
+        return gzip.compress(data, compresslevel=level or 6, mtime=0)
+    return _zstandard().ZstdCompressor(level=level or 3).compress(data)
+
+
+def decompress(method, data):
+    if method == 'gzip':
+        return gzip.decompress(data)
+    return _zstandard().ZstdDecompressor().decompress(data)
+
+
+def open_writer(method, fileobj, level=None):
+    """
+    Wrap the binary `fileobj` in a compressing stream, used for outputs too large to be compressed at once.
+    Closing the stream leaves `fileobj` open.
+    """
+    if method == 'gzip':
+        return gzip.GzipFile('', 'wb', level or 6, fileobj, mtime=0)
+    return _zstandard().ZstdCompressor(level=level or 3).stream_writer(fileobj, closefd=False)
+
+
+def strip_suffix(filename):
+    """
+    Return `filename` without its compression suffix (f.e. PTT.TXT.gz -> PTT.TXT)
+    """
+    for suffix in SUFFIXES.values():
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+def open_text(path, newline=None):
+    """
+    Open a text file for reading, decompressing it when its name ends with .gz or .zst
+    """
+    if path.endswith(SUFFIXES['gzip']):
+        return gzip.open(path, 'rt', newline=newline)
+    if path.endswith(SUFFIXES['zstd']):
+        check_method('zstd')
+        stream = _zstandard().ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        return io.TextIOWrapper(stream, newline=newline)
+    return open(path, 'r', newline=newline)
+
+
+class CompressionPool(object):
+    """
+    Compress and write outputs in background threads while the caller keeps decoding
+
+    At most 2 x `workers` outputs wait in memory, submit blocks when the pool is behind.
+
+    Private Variables
+    ----------
+    method : str
+        'gzip' or 'zstd'
+
+    suffix : str
+        Appended to the output file names
+
+    failed : set(str)
+        Paths of the outputs that could not be written
+
+    """
+    def __init__(self, method, workers=None, stats=None):
+        check_method(method)
+        self.method = method
+        self.suffix = SUFFIXES[method]
+        self.stats = stats or RunStats()
+        workers = workers or min(8, os.cpu_count() or 1)
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='ms-compress')
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        self.futures = []
+        self.failed = set()
+
+    def _compress(self, data, symbol):
+        try:
+            with self.stats.measure('compress', symbol) as m:
+                result = compress(self.method, data)
+                m.nbytes = len(data)
+            return result
+        finally:
+            self.slots.release()
+
+    def _write(self, path, data, symbol):
+        try:
+            data = self._compress(data, symbol)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            self.failed.add(path)
+            raise
+
+    def compress_async(self, data, symbol=None):
+        """
+        Return a future of the compressed `data`
+        """
+        self.slots.acquire()
+        return self.executor.submit(self._compress, data, symbol)
+
+    def submit(self, path, data, symbol=None):
+        """
+        Compress `data` and write it to `path` in the background
+        """
+        self.slots.acquire()
+        self.futures.append(self.executor.submit(self._write, path, data, symbol))
+        self.futures = [f for f in self.futures if not f.done() or f.exception() is not None]
+
+    def close(self):
+        """
+        Wait for every pending output, raise the first error
+        """
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+
+class CompressedTextWriter(object):
+    """
+    Write <SYMBOL>.TXT.gz / <SYMBOL>.TXT.zst files through a CompressionPool
+    """
+    def __init__(self, output_dir, pool):
+        self.output_dir = output_dir
+        self.pool = pool
+
+    def output_filename(self, stock):
+        return stock.output_filename(self.output_dir) + self.pool.suffix
+
+    def write(self, stock, columns, stats=None):
+        """
+        Format the decoded columns of `stock` and queue them for compression
+        """
+        stats = stats or RunStats()
+        with stats.measure('write', stock.stock_symbol) as m:
+            content = stock.format_candles(columns).encode('utf-8')
+            m.records = columns and len(columns[0][1]) or 0
+            m.nbytes = len(content)
+        self.pool.submit(self.output_filename(stock), content, stock.stock_symbol)
+
+    def write_chunks(self, stock, chunks, stats=None):
+        """
+        Format and compress decoded chunks of `stock` one at a time in the calling thread
+        """
+        stats = stats or RunStats()
+        path = self.output_filename(stock)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            stream = open_writer(self.pool.method, f)
+            for i, columns in enumerate(chunks):
+                with stats.measure('write', stock.stock_symbol) as m:
+                    content = stock.layout.rows(stock.stock_symbol, columns)
+                    if i == 0:
+                        content = stock.layout.header(columns) + content
+                    content = content.encode('utf-8')
+                    m.records = columns and len(columns[0][1]) or 0
+                    m.nbytes = len(content)
+                with self.pool.stats.measure('compress', stock.stock_symbol) as m:
+                    stream.write(content)
+                    m.nbytes = len(content)
+            stream.close()
+        os.replace(tmp_path, path)
+
+    def close(self):
+        pass
@@ -2,11 +2,33 @@
 Reading metastock files.
 """
 
-import re
+import mmap
+import operator
 import traceback
 import os.path
+from array import array
+from functools import lru_cache
 
-from .utils import *
+from .utils import fmsbin2ieee, float2date, date2float, int2date, float2time, date2minutes, minutes2datetime, \
+    readstr, readchar, readbyte, readshort, readint, readfloat
+from .stats import RunStats
+from .pipeline import ConversionPipeline
+from .symbols import SymbolTable
+from .catalog import print_symbols
+from .compress import SUFFIXES, CompressionPool, CompressedTextWriter
+from .layout import DEFAULT_COLUMNS, LayoutCache
+
+
+def _table_field(field):
+    """
+    Property reading and writing `field` of the SymbolTable row behind a DataFileInfo
+    """
+    def fget(self):
+        return self.table.get(field, self.index)
+
+    def fset(self, value):
+        self.table.set(field, self.index, value)
+    return property(fget, fset)
 
 
 class DataFileInfo(object):
@@ -16,8 +38,17 @@ class DataFileInfo(object):
     To read the quotes we need to read two files: a <file_num>.DAT file with the tick data and a <file_num>.DOP
     file describing what columns are in the DAT file
 
+    The master file fields live in a SymbolTable, a DataFileInfo is only a
+    view over one of its rows created when needed.
+
     Private Variables
     ----------
+    table : SymbolTable
+        Table holding the master file entries
+
+    index : int
+        Row of this symbol in the table
+
     file_num : int
         Symbol number
 
@@ -42,35 +73,71 @@ class DataFileInfo(object):
     columns : list
         List of columns names
 
+    layout : RecordLayout
+        Decoder compiled for the columns, shared by all symbols with the same DOP
+
+    max_recs : int
+        Capacity of the DAT file, set by read_candles
+
+    last_rec : int
+        Number of records + 1 in the DAT file, set by read_candles
+
+    record_range : tuple(int, int)
+        Indexes of the first and last + 1 records read by read_candles or iter_candles
+
     """
-    file_num = None
-    num_fields = None
-    stock_symbol = None
-    stock_name = None
-    time_frame = None
-    first_date = None
-    last_date = None
+    __slots__ = ('table', 'index', 'columns', 'layout', 'max_recs', 'last_rec', 'record_range')
 
-    reg = re.compile('\"(.+)\",.+', re.IGNORECASE)
-    columns = None
+    file_num = _table_field('file_num')
+    num_fields = _table_field('num_fields')
+    stock_symbol = _table_field('stock_symbol')
+    stock_name = _table_field('stock_name')
+    time_frame = _table_field('time_frame')
+    first_date = _table_field('first_date')
+    last_date = _table_field('last_date')
 
-    def _load_columns(self):
+    def __init__(self, table=None, index=None):
+        """
+        Parameters
+        ----------
+        table : SymbolTable, optional
+            Table holding the entry, a private single row table is created when omitted
+
+        index : int, optional
+            Row of the entry in `table`
+
+        """
+        if table is None:
+            table = SymbolTable()
+            index = table.append()
+        self.table = table
+        self.index = index
+        self.columns = None
+        self.layout = None
+        self.max_recs = 0
+        self.last_rec = 0
+        self.record_range = (0, 0)
+
+    def _load_columns(self, input_dir='.'):
         """
         Read columns names from the DOP file
+
+        DOP files with the same content share a single parsed RecordLayout
+
+        Parameters
+        ----------
+        input_dir : str, optional
+            Path of MetaStock directory input
+
         """
-        filename = 'F%d.DOP' % self.file_num
+        filename = os.path.join(input_dir, 'F%d.DOP' % self.file_num)
         if not os.path.isfile(filename):
-            self.columns = ['DATE', 'OPEN', 'HIGH', 'LOW', 'CLOSE', 'VOL', 'OI']
-            return
-        file_handle = open(filename, 'r')
-        lines = file_handle.read().split()
-        file_handle.close()
-        assert(len(lines) == self.num_fields)
-        self.columns = []
-        for line in lines:
-            match = self.reg.search(line)
-            colname = match.groups()[0]
-            self.columns.append(colname)
+            self.layout = self.layouts.for_names(DEFAULT_COLUMNS)
+        else:
+            with open(filename, 'r') as file_handle:
+                self.layout = self.layouts.for_dop(file_handle.read())
+            assert(self.num_fields is None or self.layout.num_fields == self.num_fields)
+        self.columns = list(self.layout.names)
 
     class Column(object):
         """
@@ -103,6 +170,25 @@ class DataFileInfo(object):
             """
             return str(value)
 
+        def decode(self, values):
+            """
+            Convert a column of floats decoded from MBF at once,
+            used by RecordLayout instead of calling read for every value
+            """
+            return values
+
+        def format_spec(self):
+            """
+            %-format of a value returned by decode, None to call format for every value
+            """
+            return None
+
+        def header(self):
+            """
+            Header field(s) of the column in text outputs
+            """
+            return '"%s"' % self.name
+
     class DateColumn(Column):
         """
         A date column
@@ -114,10 +200,21 @@ class DataFileInfo(object):
             return float2date(fmsbin2ieee(b))
 
         def format(self, value):
+            if isinstance(value, int):
+                return '%d' % value
             if value is not None:
                 return value.strftime('%Y%m%d')
             return DataFileInfo.Column.format(self, value)
 
+        def decode(self, values):
+            """
+            Convert YYYMMDD floats to YYYYMMDD integers
+            """
+            return array('i', [19000000 + int(value) for value in values])
+
+        def format_spec(self):
+            return '%d'
+
     class TimeColumn(Column):
         """
         A time column
@@ -129,10 +226,69 @@ class DataFileInfo(object):
             return float2time(fmsbin2ieee(b))
 
         def format(self, value):
+            if isinstance(value, int):
+                return '%04d' % value
             if value is not None:
-                return value.strftime('%Y%m%d')
+                return value.strftime('%H%M')
             return DataFileInfo.Column.format(self, value)
 
+        def decode(self, values):
+            """
+            Convert HHMMSS floats to HHMM integers
+            """
+            return array('i', [int(value) // 100 for value in values])
+
+        def format_spec(self):
+            return '%04d'
+
+    class TimestampColumn(Column):
+        """
+        Date and time of intraday records decoded together into minutes
+        since 1970-01-01 (the representation of numpy datetime64[m]),
+        used instead of separate DATE and TIME columns
+
+        Private Variables
+        ----------
+        style : str
+            'hhmm' writes YYYYMMDD and HHMM fields, 'iso' a single YYYY-MM-DDTHH:MM field
+
+        """
+        dataSize = 8
+        style = 'hhmm'
+
+        def decode(self, dates, times):
+            """
+            Combine YYYMMDD and HHMMSS floats into an array('q') of minutes
+
+            Every distinct date and time is converted once, the records are
+            looked up without a Python loop, like the byte-plane MBF decoding
+            of the other columns.
+            """
+            bases = dict((date, date2minutes(float2date(date))) for date in set(dates))
+            minutes = dict((time, int(time) // 10000 * 60 + int(time) // 100 % 100) for time in set(times))
+            return array('q', map(operator.add, map(bases.__getitem__, dates), map(minutes.__getitem__, times)))
+
+        def header(self):
+            if self.style == 'iso':
+                return '"%s"' % self.name
+            return '"Date","Time"'
+
+        @staticmethod
+        @lru_cache(maxsize=4096)
+        def _day(days, style):
+            """
+            Formatted date of `days` since 1970-01-01, the last few thousand are cached
+            """
+            date = minutes2datetime(days * 1440).date()
+            return style == 'iso' and date.isoformat() + 'T' or date.strftime('%Y%m%d') + ','
+
+        def format(self, value):
+            days, minutes = divmod(value, 1440)
+            day = self._day(days, self.style)
+            if self.style == 'iso':
+                return '%s%02d:%02d' % (day, minutes // 60, minutes % 60)
+            return '%s%02d%02d' % (day, minutes // 60, minutes % 60)
+
     class FloatColumn(Column):
         """
         A float column
@@ -154,6 +310,9 @@ class DataFileInfo(object):
         def format(self, value):
             return ("%0."+str(self.precision)+"f") % value
 
+        def format_spec(self):
+            return "%0."+str(self.precision)+"f"
+
     class IntColumn(Column):
         """
         An integer column
@@ -162,6 +321,12 @@ class DataFileInfo(object):
             """Convert MBF bytes to an integer"""
             return int(fmsbin2ieee(b))
 
+        def decode(self, values):
+            return array('q', map(int, values))
+
+        def format_spec(self):
+            return '%d'
+
     # we map a metastock column name to an object capable reading it
     knownMSColumns = {
         'DATE': DateColumn('Date'),
@@ -175,10 +340,361 @@ class DataFileInfo(object):
     }
     unknownColumnDataSize = 4    # assume unknown column data is 4 bytes long
 
-    max_recs = 0
-    last_rec = 0
+    # replaces DATE and TIME when a DAT file has both (intraday data)
+    timestampColumn = TimestampColumn('Timestamp')
+
+    # compiled decoders, one per distinct DOP layout
+    layouts = LayoutCache(knownMSColumns, timestampColumn)
+
+    header_size = 28    # bytes before the first record of a DAT file
+
+    def read_candles(self, input_dir, stats=None, start=None, end=None, last=None):
+        """
+        Read the raw records of the metastock DAT file
+
+        Records are sorted by date, when `start` or `end` is given the matching
+        slice is found by a binary search over the memory-mapped file, decoding
+        only the dates that are probed. `last` uses the last_rec header to seek
+        straight to the final records.
+
+        Parameters
+        ----------
+        input_dir : str
+            Path of MetaStock directory input
+
+        stats : RunStats, optional
+            Collect 'dat_read' timing
+
+        start : datetime.date, optional
+            Skip records before this date
+
+        end : datetime.date, optional
+            Skip records after this date
+
+        last : int, optional
+            Keep only the last `last` records (of the date range, if any)
+
+        Returns
+        -------
+        bytes
+            Records data without the file header, None when the file is corrupt
 
-    def load_candles(self, input_dir, output_dir):
+        """
+        stats = stats or RunStats()
+        with stats.measure('dat_read', self.stock_symbol) as m:
+            fullpath = self.dat_path(input_dir)
+            if os.path.getsize(fullpath) <= self.header_size:
+                print("Corrupt DAT suspected file no: %d" % self.file_num)
+                return None
+
+            with open(fullpath, 'rb') as file_handle, \
+                    mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                record_size = self._record_size()
+                begin, stop = self._record_range(mm, start, end, last)
+                data = mm[self.header_size + begin * record_size:self.header_size + stop * record_size]
+            m.records = stop - begin
+            m.nbytes = len(data) + self.header_size
+        return data
+
+    def iter_candles(self, input_dir, chunk_records, stats=None, start=None, end=None, last=None):
+        """
+        Read the raw records of the metastock DAT file in chunks, so that
+        large (intraday) files are converted with a bounded amount of memory
+
+        Parameters are the same as read_candles, plus:
+
+        chunk_records : int
+            Maximum number of records in a chunk
+
+        Returns
+        -------
+        generator(bytes)
+            Records data of every chunk, None when the file is corrupt
+
+        """
+        fullpath = self.dat_path(input_dir)
+        if os.path.getsize(fullpath) <= self.header_size:
+            print("Corrupt DAT suspected file no: %d" % self.file_num)
+            return None
+        return self._iter_chunks(fullpath, chunk_records, stats or RunStats(), start, end, last)
+
+    def _iter_chunks(self, fullpath, chunk_records, stats, start, end, last):
+        with open(fullpath, 'rb') as file_handle, \
+                mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            record_size = self._record_size()
+            begin, stop = self._record_range(mm, start, end, last)
+            for first in range(begin, stop, chunk_records):
+                with stats.measure('dat_read', self.stock_symbol) as m:
+                    count = min(chunk_records, stop - first)
+                    offset = self.header_size + first * record_size
+                    data = mm[offset:offset + count * record_size]
+                    m.records = count
+                    m.nbytes = len(data)
+                yield data
+
+    def dat_path(self, input_dir):
+        """
+        Path of the DAT file (MWD above file number 255)
+        """
+        ext = (self.file_num <= 255) and 'DAT' or 'MWD'
+        return os.path.join(input_dir, 'F%d.%s' % (self.file_num, ext))
+
+    def is_large(self, input_dir, chunk_records):
+        """
+        True when the DAT file holds more than `chunk_records` records and should be streamed
+        """
+        return chunk_records is not None and \
+            os.path.getsize(self.dat_path(input_dir)) - self.header_size > chunk_records * self._record_size()
+
+    def _record_range(self, mm, start=None, end=None, last=None):
+        """
+        Return the first and last + 1 indexes of the records to read, see read_candles
+
+        Parameters
+        ----------
+        mm : mmap
+            Memory-mapped DAT file
+
+        """
+        self.max_recs = readshort(mm[0:2])
+        self.last_rec = readshort(mm[2:4])
+
+        # not sure about this, but it seems to work
+        # file_handle.read((self.num_fields - 1) * 4)
+        # the header takes 28 bytes
+
+        # print "Expecting %d candles in file %s. num_fields : %d" % \
+        #    (self.last_rec - 1, filename, self.num_fields)
+        record_size = self._record_size()
+        count = max(self.last_rec - 1, 0)
+        available = (len(mm) - self.header_size) // record_size
+        if available < count:
+            print("Corrupt DAT after read skipped file no: %d" % self.file_num)
+            count = available
+
+        begin, stop = 0, count
+        if start is not None or end is not None:
+            date_offset = self._column_offset('DATE')
+            if start is not None:
+                begin = self._bisect_date(mm, record_size, date_offset, date2float(start), 0, count)
+            if end is not None:
+                stop = self._bisect_date(mm, record_size, date_offset, date2float(end) + 1, begin, count)
+        if last is not None:
+            begin = max(begin, stop - last)
+        self.record_range = (begin, stop)
+        return begin, stop
+
+    def read_records(self, input_dir, begin, stop):
+        """
+        Read the raw records [begin, stop) of the DAT file, whatever the read options
+
+        Returns
+        -------
+        bytes
+            Records data, shorter than requested when the file holds fewer records
+
+        """
+        record_size = self._record_size()
+        with open(self.dat_path(input_dir), 'rb') as file_handle:
+            file_handle.seek(self.header_size + begin * record_size)
+            return file_handle.read(max(stop - begin, 0) * record_size)
+
+    def _bisect_date(self, mm, record_size, date_offset, value, lo, hi):
+        """
+        Return the index of the first record in [lo, hi) dated on or after `value`
+
+        Parameters
+        ----------
+        mm : mmap
+            Memory-mapped DAT file
+
+        record_size : int
+            Number of bytes used by a single record
+
+        date_offset : int
+            Position of the DATE column inside a record
+
+        value : int
+            Date in Metastock YYYMMDD format
+
+        """
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.header_size + mid * record_size + date_offset
+            if int(fmsbin2ieee(mm[pos:pos + 4])) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _column_offset(self, ms_col_name):
+        """
+        Position of a column inside a record
+
+        Raises
+        ------
+        ValueError
+            When the DAT file has no such column
+
+        """
+        if ms_col_name not in self.layout.names:
+            raise ValueError('F%d has no %s column' % (self.file_num, ms_col_name))
+        return self.layout.offset(ms_col_name)
+
+    def _record_size(self):
+        """
+        Number of bytes used by a single record in the DAT file
+        """
+        return self.layout.record_size
+
+    def decode_candles(self, data, stats=None):
+        """
+        Decode raw DAT records into columns
+
+        Parameters
+        ----------
+        data : bytes
+            Records data returned by read_candles
+
+        stats : RunStats, optional
+            Collect 'decode' timing
+
+        Returns
+        -------
+        list(tuple(Column, sequence))
+            Known columns with their decoded values, unknown columns are skipped.
+            Dates are YYYYMMDD integers, prices floats and volumes integers
+            (see Column.decode)
+
+        """
+        stats = stats or RunStats()
+        with stats.measure('decode', self.stock_symbol) as m:
+            columns = self.layout.decode(data)
+            m.records = len(data) // self.layout.record_size
+            m.nbytes = m.records * self.layout.record_size
+        return columns
+
+    def output_filename(self, output_dir):
+        """
+        Path of the text file written for this symbol
+        """
+        sanitize_filename = self.stock_symbol.replace('/','_')
+        return os.path.join(output_dir, '%s.TXT' % sanitize_filename)
+
+    def format_candles(self, columns):
+        """
+        Format decoded columns as the content of <SYMBOL>.TXT
+
+        Parameters
+        ----------
+        columns : list(tuple(Column, sequence))
+            Columns returned by decode_candles
+
+        Returns
+        -------
+        str
+
+        """
+        return self.layout.format(self.stock_symbol, columns)
+
+    def write_candles(self, output_dir, columns, stats=None):
+        """
+        Format decoded columns and write them to <SYMBOL>.TXT
+
+        Parameters
+        ----------
+        output_dir : str
+            Path of CSV directory output
+
+        columns : list(tuple(Column, list))
+            Columns returned by decode_candles
+
+        stats : RunStats, optional
+            Collect 'write' timing
+
+        """
+        stats = stats or RunStats()
+        with stats.measure('write', self.stock_symbol) as m:
+            content = self.format_candles(columns)
+            with open(self.output_filename(output_dir), 'w') as outfile:
+                outfile.write(content)
+            m.records = columns and len(columns[0][1]) or 0
+            m.nbytes = len(content)
+
+    def write_candle_chunks(self, output_dir, chunks, stats=None):
+        """
+        Format decoded chunks and append them to <SYMBOL>.TXT one at a time
+
+        Parameters
+        ----------
+        output_dir : str
+            Path of CSV directory output
+
+        chunks : iterable(list(tuple(Column, sequence)))
+            Columns returned by decode_candles for every chunk, see decode_chunks
+
+        stats : RunStats, optional
+            Collect 'write' timing
+
+        """
+        stats = stats or RunStats()
+        with open(self.output_filename(output_dir), 'w') as outfile:
+            for i, columns in enumerate(chunks):
+                with stats.measure('write', self.stock_symbol) as m:
+                    content = self.layout.rows(self.stock_symbol, columns)
+                    if i == 0:
+                        content = self.layout.header(columns) + content
+                    outfile.write(content)
+                    m.records = columns and len(columns[0][1]) or 0
+                    m.nbytes = len(content)
+
+    def decode_chunks(self, chunks, stats=None):
+        """
+        Decode the chunks returned by iter_candles one at a time
+
+        Yields
+        ------
+        list(tuple(Column, sequence))
+            Columns of a chunk, at least one (empty) chunk is yielded
+
+        """
+        empty = True
+        for data in chunks:
+            empty = False
+            yield self.decode_candles(data, stats)
+        if empty:
+            yield self.decode_candles(b'', stats)
+
+    def tail(self, input_dir, count, stats=None):
+        """
+        Return the latest `count` candles without reading the rest of the DAT file
+
+        Parameters
+        ----------
+        input_dir : str
+            Path of MetaStock directory input
+
+        count : int
+            Number of candles
+
+        stats : RunStats, optional
+            Collect per-stage timing
+
+        Returns
+        -------
+        list(tuple(Column, list))
+            Decoded columns, see decode_candles. Empty when the DAT file is corrupt
+
+        """
+        if self.columns is None:
+            self._load_columns(input_dir)
+        data = self.read_candles(input_dir, stats, last=count)
+        if data is None:
+            return []
+        return self.decode_candles(data, stats)
+
+    def load_candles(self, input_dir, output_dir, stats=None, start=None, end=None, last=None, writer=None,
+                     chunk_records=None):
         """
         Load metastock DAT file and write the content
         to a text file
@@ -191,71 +707,50 @@ class DataFileInfo(object):
         output_dir : str
             Path of CSV directory output
 
-        """
-        file_handle = None
-        outfile = None
-        try:
-            ext = (self.file_num <= 255) and 'DAT' or 'MWD'
-            filename = 'F%d.%s' % (self.file_num, ext)
-            fullpath = os.path.join(input_dir, filename)
-            if os.path.getsize(fullpath) == 28:
-                print("Corrupt DAT suspected file no: %d" % self.file_num)
-                return
+        stats : RunStats, optional
+            Collect per-stage timing
 
-            file_handle = open(fullpath, 'rb')
-            self.max_recs = readshort(file_handle.read(2))
-            self.last_rec = readshort(file_handle.read(2))
-
-            # not sure about this, but it seems to work
-            # file_handle.read((self.num_fields - 1) * 4)
-            file_handle.read(24)
-
-            # print "Expecting %d candles in file %s. num_fields : %d" % \
-            #    (self.last_rec - 1, filename, self.num_fields)
-
-            sanitize_filename = self.stock_symbol.replace('/','_')
-            output_filename = os.path.join(output_dir, '%s.TXT' % sanitize_filename)
-            outfile = open(output_filename, 'w')
-            # write the header line, for example:
-            # "Name","Date","Time","Open","High","Low","Close","Volume","Oi"
-            outfile.write('"Name"')
-            columns = []
-            for ms_col_name in self.columns:
-                column = self.knownMSColumns.get(ms_col_name)
-                if column is not None:
-                    outfile.write(',"%s"' % column.name)
-                columns.append(column) # we append None if the column is unknown
-            outfile.write('\n')
-
-            # we have (self.last_rec - 1) candles to read
-            for _ in range(self.last_rec - 1):
-                outfile.write(self.stock_symbol)
-                for col in columns:
-                    if col is None: # unknown column?
-                        # ignore this column
-                        file_handle.read(self.unknownColumnDataSize)
-                    else:
-                        # read the column data
-                        b = file_handle.read(col.dataSize)
-                        # decode the data
-                        if (len(b) == 0):
-                            print("Corrupt DAT after read skipped file no: %d" % self.file_num)
-                            return
-
-                        value = col.read(b)
-                        # format it
-                        value = col.format(value)
-                        outfile.write(',%s' % value)
-
-
-                outfile.write('\n')
-        finally:
-            if outfile is not None:
-                outfile.close()
-            if file_handle is not None:
-                file_handle.close()
+        start : datetime.date, optional
+            Skip records before this date
+
+        end : datetime.date, optional
+            Skip records after this date
+
+        last : int, optional
+            Write only the last `last` records
 
-    def convert2ascii(self, input_dir, output_dir):
+        writer : MarketStoreWriter or CompressedTextWriter, optional
+            Write to a market store or a compressed file instead of <SYMBOL>.TXT
+
+        chunk_records : int, optional
+            Stream DAT files holding more records than this in chunks
+
+        Returns
+        -------
+        bool
+            False when the DAT file is corrupt and nothing was written
+
+        """
+        if self.is_large(input_dir, chunk_records):
+            chunks = self.iter_candles(input_dir, chunk_records, stats, start, end, last)
+            if chunks is None:
+                return False
+            if writer is not None:
+                writer.write_chunks(self, self.decode_chunks(chunks, stats), stats)
+            else:
+                self.write_candle_chunks(output_dir, self.decode_chunks(chunks, stats), stats)
+            return True
+        data = self.read_candles(input_dir, stats, start, end, last)
+        if data is None:
+            return False
+        columns = self.decode_candles(data, stats)
+        if writer is not None:
+            writer.write(self, columns, stats)
+        else:
+            self.write_candles(output_dir, columns, stats)
+        return True
+
+    def convert2ascii(self, input_dir, output_dir, stats=None, **read_options):
         """
         Load Metastock data file and output the data to text file.
 
@@ -267,33 +762,356 @@ class DataFileInfo(object):
         output_dir : str
             Path of CSV directory output
 
+        stats : RunStats, optional
+            Collect per-stage timing
+
+        read_options
+            Passed to load_candles (f.e. start, end, last, writer, chunk_records)
+
+        Returns
+        -------
+        bool
+            True when the output has been written
+
         """
+        stats = stats or RunStats()
         print("Processing %s (fileNo %d)" % (self.stock_symbol, self.file_num))
         try:
-            # print self.stock_symbol, self.file_num
-            self._load_columns()
-            # print self.columns
-            self.load_candles(input_dir, output_dir)
+            with stats.profile(self.stock_symbol):
+                # print self.stock_symbol, self.file_num
+                with stats.measure('dop', self.stock_symbol):
+                    self._load_columns(input_dir)
+                # print self.columns
+                return self.load_candles(input_dir, output_dir, stats, **read_options)
         except Exception:
             print("Error while converting symbol", self.stock_symbol)
             traceback.print_exc()
+            return False
+
+class MasterFile(object):
+    """
+    Behaviour shared by EMASTER and XMASTER index files
+
+    Private Variables
+    ----------
+    input_dir : str
+        Path of MetaStock directory input
+
+    options
+        Command line options
+
+    stats : RunStats
+        Collect per-stage timing
+
+    stocks : SymbolTable
+        Master file entries, iterating yields DataFileInfo views
+
+    written : list(DataFileInfo)
+        Symbols converted through a writer whose outputs are completed when it is
+        closed, recorded in options.cache once they are (None when writing directly)
+
+    """
+    input_dir = None
+    options = None
+    stats = None
+    stocks = None
+    written = None
+
+    def list_all_symbols(self):
+        """
+        Lists all the symbols from metastock index file and writes it to the output
+        """
+        print_symbols((stock.stock_symbol, stock.stock_name, stock.file_num) for stock in self.stocks)
+
+    def read_options(self):
+        """
+        Keyword arguments given to DataFileInfo.read_candles
+        """
+        return {
+            'start': getattr(self.options, 'date_from', None),
+            'end': getattr(self.options, 'date_to', None),
+            'last': getattr(self.options, 'last', None),
+        }
+
+    def latest(self, count):
+        """
+        Yield the latest `count` candles of every symbol,
+        the cost is proportional to `count` times the number of symbols
+
+        Parameters
+        ----------
+        count : int
+            Number of candles per symbol
+
+        Returns
+        -------
+        generator(tuple(DataFileInfo, list(tuple(Column, list))))
+
+        """
+        for stock in self.stocks:
+            try:
+                yield stock, stock.tail(self.input_dir, count, self.stats)
+            except Exception:
+                print("Error while reading symbol", stock.stock_symbol)
+                traceback.print_exc()
+
+    def conversion_settings(self):
+        """
+        Options that change the content of the outputs, used by the conversion cache
+        """
+        settings = {'precision': DataFileInfo.FloatColumn.precision,
+                    'format': getattr(self.options, 'format', None) or 'txt',
+                    'compress': getattr(self.options, 'compress', None)}
+        if getattr(self.options, 'resample', None):
+            settings['resample'] = ','.join(self.options.resample)
+        if getattr(self.options, 'indicators', None):
+            from .indicators import spec
+            settings['indicators'] = spec(self.options.indicators)
+        if DataFileInfo.TimestampColumn.style != 'hhmm':
+            settings['time_format'] = DataFileInfo.TimestampColumn.style
+        for name, value in self.read_options().items():
+            if value is not None:
+                settings[name] = str(value)
+        return settings
+
+    def store_path(self, output_dir=None):
+        """
+        Market store written with options.format == 'store', named after the input directory
+        """
+        market = os.path.basename(os.path.normpath(self.input_dir))
+        return os.path.join(output_dir or self.options.output_dir, '%s.MSS' % market)
+
+    def output_path(self, stock):
+        """
+        File the output of `stock` is written to
+        """
+        if getattr(self.options, 'format', None) == 'store':
+            return self.store_path()
+        suffix = getattr(self.options, 'compress', None) and SUFFIXES[self.options.compress] or ''
+        return stock.output_filename(self.options.output_dir) + suffix
+
+    def _writer(self):
+        """
+        Return the writer for options.format, options.compress, options.indicators
+        and options.resample, None for plain <SYMBOL>.TXT files
+        """
+        pool = None
+        if getattr(self.options, 'compress', None):
+            pool = CompressionPool(self.options.compress, getattr(self.options, 'compress_workers', None),
+                                   self.stats)
+        writer = self._output_writer(self.options.output_dir, pool)
+        indicators = getattr(self.options, 'indicators', None)
+        if indicators:
+            # resampled bars are aggregated from the decoded columns, without the indicators
+            from .indicators import IndicatorWriter
+            writer = IndicatorWriter(self.input_dir, self.options.output_dir, writer, indicators,
+                                     getattr(self.options, 'indicator_state', None), self.stats)
+        periods = getattr(self.options, 'resample', None)
+        if periods:
+            from .resample import TimeframeWriter, period_dir
+            writers = {}
+            for period in periods:
+                output_dir = period_dir(self.options.output_dir, period)
+                writers[period] = (output_dir, self._output_writer(output_dir, pool))
+            writer = TimeframeWriter(self.options.output_dir, writer, writers, self.stats)
+        return writer, pool
+
+    def _output_writer(self, output_dir, pool):
+        """
+        Writer of the outputs stored in `output_dir`, None for plain <SYMBOL>.TXT files
+        """
+        if getattr(self.options, 'format', None) == 'store':
+            from .store import MarketStoreWriter
+            return MarketStoreWriter(self.store_path(output_dir), pool=pool)
+        if pool is not None:
+            return CompressedTextWriter(output_dir, pool)
+        return None
+
+    def market(self):
+        """
+        Path of the directory relative to options.input_dir, the market of the shard units
+        """
+        return os.path.relpath(self.input_dir, self.options.input_dir)
+
+    def _completed(self, stock):
+        """
+        Record `stock` as done in options.shard
+        """
+        shard = getattr(self.options, 'shard', None)
+        if shard is not None:
+            shard.complete(self.market(), stock.stock_symbol)
+
+    def _converted(self, stock):
+        """
+        Called after the output of `stock` has been written
+        """
+        self.stats.count('converted')
+        self._completed(stock)
+        cache = getattr(self.options, 'cache', None)
+        if cache is None:
+            return
+        if self.written is not None:
+            self.written.append(stock)
+        else:
+            cache.update(self.input_dir, stock, self.conversion_settings(), self.output_path(stock))
+
+    def _close_writer(self, writer, pool):
+        """
+        Close `writer` and `pool`, then record in options.cache the symbols whose outputs were written
+        """
+        written, self.written = self.written or [], None
+        closed = False
+        try:
+            if writer is not None:
+                writer.close()
+            closed = True
+        finally:
+            try:
+                if pool is not None:
+                    pool.close()
+            finally:
+                cache = getattr(self.options, 'cache', None)
+                failed = pool is not None and pool.failed or set()
+                for stock in closed and written or []:
+                    output = self.output_path(stock)
+                    if output not in failed:
+                        cache.update(self.input_dir, stock, self.conversion_settings(), output)
+
+    def _selected(self, all_symbols, symbols):
+        """
+        Yield the requested symbols, only the changed ones when options.changes is set
+        and only the ones of this shard when options.shard is set
+        """
+        changes = getattr(self.options, 'changes', None)
+        shard = getattr(self.options, 'shard', None)
+        file_nums = None
+        if changes is not None:
+            file_nums = changes.affected(self.input_dir)
+        for stock in self.stocks:
+            if not (all_symbols or (stock.stock_symbol in symbols)):
+                continue
+            if file_nums is not None and stock.file_num not in file_nums:
+                continue
+            if shard is not None and not shard.owns(self.market(), stock.stock_symbol):
+                continue
+            yield stock
+
+    def verify(self, all_symbols, symbols):
+        """
+        Verify all or specified symbols with options.scanner without converting them
+        """
+        for stock in self._selected(all_symbols, symbols):
+            self.options.scanner.check(self.input_dir, stock)
+            self._completed(stock)
+
+    def output_ascii(self, all_symbols, symbols):
+        """
+        Read all or specified symbols and write them to text
+        files (each symbol in separate file)
+
+        Symbols whose inputs and settings did not change since the previous
+        run are skipped when options.cache is set
+
+        Parameters
+        ----------
+        all_symbols : bool
+            When True, all symbols are processed
+
+        symbols : list(str)
+            List of symbols to process
+
+        options.pipeline : bool, optional
+            Overlap reading, decoding and writing of different symbols
+
+        options.cache : ConversionCache, optional
+            Skip unchanged symbols
+
+        options.changes : ChangeSet, optional
+            Process only the symbols whose files are listed as changed
+
+        options.date_from, options.date_to : datetime.date, optional
+            Write only the records in this date range
+
+        options.last : int, optional
+            Write only the latest `last` records of each symbol
+
+        options.format : str, optional
+            'txt' (default) or 'store' to pack the whole market in <market>.MSS
 
-class MSEMasterFile(object):
+        options.compress : str, optional
+            'gzip' or 'zstd', compress the outputs in background threads
+
+        options.chunk_records : int, optional
+            Stream DAT files holding more records than this in chunks of this size
+
+        options.resample : list(str), optional
+            Also write weekly/monthly/quarterly bars ('W', 'M', 'Q') to sub directories
+
+        options.indicators : list(Indicator), optional
+            Append indicator columns to the outputs
+
+        options.indicator_state : IndicatorState, optional
+            Kernel states of the previous outputs, extended instead of reading the records before --from/--last
+
+        options.scanner : IntegrityScanner, optional
+            Verify the symbols first and skip the ones that get quarantined
+
+        options.shard : Shard, optional
+            Process only the symbols of this shard and record the ones done
+
+        """
+        cache = getattr(self.options, 'cache', None)
+        scanner = getattr(self.options, 'scanner', None)
+        settings = self.conversion_settings()
+        selected = []
+        for stock in self._selected(all_symbols, symbols):
+            if cache is not None and cache.is_fresh(self.input_dir, stock, settings, self.output_path(stock)):
+                self.stats.count('skipped')
+                self._completed(stock)
+                continue
+            if scanner is not None and not scanner.check(self.input_dir, stock):
+                self.stats.count('quarantined')
+                self._completed(stock)
+                continue
+            selected.append(stock)
+
+        if not selected:
+            return
+        chunk_records = getattr(self.options, 'chunk_records', None)
+        writer, pool = self._writer()
+        # outputs written through a writer are only complete once it is closed
+        self.written = [] if writer is not None else None
+        try:
+            if getattr(self.options, 'pipeline', False):
+                pipeline = ConversionPipeline(self.input_dir, self.options.output_dir, self.stats,
+                                              getattr(self.options, 'queue_depth', None) or 4,
+                                              self._converted, self.read_options(), writer, chunk_records)
+                pipeline.run(selected)
+                return
+            for stock in selected:
+                if stock.convert2ascii(self.input_dir, self.options.output_dir, self.stats, writer=writer,
+                                       chunk_records=chunk_records, **self.read_options()):
+                    self._converted(stock)
+        finally:
+            self._close_writer(writer, pool)
+
+
+class MSEMasterFile(MasterFile):
     """
     Metastock extended index file
     Control file number 1-255
 
     Private Variables
     ----------
-    stocks : list(DataFileInfo)
-        List of DataFileInfo objects
+    stocks : SymbolTable
+        Master file entries, iterating yields DataFileInfo views
 
     """
     stocks = None
 
     def _read_file_info(self, file_handle):
         """
-        read the entry for a single symbol and return a DataFileInfo
+        read the entry for a single symbol into a new row of self.stocks
 
         Parameters
         ----------
@@ -303,9 +1121,10 @@ class MSEMasterFile(object):
         Returns
         -------
         DataFileInfo
+            View over the new row
 
         """
-        dfi = DataFileInfo()
+        dfi = DataFileInfo(self.stocks, self.stocks.append())
         file_handle.read(2)
         dfi.file_num = readbyte(file_handle.read(1))
         file_handle.read(3)
@@ -335,6 +1154,12 @@ class MSEMasterFile(object):
         options.precision : int
             round floats to n digits after the decimal point
 
+        options.time_format : str, optional
+            'hhmm' or 'iso', how intraday timestamps are written
+
+        options.stats : RunStats, optional
+            Collect per-stage timing
+
         """
         self.input_dir = subdir is not None and \
                         os.path.join(options.input_dir, subdir) or \
@@ -342,62 +1167,41 @@ class MSEMasterFile(object):
         precision = not (options.precision) and None or options.precision
         if precision is not None:
             DataFileInfo.FloatColumn.precision = precision
-        file_handle = open(os.path.join(self.input_dir, 'EMASTER'), 'rb')
-        files_no = readshort(file_handle.read(2))
-        last_file = readshort(file_handle.read(2))
-        file_handle.read(188)
-        self.stocks = []
-        self.options = options
-        # print files_no, last_file
-        while files_no > 0:
-            self.stocks.append(self._read_file_info(file_handle))
-            files_no -= 1
-        file_handle.close()
-
-    def list_all_symbols(self):
-        """
-        Lists all the symbols from metastock index file and writes it to the output
-        """
-        print("List of available symbols:")
-        for stock in self.stocks:
-            print("symbol: %s, name: %s, file number: %s" %
-                   (stock.stock_symbol, stock.stock_name, stock.file_num))
-
-    def output_ascii(self, all_symbols, symbols):
-        """
-        Read all or specified symbols and write them to text
-        files (each symbol in separate file)
-
-        Parameters
-        ----------
-        all_symbols : bool
-            When True, all symbols are processed
-
-        symbols : list(str)
-            List of symbols to process
-
-        """
-        for stock in self.stocks:
-            if all_symbols or (stock.stock_symbol in symbols):
-                stock.convert2ascii(self.input_dir, self.options.output_dir)
-
-
-class MSXMasterFile(object):
+        if getattr(options, 'time_format', None):
+            DataFileInfo.TimestampColumn.style = options.time_format
+        self.stats = getattr(options, 'stats', None) or RunStats()
+        with self.stats.measure('master') as m:
+            file_handle = open(os.path.join(self.input_dir, 'EMASTER'), 'rb')
+            files_no = readshort(file_handle.read(2))
+            last_file = readshort(file_handle.read(2))
+            file_handle.read(188)
+            self.stocks = SymbolTable()
+            self.options = options
+            # print files_no, last_file
+            while files_no > 0:
+                self._read_file_info(file_handle)
+                files_no -= 1
+            m.records = len(self.stocks)
+            m.nbytes = file_handle.tell()
+            file_handle.close()
+
+
+class MSXMasterFile(MasterFile):
     """
     Metastock XMASTER index file
     Control file number 255+
 
     Private Variables
     ----------
-    stocks : list(DataFileInfo)
-        List of DataFileInfo objects
+    stocks : SymbolTable
+        Master file entries, iterating yields DataFileInfo views
 
     """
     stocks = None
 
     def _read_file_info(self, file_handle):
         """
-        read the entry for a single symbol and return a DataFileInfo
+        read the entry for a single symbol into a new row of self.stocks
 
         Parameters
         ----------
@@ -407,9 +1211,10 @@ class MSXMasterFile(object):
         Returns
         -------
         DataFileInfo
+            View over the new row
 
         """
-        dfi = DataFileInfo()
+        dfi = DataFileInfo(self.stocks, self.stocks.append())
         file_handle.read(1)
         dfi.stock_symbol = readstr(file_handle.read(15))
         dfi.stock_name = readstr(file_handle.read(46))
@@ -435,6 +1240,12 @@ class MSXMasterFile(object):
         options.precision : int
             round floats to n digits after the decimal point
 
+        options.time_format : str, optional
+            'hhmm' or 'iso', how intraday timestamps are written
+
+        options.stats : RunStats, optional
+            Collect per-stage timing
+
         """
         self.input_dir = subdir is not None and \
                         os.path.join(options.input_dir, subdir) or \
@@ -442,45 +1253,24 @@ class MSXMasterFile(object):
         precision = not (options.precision) and options.precision or None
         if precision is not None:
             DataFileInfo.FloatColumn.precision = precision
-        file_handle = open(os.path.join(self.input_dir, 'XMASTER'), 'rb')
-        file_handle.read(10)
-        files_no = readshort(file_handle.read(2))
-        file_handle.read(2)
-        last_file = readshort(file_handle.read(2))
-        file_handle.read(2)
-        next = readshort(file_handle.read(2))
-        file_handle.read(130)
-        self.stocks = []
-        self.options = options
-        # print files_no, last_file
-        while files_no > 0:
-            self.stocks.append(self._read_file_info(file_handle))
-            files_no -= 1
-        file_handle.close()
-
-    def list_all_symbols(self):
-        """
-        Lists all the symbols from metastock index file and writes it to the output
-        """
-        print("List of available symbols:")
-        for stock in self.stocks:
-            print("symbol: %s, name: %s, file number: %s" %
-                   (stock.stock_symbol, stock.stock_name, stock.file_num))
-
-    def output_ascii(self, all_symbols, symbols):
-        """
-        Read all or specified symbols and write them to text
-        files (each symbol in separate file)
-
-        Parameters
-        ----------
-        all_symbols : bool
-            When True, all symbols are processed
-
-        symbols : list(str)
-            List of symbols to process
-
-        """
-        for stock in self.stocks:
-            if all_symbols or (stock.stock_symbol in symbols):
-                stock.convert2ascii(self.input_dir, self.options.output_dir)
+        if getattr(options, 'time_format', None):
+            DataFileInfo.TimestampColumn.style = options.time_format
+        self.stats = getattr(options, 'stats', None) or RunStats()
+        with self.stats.measure('master') as m:
+            file_handle = open(os.path.join(self.input_dir, 'XMASTER'), 'rb')
+            file_handle.read(10)
+            files_no = readshort(file_handle.read(2))
+            file_handle.read(2)
+            last_file = readshort(file_handle.read(2))
+            file_handle.read(2)
+            next = readshort(file_handle.read(2))
+            file_handle.read(130)
+            self.stocks = SymbolTable()
+            self.options = options
+            # print files_no, last_file
+            while files_no > 0:
+                self._read_file_info(file_handle)
+                files_no -= 1
+            m.records = len(self.stocks)
+            m.nbytes = file_handle.tell()
+            file_handle.close()
@@ -0,0 +1,505 @@
+"""
+Indicator columns (moving averages, returns, ATR) computed from decoded
+columns and written next to them.
+
+Every indicator is a kernel over whole columns: it takes the values of a
+batch of records and the state left by the previous batch, and returns one
+value per record and the new state. A symbol gives the same values whether it
+is converted at once, in chunks, or from a state saved by a previous run.
+"""
+
+import json
+import operator
+import os.path
+from array import array
+from itertools import accumulate, islice
+
+from .files import DataFileInfo
+from .stats import RunStats
+
+NAN = float('nan')
+
+# records kept between the end of the output and the second saved state, so that
+# a run writing only the latest records (--last) extends a recent state
+TAIL_RECORDS = 250
+
+
+def _rolling_sums(values, period):
+    """
+    Sum of every window of `period` consecutive values, from differences of a running sum
+    """
+    sums = [0.0]
+    sums.extend(accumulate(values))
+    return list(map(operator.sub, sums[period:], sums[:-period]))
+
+
+def _smoothed(values, state, period, alpha):
+    """
+    Exponential smoothing seeded with the mean of the first `period` values,
+    NaN before the seed
+
+    Parameters
+    ----------
+    values : list(float)
+
+    state : dict
+        'count' values seen so far, their 'sum' until the seed, then the last 'value'
+
+    period : int
+
+    alpha : float
+        Weight of a new value
+
+    Returns
+    -------
+    tuple(list(float), dict)
+
+    """
+    count, total, value = state.get('count', 0), state.get('sum', 0.0), state.get('value')
+    output = []
+    i = 0
+    while value is None and i < len(values):
+        total += values[i]
+        count += 1
+        i += 1
+        if count == period:
+            value = total / period
+            output.append(value)
+        else:
+            output.append(NAN)
+    if value is not None and i < len(values):
+        smoothed = list(accumulate(values[i:], lambda previous, x: previous + alpha * (x - previous),
+                                   initial=value))[1:]
+        output.extend(smoothed)
+        value = smoothed[-1]
+        count += len(smoothed)
+    return output, {'count': count, 'sum': total, 'value': value}
+
+
+class Indicator(object):
+    """
+    Base class of the indicator kernels
+
+    Private Variables
+    ----------
+    period : int
+        Number of records of the window
+
+    inputs : tuple(str)
+        Metastock columns the indicator is computed from
+
+    precision : int, optional
+        Digits after the decimal point, the price precision when None
+
+    """
+    kind = None
+    inputs = ('CLOSE',)
+    precision = None
+
+    def __init__(self, period):
+        self.period = period
+
+    @property
+    def name(self):
+        return '%s%d' % (self.kind.upper(), self.period)
+
+    @property
+    def spec(self):
+        return '%s:%d' % (self.kind, self.period)
+
+    def compute(self, fields, state):
+        """
+        Compute the values of a batch of records
+
+        Parameters
+        ----------
+        fields : dict
+            Mapping input column -> list of float values of the batch
+
+        state : dict
+            State returned for the previous batch, empty for the first record of the file
+
+        Returns
+        -------
+        tuple(list(float), dict)
+            Value of every record (NaN while the window is not full) and the new state
+
+        """
+        raise NotImplementedError
+
+
+class SimpleMovingAverage(Indicator):
+    """
+    Mean of the last `period` closes
+    """
+    kind = 'sma'
+
+    def compute(self, fields, state):
+        window = state.get('window', [])
+        values = window + fields['CLOSE']
+        averages = [NAN] * (self.period - 1) + [total / self.period for total in _rolling_sums(values, self.period)]
+        return averages[len(window):len(values)], {'window': values[max(len(values) - self.period + 1, 0):]}
+
+
+class ExponentialMovingAverage(Indicator):
+    """
+    Exponential moving average of the closes, seeded with the simple average of the first `period`
+    """
+    kind = 'ema'
+
+    def compute(self, fields, state):
+        return _smoothed(fields['CLOSE'], state, self.period, 2.0 / (self.period + 1))
+
+
+class Return(Indicator):
+    """
+    Relative change of the close over `period` records
+    """
+    kind = 'ret'
+    precision = 6
+
+    def compute(self, fields, state):
+        window = state.get('window', [])
+        values = window + fields['CLOSE']
+        returns = [NAN] * self.period + [current / previous - 1.0 if previous else NAN
+                                         for previous, current in zip(values, values[self.period:])]
+        return returns[len(window):len(values)], {'window': values[-self.period:]}
+
+
+class AverageTrueRange(Indicator):
+    """
+    Wilder's average true range, the true range of the first record of the file is high - low
+    """
+    kind = 'atr'
+    inputs = ('HIGH', 'LOW', 'CLOSE')
+
+    def compute(self, fields, state):
+        highs, lows, closes = fields['HIGH'], fields['LOW'], fields['CLOSE']
+        if not closes:
+            return [], state
+        previous = [state.get('close', closes[0])] + closes[:-1]
+        ranges = list(map(max, map(operator.sub, highs, lows),
+                          map(abs, map(operator.sub, highs, previous)),
+                          map(abs, map(operator.sub, lows, previous))))
+        if 'close' not in state:
+            ranges[0] = highs[0] - lows[0]
+        values, state = _smoothed(ranges, state, self.period, 1.0 / self.period)
+        state['close'] = closes[-1]
+        return values, state
+
+
+KINDS = dict((cls.kind, cls) for cls in (SimpleMovingAverage, ExponentialMovingAverage, Return, AverageTrueRange))
+
+
+def parse_indicators(value):
+    """
+    Parse a comma separated list of kind:period (f.e. 'sma:20,atr:14'), raise ValueError when one is invalid
+    """
+    indicators = []
+    for item in value.split(','):
+        item = item.strip().lower()
+        if not item:
+            continue
+        kind, _, period = item.partition(':')
+        if kind not in KINDS:
+            raise ValueError('unknown indicator %r, expected one of %s' % (kind, ', '.join(sorted(KINDS))))
+        try:
+            period = int(period)
+        except ValueError:
+            raise ValueError('%r: the period must be an integer' % item)
+        if period < 1:
+            raise ValueError('%r: the period must be positive' % item)
+        indicators.append(KINDS[kind](period))
+    return indicators
+
+
+def spec(indicators):
+    """
+    Canonical string of a list of indicators, stored with their states
+    """
+    return ','.join(indicator.spec for indicator in indicators)
+
+
+class IndicatorColumn(DataFileInfo.FloatColumn):
+    """
+    A computed float column, written with its own precision when it has one
+    """
+    def __init__(self, name, precision=None):
+        DataFileInfo.FloatColumn.__init__(self, name)
+        if precision is not None:
+            self.precision = precision
+
+
+class IndicatorState(object):
+    """
+    Kernel states saved at the end of the previous outputs, so that the next
+    run computes only the records it writes
+
+    Private Variables
+    ----------
+    path : str
+        JSON file where the states are stored
+
+    entries : dict
+        Mapping '<input_dir>:<file_num>' -> indicators spec and saved states
+
+    """
+    FILENAME = '.ms2csv-indicators.json'
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                print('Ignoring unreadable indicator state %s' % path)
+
+    @staticmethod
+    def key(input_dir, stock):
+        return '%s:%d' % (input_dir, stock.file_num)
+
+    def get(self, input_dir, stock, indicators):
+        """
+        Saved states of `stock` for these indicators, latest record first
+        """
+        entry = self.entries.get(self.key(input_dir, stock))
+        if entry is None or entry.get('spec') != spec(indicators):
+            return []
+        return sorted(entry['states'], key=lambda state: state['index'], reverse=True)
+
+    def set(self, input_dir, stock, indicators, states):
+        self.entries[self.key(input_dir, stock)] = {'spec': spec(indicators), 'states': states}
+
+    def save(self):
+        """
+        Write the state file, replacing the previous one atomically
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def _record_key(layout, data):
+    """
+    DATE (and TIME) of the first record of `data`, identifies a saved state
+    """
+    return [layout.field(data[:layout.record_size], name)[0] for name in ('DATE', 'TIME') if name in layout.names]
+
+
+class IndicatorWriter(object):
+    """
+    Append indicator columns to the decoded columns of every symbol before
+    they are written
+
+    The records before the output (with --from or --last) are only needed to
+    fill the windows: they are read from the end of the most recent saved
+    state that precedes the output, from the start of the file otherwise.
+    A full <SYMBOL>.TXT output is extended from the latest saved state when
+    the DAT file and the previous output still hold the records up to it:
+    their lines are kept and only the records after it are computed.
+
+    Private Variables
+    ----------
+    input_dir : str
+        Path of MetaStock directory input
+
+    output_dir : str
+        Path of CSV directory output
+
+    writer : MarketStoreWriter or CompressedTextWriter, optional
+        Writer of the extended columns, None for <SYMBOL>.TXT files
+
+    indicators : list(Indicator)
+
+    state : IndicatorState, optional
+        Saved kernel states, updated with the states at the end of every output
+
+    stats : RunStats
+        Collect 'indicators' timing
+
+    """
+    def __init__(self, input_dir, output_dir, writer, indicators, state=None, stats=None):
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.writer = writer
+        self.indicators = indicators
+        self.state = state
+        self.stats = stats or RunStats()
+        self.columns = [IndicatorColumn(indicator.name, indicator.precision) for indicator in indicators]
+
+    def _inputs(self, stock):
+        """
+        Indicators whose inputs are in the DAT file of `stock`, the others are left empty
+        """
+        return [indicator if all(name in stock.layout.names for name in indicator.inputs) else None
+                for indicator in self.indicators]
+
+    def _history(self, stock, begin, snapshots):
+        """
+        Kernel states at record `begin`, from a saved state or from the start of the file
+        """
+        fresh = [{} for _ in self.indicators]
+        if not begin:
+            return fresh
+        layout = stock.layout
+        data = None
+        states = fresh
+        for saved in self.state is not None and self.state.get(self.input_dir, stock, self.indicators) or []:
+            if saved['index'] >= begin:
+                continue
+            records = stock.read_records(self.input_dir, saved['index'], begin)
+            if records and _record_key(layout, records) == saved['key']:
+                data, states = records[layout.record_size:], [dict(state) for state in saved['kernels']]
+                break
+        if data is None:
+            data = stock.read_records(self.input_dir, 0, begin)
+        fields = dict((name, list(layout.field(data, name))) for name in ('HIGH', 'LOW', 'CLOSE')
+                      if name in layout.names)
+        states = self._advance(stock, fields, states)[1]
+        snapshots.append(self._snapshot(stock, begin - 1, states))
+        return states
+
+    def _advance(self, stock, fields, states):
+        values = []
+        new_states = []
+        for indicator, state in zip(self._inputs(stock), states):
+            if indicator is None:
+                values.append(None)
+                new_states.append(state)
+                continue
+            indicator_values, state = indicator.compute(fields, state)
+            values.append(indicator_values)
+            new_states.append(state)
+        return values, new_states
+
+    def _snapshot(self, stock, index, states):
+        data = stock.read_records(self.input_dir, index, index + 1)
+        return {'index': index, 'key': _record_key(stock.layout, data), 'kernels': states}
+
+    def _extend(self, stock, columns, states, first, snapshots):
+        """
+        Append the indicator columns to the decoded columns of records [first, first + len)
+
+        A snapshot of the kernel states is saved at the end of the records and at
+        TAIL_RECORDS before the end of the output
+        """
+        with self.stats.measure('indicators', stock.stock_symbol) as m:
+            decoded = dict((column.name, column_values) for column, column_values in columns)
+            count = columns and len(columns[0][1]) or 0
+            fields = {}
+            for name in ('HIGH', 'LOW', 'CLOSE'):
+                values = decoded.get(DataFileInfo.knownMSColumns[name].name)
+                if values is not None:
+                    fields[name] = list(values)
+            tail = stock.record_range[1] - 1 - TAIL_RECORDS - first
+            parts = 0 <= tail < count - 1 and [(0, tail + 1), (tail + 1, count)] or [(0, count)]
+            values = [[] for _ in self.indicators]
+            for start, end in parts:
+                part_values, states = self._advance(stock, dict((name, field[start:end])
+                                                                for name, field in fields.items()), states)
+                for output, part in zip(values, part_values):
+                    output.extend(part is None and [NAN] * (end - start) or part)
+                if end > start:
+                    snapshots.append(self._snapshot(stock, first + end - 1, states))
+            m.records = count
+        return columns + [(column, array('d', column_values)) for column, column_values in zip(self.columns, values)], \
+            states
+
+    def _save(self, stock, snapshots):
+        """
+        Keep the states at the end of the output and at TAIL_RECORDS before it,
+        or before the output when it is shorter
+        """
+        if self.state is None or not snapshots:
+            return
+        last = snapshots[-1]
+        tail = [snapshot for snapshot in snapshots[:-1] if snapshot['index'] <= last['index'] - TAIL_RECORDS]
+        self.state.set(self.input_dir, stock, self.indicators, (tail[-1:] or snapshots[:-1][:1]) + [last])
+
+    def _resume(self, stock, columns):
+        """
+        Lines of the previous <SYMBOL>.TXT up to the latest saved state matching the DAT file
+        and that state, (None, None) when the output has to be computed from the start
+        """
+        path = stock.output_filename(self.output_dir)
+        if self.state is None or self.writer is not None or stock.record_range[0] or not os.path.isfile(path):
+            return None, None
+        layout = stock.layout
+        count = columns and len(columns[0][1]) or 0
+        header = layout.header(columns + [(column, None) for column in self.columns])
+        for saved in self.state.get(self.input_dir, stock, self.indicators):
+            index = saved['index']
+            if index >= count:
+                continue
+            records = stock.read_records(self.input_dir, index, index + 1)
+            if not records or _record_key(layout, records) != saved['key']:
+                continue
+            with open(path, 'r') as f:
+                lines = list(islice(f, index + 2))
+            # the previous output holds the same record at the same line (no --last, same precision)
+            row = layout.rows(stock.stock_symbol, [(column, values[index:index + 1]) for column, values in columns])
+            if len(lines) == index + 2 and lines[0] == header and lines[-1].startswith(row.rstrip('\n') + ','):
+                return lines, saved
+        return None, None
+
+    def _write_resumed(self, stock, columns, stats, lines, saved):
+        """
+        Write the kept `lines` and the records after the `saved` state to <SYMBOL>.TXT
+        """
+        first = saved['index'] + 1
+        snapshots = [snapshot for snapshot in reversed(self.state.get(self.input_dir, stock, self.indicators))
+                     if snapshot['index'] <= saved['index']]
+        tail, _ = self._extend(stock, [(column, values[first:]) for column, values in columns],
+                               [dict(state) for state in saved['kernels']], first, snapshots)
+        with stats.measure('write', stock.stock_symbol) as m:
+            content = ''.join(lines) + stock.layout.rows(stock.stock_symbol, tail)
+            with open(stock.output_filename(self.output_dir), 'w') as outfile:
+                outfile.write(content)
+            m.records = len(tail[0][1]) if tail else 0
+            m.nbytes = len(content)
+        self._save(stock, snapshots)
+
+    def write(self, stock, columns, stats=None):
+        stats = stats or self.stats
+        lines, saved = self._resume(stock, columns)
+        if saved is not None:
+            self.stats.count('indicators_resumed')
+            self._write_resumed(stock, columns, stats, lines, saved)
+            return
+        begin = stock.record_range[0]
+        snapshots = []
+        columns, _ = self._extend(stock, columns, self._history(stock, begin, snapshots), begin, snapshots)
+        if self.writer is not None:
+            self.writer.write(stock, columns, stats)
+        else:
+            stock.write_candles(self.output_dir, columns, stats)
+        self._save(stock, snapshots)
+
+    def write_chunks(self, stock, chunks, stats=None):
+        stats = stats or self.stats
+        snapshots = []
+
+        def extended():
+            states = None
+            first = 0
+            for columns in chunks:
+                if states is None:
+                    # the record range is known once the first chunk has been read
+                    first = stock.record_range[0]
+                    states = self._history(stock, first, snapshots)
+                columns, states = self._extend(stock, columns, states, first, snapshots)
+                first += columns and len(columns[0][1]) or 0
+                yield columns
+
+        if self.writer is not None:
+            self.writer.write_chunks(stock, extended(), stats)
+        else:
+            stock.write_candle_chunks(self.output_dir, extended(), stats)
+        self._save(stock, snapshots)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
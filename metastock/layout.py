@@ -0,0 +1,193 @@
+"""
+DAT record layouts described by DOP files, compiled once per distinct column list.
+"""
+
+import re
+import threading
+from itertools import repeat
+
+from .utils import fmsbin2ieee_array
+
+DEFAULT_COLUMNS = ('DATE', 'OPEN', 'HIGH', 'LOW', 'CLOSE', 'VOL', 'OI')
+
+
+class RecordLayout(object):
+    """
+    Decoder and formatter specialized for one list of DAT columns.
+
+    Every field of a DAT record is a 4-byte MBF number, so a whole buffer of
+    records is converted at once and each known column is a strided slice of
+    the result. Rows are formatted with a single format string built for the
+    layout instead of a call per field.
+
+    Intraday layouts (with both DATE and TIME) decode the two fields into a
+    single timestamp column.
+
+    Private Variables
+    ----------
+    names : tuple(str)
+        Metastock column names, in record order
+
+    known : list(tuple(Column, tuple(int)))
+        Columns that are decoded, with the position in the record of the fields they are decoded from
+
+    intraday : bool
+        True when DATE and TIME are decoded as a timestamp column
+
+    num_fields : int
+        Number of fields in a record
+
+    record_size : int
+        Number of bytes used by a single record
+
+    """
+    def __init__(self, names, known_columns, timestamp_column=None, field_size=4):
+        self.names = tuple(names)
+        self.num_fields = len(self.names)
+        self.record_size = self.num_fields * field_size
+        self.field_size = field_size
+        self.intraday = timestamp_column is not None and 'DATE' in self.names and 'TIME' in self.names
+        self.known = []
+        for i, name in enumerate(self.names):
+            if self.intraday and name == 'DATE':
+                self.known.append((timestamp_column, (i, self.names.index('TIME'))))
+            elif known_columns.get(name) is not None and not (self.intraday and name == 'TIME'):
+                self.known.append((known_columns[name], (i,)))
+        self._formats = {}
+
+    def offset(self, name):
+        """
+        Position of a column inside a record
+
+        Raises
+        ------
+        ValueError
+            When the layout has no such column
+
+        """
+        return self.names.index(name) * self.field_size
+
+    def field(self, data, name):
+        """
+        Decode a single field of every record, without converting the other fields
+
+        Parameters
+        ----------
+        data : bytes
+            Records data
+
+        name : str
+            Metastock column name (f.e. 'DATE')
+
+        Returns
+        -------
+        array('f')
+
+        """
+        offset = self.offset(name)
+        end = len(data) // self.record_size * self.record_size
+        plane = bytearray(end // self.record_size * self.field_size)
+        for i in range(self.field_size):
+            plane[i::self.field_size] = data[offset + i:end:self.record_size]
+        return fmsbin2ieee_array(plane)
+
+    def decode(self, data):
+        """
+        Decode whole records
+
+        Parameters
+        ----------
+        data : bytes
+            Records data, a trailing partial record is ignored
+
+        Returns
+        -------
+        list(tuple(Column, sequence))
+            Known columns and their values, see Column.decode
+
+        """
+        count = len(data) // self.record_size
+        words = fmsbin2ieee_array(data[:count * self.record_size])
+        return [(column, column.decode(*[words[i::self.num_fields] for i in fields]))
+                for column, fields in self.known]
+
+    def _row_format(self, specs):
+        """
+        Format string of a whole row, columns without a format spec are preformatted strings
+        """
+        fmt = self._formats.get(specs)
+        if fmt is None:
+            fmt = self._formats[specs] = '%s' + ''.join(',' + (spec or '%s') for spec in specs) + '\n'
+        return fmt
+
+    def header(self, columns):
+        """
+        Header line of the text output of decoded columns
+        """
+        # for example:
+        # "Name","Date","Time","Open","High","Low","Close","Volume","Oi"
+        return '"Name"' + ''.join(',' + column.header() for column, _ in columns) + '\n'
+
+    def rows(self, symbol, columns):
+        """
+        Format decoded columns as text lines prefixed by the symbol, without header
+        """
+        specs = tuple(column.format_spec() for column, _ in columns)
+        values = [spec is not None and column_values or [column.format(v) for v in column_values]
+                  for (column, column_values), spec in zip(columns, specs)]
+        fmt = self._row_format(specs)
+        return ''.join(fmt % row for row in zip(repeat(symbol), *values))
+
+    def format(self, symbol, columns):
+        """
+        Format decoded columns as text lines prefixed by the symbol, with a header line
+
+        Parameters
+        ----------
+        symbol : str
+
+        columns : list(tuple(Column, sequence))
+            Columns returned by decode
+
+        Returns
+        -------
+        str
+
+        """
+        return self.header(columns) + self.rows(symbol, columns)
+
+
+class LayoutCache(object):
+    """
+    Parse every distinct DOP content once and share the compiled RecordLayout
+    between all the symbols using the same columns.
+    """
+    reg = re.compile('\"(.+)\",.+', re.IGNORECASE)
+
+    def __init__(self, known_columns, timestamp_column=None):
+        self.known_columns = known_columns
+        self.timestamp_column = timestamp_column
+        self.by_content = {}
+        self.by_names = {}
+        self._lock = threading.Lock()
+
+    def for_names(self, names):
+        names = tuple(names)
+        layout = self.by_names.get(names)
+        if layout is None:
+            with self._lock:
+                layout = self.by_names.setdefault(names, RecordLayout(names, self.known_columns,
+                                                                          self.timestamp_column))
+        return layout
+
+    def for_dop(self, content):
+        """
+        Return the layout described by the content of a DOP file
+        """
+        layout = self.by_content.get(content)
+        if layout is None:
+            names = [self.reg.search(line).groups()[0] for line in content.split()]
+            layout = self.for_names(names)
+            with self._lock:
+                self.by_content[content] = layout
+        return layout
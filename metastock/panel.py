@@ -0,0 +1,301 @@
+"""
+Cross-symbol panels: one date x symbol matrix per field, stored as .npy files.
+
+A panel directory <MARKET>.panel contains:
+    dates.npy       the union trading calendar, YYYYMMDD int32
+                    (datetime64[m] timestamps for intraday markets)
+    <Field>.npy     float matrix of shape (dates, symbols), NaN where a symbol has no bar
+    panel.json      symbols (column order), fields and shape
+
+Matrices are stored in Fortran (column-major) order so that the bars of a
+symbol are contiguous: numpy.load(path, mmap_mode='r')[:, j] reads a single block.
+"""
+
+import json
+import mmap
+import os
+import os.path
+import struct
+import sys
+from array import array
+
+from .files import DataFileInfo
+from .stats import RunStats
+
+NPY_MAGIC = b'\x93NUMPY'
+
+# field -> array typecode and numpy dtype of its matrix, volumes need float64 to hold NaN exactly
+FIELD_TYPES = {'Volume': ('d', '<f8'), 'OI': ('d', '<f8')}
+DEFAULT_FIELD_TYPE = ('f', '<f4')
+DEFAULT_FIELDS = ('Open', 'High', 'Low', 'Close', 'Volume')
+
+NAN = float('nan')
+
+
+def npy_header(descr, shape, fortran_order=False):
+    """
+    Return the header of a version 1.0 .npy file
+
+    Parameters
+    ----------
+    descr : str
+        numpy dtype string (f.e. '<f4')
+
+    shape : tuple(int)
+
+    fortran_order : bool
+
+    Returns
+    -------
+    bytes
+
+    """
+    dims = ''.join('%d, ' % dim for dim in shape).rstrip(' ')
+    if len(shape) > 1:
+        dims = dims.rstrip(',')
+    header = "{'descr': '%s', 'fortran_order': %s, 'shape': (%s), }" % (descr, fortran_order, dims)
+    # the whole header, magic included, is padded to a multiple of 64 bytes and ends with a newline
+    header += ' ' * (-(len(NPY_MAGIC) + 4 + len(header) + 1) % 64) + '\n'
+    return NPY_MAGIC + b'\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+def write_npy(path, descr, values):
+    """
+    Write a one dimensional array to a .npy file
+    """
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    with open(path, 'wb') as f:
+        f.write(npy_header(descr, (len(values),)))
+        f.write(values.tobytes())
+
+
+class NpyMatrix(object):
+    """
+    A .npy matrix preallocated on disk and filled column by column through a memory map
+
+    Private Variables
+    ----------
+    typecode : str
+        array typecode of the values
+
+    shape : tuple(int, int)
+        Rows (dates) and columns (symbols)
+
+    offset : int
+        Size of the header, where the data starts
+
+    """
+    def __init__(self, path, typecode, descr, shape):
+        self.path = path
+        self.typecode = typecode
+        self.shape = shape
+        header = npy_header(descr, shape, fortran_order=True)
+        self.offset = len(header)
+        self.itemsize = array(typecode).itemsize
+        size = self.offset + shape[0] * shape[1] * self.itemsize
+        self.file_handle = open(path, 'w+b')
+        self.file_handle.write(header)
+        self.file_handle.truncate(size)
+        self.mm = mmap.mmap(self.file_handle.fileno(), size)
+
+    def write_column(self, index, values):
+        """
+        Store the array `values` (one value per row) as column `index`
+        """
+        if sys.byteorder != 'little':
+            values = array(values.typecode, values)
+            values.byteswap()
+        start = self.offset + index * self.shape[0] * self.itemsize
+        self.mm[start:start + self.shape[0] * self.itemsize] = values.tobytes()
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        self.file_handle.close()
+
+
+def _keys(decoded):
+    """
+    Calendar keys of decoded records: YYYYMMDD dates or intraday timestamps
+    """
+    for column, values in decoded:
+        if isinstance(column, (DataFileInfo.DateColumn, DataFileInfo.TimestampColumn)):
+            return values
+    return None
+
+
+class PanelBuilder(object):
+    """
+    Build the panel of the symbols of one MetaStock directory
+
+    The first pass reads only the DATE (and TIME) fields of every DAT file to
+    build the union calendar and preallocate the matrices, the second decodes
+    each symbol once and scatters its bars into its column. Only one symbol
+    is held in memory at a time.
+
+    Private Variables
+    ----------
+    masters : list(MasterFile)
+        EMASTER and XMASTER of the directory
+
+    fields : list(str)
+        Decoded columns to export (f.e. 'Close')
+
+    stats : RunStats
+        Collect per-stage timing
+
+    """
+    def __init__(self, masters, fields=None, stats=None):
+        self.masters = masters
+        self.fields = list(fields or DEFAULT_FIELDS)
+        self.stats = stats or RunStats()
+
+    def _stocks(self, all_symbols, symbols):
+        stocks = []
+        for master in self.masters:
+            scanner = getattr(master.options, 'scanner', None)
+            for stock in master.stocks:
+                if not (all_symbols or stock.stock_symbol in symbols):
+                    continue
+                with self.stats.measure('dop', stock.stock_symbol):
+                    stock._load_columns(master.input_dir)
+                if scanner is not None and not scanner.check(master.input_dir, stock):
+                    continue
+                stocks.append((master, stock))
+        return stocks
+
+    def _calendar_keys(self, master, stock):
+        data = stock.read_candles(master.input_dir, self.stats, **master.read_options())
+        if data is None:
+            return None
+        with self.stats.measure('panel_calendar', stock.stock_symbol) as m:
+            layout = stock.layout
+            dates = layout.field(data, 'DATE')
+            if layout.intraday:
+                keys = DataFileInfo.timestampColumn.decode(dates, layout.field(data, 'TIME'))
+            else:
+                keys = DataFileInfo.knownMSColumns['DATE'].decode(dates)
+            m.records = len(keys)
+        return keys
+
+    def build(self, output_dir, all_symbols=True, symbols=()):
+        """
+        Write <output_dir>/<MARKET>.panel
+
+        Parameters
+        ----------
+        output_dir : str
+
+        all_symbols : bool
+            When True, all symbols are exported
+
+        symbols : list(str)
+            Symbols to export otherwise
+
+        Returns
+        -------
+        str
+            Path of the panel directory, None when there is no symbol to export
+
+        """
+        market = os.path.basename(os.path.normpath(self.masters[0].input_dir))
+        path = os.path.join(output_dir, '%s.panel' % market)
+
+        # first pass: union calendar
+        calendar = set()
+        stocks = []
+        intraday = None
+        for master, stock in self._stocks(all_symbols, symbols):
+            try:
+                if intraday is None:
+                    intraday = stock.layout.intraday
+                elif stock.layout.intraday != intraday:
+                    print('Skipping %s: daily and intraday symbols cannot share a panel' % stock.stock_symbol)
+                    continue
+                keys = self._calendar_keys(master, stock)
+            except Exception:
+                print("Error while reading symbol", stock.stock_symbol)
+                continue
+            if keys is None:
+                continue
+            calendar.update(keys)
+            stocks.append((master, stock, len(keys)))
+        if not stocks:
+            return None
+        calendar = sorted(calendar)
+        rows = dict((key, row) for row, key in enumerate(calendar))
+        shape = (len(calendar), len(stocks))
+        print('Building panel %s: %d dates x %d symbols' % (path, shape[0], shape[1]))
+
+        # second pass: scatter every symbol into its column
+        os.makedirs(path, exist_ok=True)
+        matrices = {}
+        try:
+            for field in self.fields:
+                typecode, descr = FIELD_TYPES.get(field, DEFAULT_FIELD_TYPE)
+                matrices[field] = NpyMatrix(os.path.join(path, '%s.npy.tmp' % field), typecode, descr, shape)
+            for index, (master, stock, records) in enumerate(stocks):
+                self._scatter(master, stock, index, rows, matrices, records)
+        finally:
+            for matrix in matrices.values():
+                matrix.close()
+        for field, matrix in matrices.items():
+            os.replace(matrix.path, os.path.join(path, '%s.npy' % field))
+
+        write_npy(os.path.join(path, 'dates.npy'), intraday and '<M8[m]' or '<i4',
+                  array(intraday and 'q' or 'i', calendar))
+        meta = {
+            'symbols': [stock.stock_symbol for _, stock, _ in stocks],
+            'fields': self.fields,
+            'shape': list(shape),
+            'dates': intraday and 'datetime64[m]' or 'YYYYMMDD',
+            'order': 'F',
+        }
+        with open(os.path.join(path, 'panel.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        return path
+
+    def _scatter(self, master, stock, index, rows, matrices, records):
+        """
+        Decode `stock` and write its column of every matrix, NaN where it has no bar
+
+        Only the first `records` records, the ones the calendar was built from, are
+        written; bars of dates missing from the calendar (a DAT file rewritten since
+        the first pass) are skipped.
+        """
+        print("Processing %s (fileNo %d)" % (stock.stock_symbol, stock.file_num))
+        decoded = []
+        try:
+            data = stock.read_candles(master.input_dir, self.stats, **master.read_options())
+            if data is not None:
+                decoded = stock.decode_candles(data, self.stats)
+        except Exception:
+            print("Error while converting symbol", stock.stock_symbol)
+        with self.stats.measure('panel', stock.stock_symbol) as m:
+            # records appended to the DAT file since the first pass have no row in the calendar
+            keys = _keys(decoded)
+            keys = keys[:records] if keys is not None else None
+            values = dict((column.name, column_values[:records]) for column, column_values in decoded)
+            positions = None
+            first = 0
+            if keys:
+                first = rows.get(keys[0])
+                last = rows.get(keys[-1])
+                if first is None or last is None or last - first != len(keys) - 1:
+                    # the symbol has no bar on some dates of the calendar
+                    positions = [rows.get(key) for key in keys]
+            for field, matrix in matrices.items():
+                column = array(matrix.typecode, [NAN]) * matrix.shape[0]
+                field_values = values.get(field)
+                if keys and field_values is not None:
+                    if positions is None:
+                        column[first:first + len(keys)] = array(matrix.typecode, field_values)
+                    else:
+                        for position, value in zip(positions, field_values):
+                            if position is not None:
+                                column[position] = value
+                matrix.write_column(index, column)
+                m.nbytes += matrix.shape[0] * matrix.itemsize
+            m.records = len(keys or ())
@@ -0,0 +1,148 @@
+"""
+Pipelined conversion: reader, decoder and writer stages connected by bounded queues.
+"""
+
+import threading
+import traceback
+import queue
+
+from .stats import RunStats
+
+# marks the end of the stream between stages
+_DONE = object()
+
+
+class ConversionPipeline(object):
+    """
+    Convert many symbols overlapping the I/O of one symbol with the CPU work of another.
+
+    The reader thread prefetches DAT files, the calling thread decodes them and
+    the writer thread formats and flushes finished outputs. Stages are connected
+    by queues holding at most `depth` symbols, a slow stage blocks the faster ones.
+
+    Private Variables
+    ----------
+    input_dir : str
+        Path of MetaStock directory input
+
+    output_dir : str
+        Path of CSV directory output
+
+    stats : RunStats
+        Collect per-stage timing
+
+    depth : int
+        Maximum number of symbols waiting between two stages
+
+    done : callable, optional
+        Called with the DataFileInfo once its output has been written
+
+    read_options : dict, optional
+        Keyword arguments given to DataFileInfo.read_candles (f.e. start, end)
+
+    writer : MarketStoreWriter or CompressedTextWriter, optional
+        Write to a market store or a compressed file instead of <SYMBOL>.TXT
+
+    chunk_records : int, optional
+        DAT files holding more records than this bypass the queues and are
+        streamed in chunks by the writer thread
+
+    """
+    def __init__(self, input_dir, output_dir, stats=None, depth=4, done=None, read_options=None,
+                 writer=None, chunk_records=None):
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.stats = stats or RunStats()
+        self.depth = depth
+        self.done = done
+        self.read_options = read_options or {}
+        self.writer = writer
+        self.chunk_records = chunk_records
+
+    def _fail(self, stock):
+        print("Error while converting symbol", stock.stock_symbol)
+        traceback.print_exc()
+
+    def _read(self, stocks, decode_queue):
+        """
+        Reader stage: load DOP columns and raw DAT records
+        """
+        try:
+            for stock in stocks:
+                print("Processing %s (fileNo %d)" % (stock.stock_symbol, stock.file_num))
+                try:
+                    with self.stats.measure('dop', stock.stock_symbol):
+                        stock._load_columns(self.input_dir)
+                    if stock.is_large(self.input_dir, self.chunk_records):
+                        # too large to be held in a queue, streamed by the writer stage
+                        decode_queue.put((stock, None))
+                        continue
+                    data = stock.read_candles(self.input_dir, self.stats, **self.read_options)
+                except Exception:
+                    self._fail(stock)
+                    continue
+                if data is not None:
+                    decode_queue.put((stock, data))
+        finally:
+            decode_queue.put(_DONE)
+
+    def _write(self, write_queue):
+        """
+        Writer stage: format and flush decoded columns
+        """
+        while True:
+            item = write_queue.get()
+            if item is _DONE:
+                return
+            stock, columns = item
+            try:
+                if columns is None:
+                    if not stock.load_candles(self.input_dir, self.output_dir, self.stats, writer=self.writer,
+                                              chunk_records=self.chunk_records, **self.read_options):
+                        continue
+                elif self.writer is not None:
+                    self.writer.write(stock, columns, self.stats)
+                else:
+                    stock.write_candles(self.output_dir, columns, self.stats)
+            except Exception:
+                self._fail(stock)
+                continue
+            if self.done is not None:
+                self.done(stock)
+
+    def run(self, stocks):
+        """
+        Convert all `stocks` and wait for every output to be written
+
+        Parameters
+        ----------
+        stocks : iterable(DataFileInfo)
+            Symbols to convert
+
+        """
+        decode_queue = queue.Queue(self.depth)
+        write_queue = queue.Queue(self.depth)
+        reader = threading.Thread(target=self._read, args=(stocks, decode_queue),
+                                  name='ms-reader', daemon=True)
+        writer = threading.Thread(target=self._write, args=(write_queue,),
+                                  name='ms-writer', daemon=True)
+        reader.start()
+        writer.start()
+        while True:
+            item = decode_queue.get()
+            if item is _DONE:
+                break
+            stock, data = item
+            if data is None:
+                write_queue.put((stock, None))
+                continue
+            try:
+                with self.stats.profile(stock.stock_symbol):
+                    columns = stock.decode_candles(data, self.stats)
+            except Exception:
+                self._fail(stock)
+                continue
+            write_queue.put((stock, columns))
+        write_queue.put(_DONE)
+        writer.join()
+        reader.join()
@@ -0,0 +1,257 @@
+"""
+Weekly, monthly and quarterly bars aggregated from decoded daily columns.
+"""
+
+import datetime
+import operator
+import os
+import os.path
+from array import array
+from itertools import compress, repeat
+
+from .files import DataFileInfo
+from .stats import RunStats
+from .utils import minutes2datetime
+
+# timeframe -> sub directory of the output directory its bars are written to
+PERIODS = {'W': 'weekly', 'M': 'monthly', 'Q': 'quarterly'}
+
+# how the values of a group of records are reduced to a bar, and how two partial bars are combined
+_FIRST = (lambda values, start, end: values[start], lambda a, b: a)
+_LAST = (lambda values, start, end: values[end - 1], lambda a, b: b)
+_HIGH = (lambda values, start, end: max(values[start:end]), max)
+_LOW = (lambda values, start, end: min(values[start:end]), min)
+_SUM = (lambda values, start, end: sum(values[start:end]), operator.add)
+_AGGREGATES = {'Open': _FIRST, 'High': _HIGH, 'Low': _LOW, 'Close': _LAST, 'Volume': _SUM}
+
+
+def check_periods(value):
+    """
+    Parse a comma separated list of timeframes (f.e. 'W,M'), raise ValueError when one is unknown
+    """
+    periods = [period.strip().upper() for period in value.split(',') if period.strip()]
+    for period in periods:
+        if period not in PERIODS:
+            raise ValueError('unknown timeframe %r, expected one of %s' % (period, ', '.join(sorted(PERIODS))))
+    return periods
+
+
+def period_dir(output_dir, period):
+    """
+    Directory the bars of `period` are written to, created when needed
+    """
+    path = os.path.join(output_dir, PERIODS[period])
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _days(decoded):
+    """
+    YYYYMMDD integer of every record, from the Date or the intraday Timestamp column
+    """
+    for column, values in decoded:
+        if isinstance(column, DataFileInfo.DateColumn):
+            return values
+        if isinstance(column, DataFileInfo.TimestampColumn):
+            cache = {}
+            days = array('i')
+            for day in map(operator.floordiv, values, repeat(1440)):
+                value = cache.get(day)
+                if value is None:
+                    value = cache[day] = int(minutes2datetime(day * 1440).strftime('%Y%m%d'))
+                days.append(value)
+            return days
+    raise ValueError('no date column to resample')
+
+
+def _keys(days, period):
+    """
+    Group key of every record, records of the same bar have equal keys
+    """
+    if period == 'M':
+        return list(map(operator.floordiv, days, repeat(100)))
+    if period == 'Q':
+        return [day // 10000 * 4 + (day // 100 % 100 - 1) // 3 for day in days]
+    # weeks start on monday, ordinal 1 (0001-01-01) is a monday
+    cache = {}
+    keys = []
+    for day in days:
+        key = cache.get(day)
+        if key is None:
+            key = cache[day] = (datetime.date(day // 10000, day // 100 % 100, day % 100).toordinal() - 1) // 7
+        keys.append(key)
+    return keys
+
+
+def aggregate(decoded, period):
+    """
+    Aggregate decoded records into bars
+
+    Records are sorted by date, so a bar is a run of records with the same
+    key; the runs are found in one pass comparing each key with the previous.
+    A bar is dated by its last record, opens with the first open, closes with
+    the last close, volumes are summed and other columns keep their last value.
+
+    Parameters
+    ----------
+    decoded : list(tuple(Column, sequence))
+        Columns returned by DataFileInfo.decode_candles
+
+    period : str
+        'W', 'M' or 'Q'
+
+    Returns
+    -------
+    tuple(list, list(tuple(Column, list)))
+        Key of every bar and the bars, the Date column first (intraday
+        timestamps are replaced by the date of the last record)
+
+    """
+    days = _days(decoded)
+    count = len(days)
+    if not count:
+        return [], [(DataFileInfo.knownMSColumns['DATE'], [])] + \
+            [(column, []) for column, _ in decoded if not _is_time(column)]
+    keys = _keys(days, period)
+    starts = [0] + list(compress(range(1, count), map(operator.ne, keys[1:], keys)))
+    ends = starts[1:] + [count]
+    bars = [(DataFileInfo.knownMSColumns['DATE'], [days[end - 1] for end in ends])]
+    for column, values in decoded:
+        if _is_time(column):
+            continue
+        reduce_group = _AGGREGATES.get(column.name, _LAST)[0]
+        bars.append((column, [reduce_group(values, start, end) for start, end in zip(starts, ends)]))
+    return [keys[start] for start in starts], bars
+
+
+def _is_time(column):
+    return isinstance(column, (DataFileInfo.DateColumn, DataFileInfo.TimeColumn, DataFileInfo.TimestampColumn))
+
+
+class BarAccumulator(object):
+    """
+    Aggregate the chunks of a symbol one after the other, merging the bar
+    that spans two chunks
+
+    Private Variables
+    ----------
+    period : str
+        'W', 'M' or 'Q'
+
+    keys : list
+        Key of every bar so far
+
+    columns : list(tuple(Column, list))
+        Bars so far
+
+    """
+    def __init__(self, period):
+        self.period = period
+        self.keys = []
+        self.columns = None
+
+    def add(self, decoded):
+        keys, bars = aggregate(decoded, self.period)
+        if self.columns is None:
+            self.keys, self.columns = keys, bars
+            return
+        if not keys:
+            return
+        if self.keys and self.keys[-1] == keys[0]:
+            for (column, values), (_, more) in zip(self.columns, bars):
+                values[-1] = _AGGREGATES.get(column.name, _LAST)[1](values[-1], more[0])
+                values.extend(more[1:])
+            keys = keys[1:]
+        else:
+            for (_, values), (_, more) in zip(self.columns, bars):
+                values.extend(more)
+        self.keys.extend(keys)
+
+    def bars(self):
+        """
+        Return the bars with the same types as the columns returned by decode_candles
+        """
+        bars = []
+        for column, values in self.columns or []:
+            if isinstance(column, DataFileInfo.DateColumn):
+                values = array('i', values)
+            elif isinstance(column, DataFileInfo.FloatColumn):
+                values = array('f', values)
+            elif isinstance(column, DataFileInfo.IntColumn):
+                values = array('q', values)
+            bars.append((column, values))
+        return bars
+
+
+class TimeframeWriter(object):
+    """
+    Write the daily output of a symbol and its weekly/monthly/quarterly bars
+    from the same decoded columns, so that each DAT file is read once
+
+    Private Variables
+    ----------
+    output_dir : str
+        Path of the daily output
+
+    writer : MarketStoreWriter or CompressedTextWriter, optional
+        Daily writer, None for <SYMBOL>.TXT files
+
+    periods : dict
+        Mapping period -> (output directory, writer or None)
+
+    stats : RunStats
+        Collect 'resample' timing
+
+    """
+    def __init__(self, output_dir, writer, periods, stats=None):
+        self.output_dir = output_dir
+        self.writer = writer
+        self.periods = periods
+        self.stats = stats or RunStats()
+
+    def _write_bars(self, stock, accumulators, stats):
+        for period, accumulator in sorted(accumulators.items()):
+            output_dir, writer = self.periods[period]
+            bars = accumulator.bars()
+            if writer is not None:
+                writer.write(stock, bars, stats)
+            else:
+                stock.write_candles(output_dir, bars, stats)
+
+    def _accumulate(self, stock, accumulators, columns):
+        with self.stats.measure('resample', stock.stock_symbol) as m:
+            for accumulator in accumulators.values():
+                accumulator.add(columns)
+            m.records = columns and len(columns[0][1]) or 0
+
+    def write(self, stock, columns, stats=None):
+        stats = stats or self.stats
+        if self.writer is not None:
+            self.writer.write(stock, columns, stats)
+        else:
+            stock.write_candles(self.output_dir, columns, stats)
+        accumulators = dict((period, BarAccumulator(period)) for period in self.periods)
+        self._accumulate(stock, accumulators, columns)
+        self._write_bars(stock, accumulators, stats)
+
+    def write_chunks(self, stock, chunks, stats=None):
+        stats = stats or self.stats
+        accumulators = dict((period, BarAccumulator(period)) for period in self.periods)
+
+        def accumulated():
+            for columns in chunks:
+                self._accumulate(stock, accumulators, columns)
+                yield columns
+
+        if self.writer is not None:
+            self.writer.write_chunks(stock, accumulated(), stats)
+        else:
+            stock.write_candle_chunks(self.output_dir, accumulated(), stats)
+        self._write_bars(stock, accumulators, stats)
+
+    def close(self):
+        for _, writer in self.periods.values():
+            if writer is not None:
+                writer.close()
+        if self.writer is not None:
+            self.writer.close()
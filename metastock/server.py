@@ -0,0 +1,425 @@
+"""
+Local candle query service with an LRU cache of decoded symbols.
+"""
+
+import bisect
+import json
+import os
+import os.path
+import socketserver
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from .files import DataFileInfo, MSEMasterFile, MSXMasterFile
+from .store import typed_columns
+from .utils import date2minutes, float2date
+
+
+# a frame is: magic, number of rows, number of columns, then for every column
+# its name length, name and array typecode, followed by the raw little-endian column blocks
+FRAME_MAGIC = b'MSC1'
+frame_header = struct.Struct('<4sIH')
+
+
+def encode_frame(columns):
+    """
+    Encode columns into the compact binary frame returned by the service
+
+    Parameters
+    ----------
+    columns : list(tuple(str, array))
+        Column names and values, all columns have the same length
+
+    Returns
+    -------
+    bytes
+
+    """
+    rows = columns and len(columns[0][1]) or 0
+    parts = [frame_header.pack(FRAME_MAGIC, rows, len(columns))]
+    for name, values in columns:
+        name = name.encode('ascii')
+        parts.append(struct.pack('<B', len(name)) + name + values.typecode.encode('ascii'))
+    for name, values in columns:
+        if sys.byteorder != 'little':
+            values = array(values.typecode, values)
+            values.byteswap()
+        parts.append(values.tobytes())
+    return b''.join(parts)
+
+
+def decode_frame(data):
+    """
+    Decode a frame created by encode_frame
+
+    Returns
+    -------
+    list(tuple(str, array))
+
+    """
+    magic, rows, ncols = frame_header.unpack_from(data, 0)
+    if magic != FRAME_MAGIC:
+        raise ValueError('not a candle frame')
+    offset = frame_header.size
+    layout = []
+    for _ in range(ncols):
+        length = data[offset]
+        name = data[offset + 1:offset + 1 + length].decode('ascii')
+        typecode = chr(data[offset + 1 + length])
+        offset += length + 2
+        layout.append((name, typecode))
+    columns = []
+    for name, typecode in layout:
+        values = array(typecode)
+        size = rows * values.itemsize
+        values.frombytes(data[offset:offset + size])
+        if sys.byteorder != 'little':
+            values.byteswap()
+        offset += size
+        columns.append((name, values))
+    return columns
+
+
+class DecodedSymbol(object):
+    """
+    Full history of a symbol decoded into typed arrays
+
+    Private Variables
+    ----------
+    columns : list(tuple(str, array))
+        Dates and times as YYYYMMDD/HHMM integers (intraday timestamps as minutes
+        since 1970-01-01), prices as float32, volumes as int64
+
+    dates : array
+        The Date column, used to binary search ranges
+
+    timestamps : array
+        The Timestamp column of intraday symbols, used instead of dates
+
+    fingerprint : tuple
+        DAT size and mtime when it was decoded
+
+    nbytes : int
+        Memory used by the arrays
+
+    """
+    def __init__(self, decoded, fingerprint):
+        self.fingerprint = fingerprint
+        self.columns = typed_columns(decoded)
+        self.dates = None
+        self.timestamps = None
+        for name, values in self.columns:
+            if name == 'Date':
+                self.dates = values
+            elif name == 'Timestamp':
+                self.timestamps = values
+        self.nbytes = sum(values.itemsize * len(values) for _, values in self.columns)
+
+    def select(self, start=None, end=None, last=None):
+        """
+        Return the columns of the rows in [start, end] (YYYYMMDD integers), keeping the last `last` rows
+        """
+        rows = self.columns and len(self.columns[0][1]) or 0
+        begin, stop = 0, rows
+        if self.dates is not None:
+            if start is not None:
+                begin = bisect.bisect_left(self.dates, start)
+            if end is not None:
+                stop = bisect.bisect_right(self.dates, end)
+        elif self.timestamps is not None:
+            if start is not None:
+                begin = bisect.bisect_left(self.timestamps, date2minutes(float2date(start - 19000000)))
+            if end is not None:
+                stop = bisect.bisect_left(self.timestamps, date2minutes(float2date(end - 19000000)) + 1440)
+        if last is not None:
+            begin = max(begin, stop - last)
+        if begin == 0 and stop == rows:
+            return self.columns
+        return [(name, values[begin:stop]) for name, values in self.columns]
+
+
+class CandleService(object):
+    """
+    Answer symbol, range and tail queries from the MSEMasterFile/MSXMasterFile index
+    of every MetaStock directory under options.input_dir.
+
+    Recently decoded symbols stay in an LRU cache limited to `budget` bytes,
+    an entry is dropped as soon as the size or mtime of its DAT file changes.
+    The index is reloaded when a master file is added, removed or changed,
+    the input directory is walked at most every REFRESH_INTERVAL seconds to
+    find out.
+
+    Private Variables
+    ----------
+    symbols : dict
+        Mapping (market, symbol) -> (directory, DataFileInfo), the market being the
+        directory relative to options.input_dir (its name for options.input_dir itself)
+
+    masters : dict
+        Mapping master file path -> mtime, used to reload the index
+
+    cache : OrderedDict
+        Mapping (directory, file_num) -> DecodedSymbol, least recently used first
+
+    """
+    REFRESH_INTERVAL = 1.0
+
+    def __init__(self, options, budget=256 * 1024 * 1024):
+        self.options = options
+        self.budget = budget
+        self.used = 0
+        self.cache = OrderedDict()
+        self.symbols = {}
+        self.masters = {}
+        self.refreshed = 0.0
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0,
+                         'requests': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+        self._lock = threading.Lock()
+        self._load_index()
+
+    def _master_mtimes(self):
+        mtimes = {}
+        for dirpath, dirnames, filenames in os.walk(self.options.input_dir):
+            for name in ('EMASTER', 'XMASTER'):
+                if name in filenames:
+                    path = os.path.join(dirpath, name)
+                    mtimes[path] = os.stat(path).st_mtime_ns
+        return mtimes
+
+    def _load_index(self, masters=None):
+        self.masters = masters if masters is not None else self._master_mtimes()
+        self.refreshed = time.monotonic()
+        symbols = {}
+        for path in sorted(self.masters):
+            directory, name = os.path.split(path)
+            subdir = os.path.relpath(directory, self.options.input_dir)
+            market = subdir == '.' and os.path.basename(os.path.normpath(directory)) or subdir
+            master = name == 'EMASTER' and MSEMasterFile(self.options, subdir) or MSXMasterFile(self.options, subdir)
+            for stock in master.stocks:
+                symbols[(market, stock.stock_symbol)] = (master.input_dir, stock)
+        self.symbols = symbols
+
+    def refresh(self):
+        """
+        Reload the index when a master file was added, removed or changed
+        """
+        if time.monotonic() - self.refreshed < self.REFRESH_INTERVAL:
+            return
+        masters = self._master_mtimes()
+        self.refreshed = time.monotonic()
+        if masters != self.masters:
+            self._load_index(masters)
+
+    def resolve(self, symbol, market=None):
+        """
+        Return the (market, symbol) key of `symbol`
+
+        Raises
+        ------
+        KeyError
+            When the symbol is unknown
+
+        ValueError
+            When `market` is omitted and the symbol is in several markets
+
+        """
+        if market is not None:
+            if (market, symbol) not in self.symbols:
+                raise KeyError(symbol)
+            return market, symbol
+        keys = [key for key in self.symbols if key[1] == symbol]
+        if not keys:
+            raise KeyError(symbol)
+        if len(keys) > 1:
+            raise ValueError('%s is in several markets (%s), give the market'
+                             % (symbol, ', '.join(sorted(market for market, _ in keys))))
+        return keys[0]
+
+    @staticmethod
+    def _fingerprint(directory, stock):
+        st = os.stat(stock.dat_path(directory))
+        return st.st_size, st.st_mtime_ns
+
+    def _decoded(self, key):
+        directory, stock = self.symbols[key]
+        key = (directory, stock.file_num)
+        fingerprint = self._fingerprint(directory, stock)
+        with self._lock:
+            entry = self.cache.get(key)
+            if entry is not None:
+                if entry.fingerprint == fingerprint:
+                    self.cache.move_to_end(key)
+                    self.counters['hits'] += 1
+                    return entry
+                del self.cache[key]
+                self.used -= entry.nbytes
+                self.counters['invalidations'] += 1
+            self.counters['misses'] += 1
+
+        view = DataFileInfo(stock.table, stock.index)
+        view._load_columns(directory)
+        data = view.read_candles(directory)
+        entry = DecodedSymbol(data is not None and view.decode_candles(data) or [], fingerprint)
+
+        with self._lock:
+            old = self.cache.pop(key, None)
+            if old is not None:
+                self.used -= old.nbytes
+            self.cache[key] = entry
+            self.used += entry.nbytes
+            while self.used > self.budget and len(self.cache) > 1:
+                _, evicted = self.cache.popitem(last=False)
+                self.used -= evicted.nbytes
+                self.counters['evictions'] += 1
+        return entry
+
+    def query(self, symbol, start=None, end=None, last=None, market=None):
+        """
+        Return the encoded frame with the candles of `symbol`
+
+        Parameters
+        ----------
+        symbol : str
+
+        start, end : int, optional
+            Date range as YYYYMMDD integers
+
+        last : int, optional
+            Keep only the latest `last` candles
+
+        market : str, optional
+            Market of the symbol, required when the symbol is in several markets
+
+        Raises
+        ------
+        KeyError
+            When the symbol is unknown
+
+        ValueError
+            When `market` is omitted and the symbol is in several markets
+
+        OSError
+            When the DAT file of the symbol is missing or unreadable, e.g. deleted
+            since the last index refresh
+
+        """
+        started = time.perf_counter()
+        self.refresh()
+        frame = encode_frame(self._decoded(self.resolve(symbol, market)).select(start, end, last))
+        self._record_latency(time.perf_counter() - started)
+        return frame
+
+    def _record_latency(self, seconds):
+        with self._lock:
+            self.counters['requests'] += 1
+            self.counters['latency_total'] += seconds
+            self.counters['latency_max'] = max(self.counters['latency_max'], seconds)
+
+    def list_symbols(self, market=None):
+        self.refresh()
+        return sorted(set(symbol for key_market, symbol in self.symbols if market is None or key_market == market))
+
+    def list_markets(self):
+        self.refresh()
+        return sorted(set(market for market, _ in self.symbols))
+
+    def statistics(self):
+        """
+        Cache hit/miss and latency counters
+        """
+        with self._lock:
+            stats = dict(self.counters)
+            stats.update({'cached_symbols': len(self.cache), 'cached_bytes': self.used,
+                          'budget_bytes': self.budget})
+        stats['latency_avg'] = stats['requests'] and stats['latency_total'] / stats['requests'] or 0.0
+        return stats
+
+
+class CandleRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /markets                                        JSON list of markets
+    GET /symbols?market=SET                             JSON list of symbols (of all markets without market)
+    GET /candles?symbol=PTT&market=SET&from=YYYYMMDD&to=YYYYMMDD&last=N
+                                                        binary frame (see encode_frame), market is
+                                                        required when the symbol is in several markets
+    GET /stats                                          JSON cache and latency counters
+    """
+    def address_string(self):
+        # client_address is empty on Unix sockets
+        return self.client_address and self.client_address[0] or 'unix'
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, value):
+        self._send(status, json.dumps(value).encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        service = self.server.service
+        if url.path == '/markets':
+            return self._send_json(200, service.list_markets())
+        if url.path == '/symbols':
+            return self._send_json(200, service.list_symbols(query.get('market')))
+        if url.path == '/stats':
+            return self._send_json(200, service.statistics())
+        if url.path != '/candles':
+            return self._send_json(404, {'error': 'unknown path %s' % url.path})
+        try:
+            start = int(query['from'].replace('-', '')) if 'from' in query else None
+            end = int(query['to'].replace('-', '')) if 'to' in query else None
+            last = int(query['last']) if 'last' in query else None
+            if last is not None and last < 0:
+                raise ValueError('last must not be negative')
+            frame = service.query(query['symbol'], start, end, last, query.get('market'))
+        except KeyError:
+            return self._send_json(404, {'error': 'unknown symbol %s' % query.get('symbol')})
+        except ValueError as e:
+            return self._send_json(400, {'error': str(e)})
+        except FileNotFoundError:
+            return self._send_json(404, {'error': 'data file of %s not found' % query.get('symbol')})
+        except OSError as e:
+            return self._send_json(503, {'error': 'cannot read %s: %s' % (query.get('symbol'), e)})
+        self._send(200, frame, 'application/octet-stream')
+
+
+class CandleHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class CandleUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service, host='127.0.0.1', port=8765, socket_path=None):
+    """
+    Serve queries on localhost:port, or on a Unix socket when `socket_path` is given, until interrupted
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = CandleUnixServer(socket_path, CandleRequestHandler)
+        print('Serving candles on unix:%s' % socket_path)
+    else:
+        server = CandleHTTPServer((host, port), CandleRequestHandler)
+        print('Serving candles on http://%s:%d' % (host, port))
+    server.service = service
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.unlink(socket_path)
@@ -0,0 +1,229 @@
+"""
+Deterministic split of a run into shards processed by independent processes or hosts.
+
+The units of work are (market, symbol) pairs weighted by the size of their
+input file. Every shard computes the same plan from the same input tree, so
+the shards need no coordination: each one keeps the units assigned to it and
+writes a completion manifest, and check_shards verifies that the manifests
+of all the shards cover every unit exactly once.
+"""
+
+import datetime
+import glob
+import heapq
+import json
+import os.path
+import zlib
+
+
+def parse_shard(value):
+    """
+    Parse 'i/N' (1 <= i <= N), raise ValueError when it is invalid
+    """
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise ValueError('invalid shard %r, expected i/N (f.e. 2/4)' % value)
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError('invalid shard %r, i must be between 1 and N' % value)
+    return index, count
+
+
+def unit_key(market, symbol):
+    return '%s/%s' % (market, symbol)
+
+
+def size_bucket(weight):
+    """
+    Power of two bucket of a weight: 2**(b-1) <= weight < 2**b, 0 for an empty file
+    """
+    return int(weight).bit_length()
+
+
+class ShardPlan(object):
+    """
+    Assignment of weighted units to N shards
+
+    Units are taken from the heaviest to the lightest and each one goes to the
+    least loaded shard. The plan only uses the power of two bucket of every
+    weight (see size_bucket), units of the same bucket being ordered by a
+    CRC32 of their key: a file whose size changes by less than a factor two
+    (f.e. a DAT file growing between the walks of two hosts) keeps the same
+    plan, and hosts that see different buckets compute different fingerprints,
+    which check_shards reports as stale.
+
+    Private Variables
+    ----------
+    weights : dict
+        Mapping unit key -> weight (input file size in bytes)
+
+    count : int
+        Number of shards
+
+    shards : dict
+        Mapping unit key -> shard number (1 to count)
+
+    loads : list(int)
+        Total weight of every shard
+
+    """
+    def __init__(self, weights, count):
+        self.weights = weights
+        self.count = count
+        self.shards = {}
+        self.loads = [0] * count
+        buckets = dict((key, size_bucket(weight)) for key, weight in weights.items())
+        heap = [(0, shard) for shard in range(count)]
+        order = sorted(weights, key=lambda key: (-buckets[key], zlib.crc32(key.encode('utf-8')), key))
+        for key in order:
+            load, shard = heapq.heappop(heap)
+            self.shards[key] = shard + 1
+            self.loads[shard] += weights[key]
+            heapq.heappush(heap, (load + (1 << buckets[key]), shard))
+
+    @property
+    def fingerprint(self):
+        """
+        CRC32 of the units and their size buckets, equal for the shards that computed the same plan
+        """
+        data = json.dumps(sorted((key, size_bucket(weight)) for key, weight in self.weights.items()),
+                          separators=(',', ':')).encode('utf-8')
+        return '%08x' % zlib.crc32(data)
+
+    def units(self, shard):
+        return sorted(key for key, owner in self.shards.items() if owner == shard)
+
+
+class Shard(object):
+    """
+    The units of one shard and the ones it completed
+
+    Private Variables
+    ----------
+    tool : str
+        Name of the program, part of the manifest file name
+
+    index : int
+        Shard number, from 1 to plan.count
+
+    plan : ShardPlan
+
+    assigned : set(str)
+        Unit keys of this shard
+
+    done : set(str)
+        Unit keys completed so far
+
+    """
+    def __init__(self, tool, index, plan):
+        self.tool = tool
+        self.index = index
+        self.plan = plan
+        self.assigned = set(plan.units(index))
+        self.done = set()
+
+    def owns(self, market, symbol):
+        return unit_key(market, symbol) in self.assigned
+
+    def complete(self, market, symbol):
+        key = unit_key(market, symbol)
+        if key in self.assigned:
+            self.done.add(key)
+
+    @staticmethod
+    def manifest_name(tool, index, count):
+        return '.%s-shard-%d-of-%d.json' % (tool, index, count)
+
+    def write_manifest(self, directory):
+        """
+        Write the completion manifest of this shard to `directory`, return its path
+        """
+        path = os.path.join(directory, self.manifest_name(self.tool, self.index, self.plan.count))
+        manifest = {
+            'tool': self.tool,
+            'shard': self.index,
+            'count': self.plan.count,
+            'fingerprint': self.plan.fingerprint,
+            'weight': self.plan.loads[self.index - 1],
+            'assigned': sorted(self.assigned),
+            'done': sorted(self.done),
+            'finished': datetime.datetime.now().isoformat(timespec='seconds'),
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, path)
+        print('Shard %d/%d: %d of %d units done, manifest %s'
+              % (self.index, self.plan.count, len(self.done), len(self.assigned), path))
+        return path
+
+
+def check_shards(directory, tool, weights):
+    """
+    Check that the shard manifests in `directory` together cover every unit
+
+    Parameters
+    ----------
+    directory : str
+        Where the manifests of all the shards have been gathered
+
+    tool : str
+        'ms2csv' or 'rdsupload'
+
+    weights : dict
+        Mapping unit key -> weight of the full run, see ShardPlan
+
+    Returns
+    -------
+    dict
+        'count' shards expected, and the lists of 'missing_shards', 'stale_shards'
+        (planned from other inputs), 'incomplete' units (not done by any shard),
+        'duplicated' units (done by several shards) and 'unknown' units;
+        'ok' is True when all of them are empty
+
+    """
+    manifests = []
+    for path in sorted(glob.glob(os.path.join(directory, '.%s-shard-*-of-*.json' % tool))):
+        with open(path, 'r') as f:
+            manifests.append(json.load(f))
+    report = {'manifests': len(manifests), 'count': None, 'missing_shards': [], 'stale_shards': [],
+              'incomplete': [], 'duplicated': [], 'unknown': []}
+    if not manifests:
+        report['ok'] = False
+        return report
+    count = max(manifest['count'] for manifest in manifests)
+    report['count'] = count
+    fingerprint = ShardPlan(weights, count).fingerprint
+    found = set()
+    owners = {}
+    for manifest in manifests:
+        if manifest['count'] != count:
+            continue
+        found.add(manifest['shard'])
+        if manifest['fingerprint'] != fingerprint:
+            report['stale_shards'].append(manifest['shard'])
+        for key in manifest['done']:
+            owners.setdefault(key, []).append(manifest['shard'])
+    report['missing_shards'] = [shard for shard in range(1, count + 1) if shard not in found]
+    report['incomplete'] = sorted(key for key in weights if key not in owners)
+    report['duplicated'] = sorted(key for key, shards in owners.items() if len(shards) > 1)
+    report['unknown'] = sorted(key for key in owners if key not in weights)
+    report['ok'] = not (report['missing_shards'] or report['stale_shards'] or report['incomplete']
+                        or report['duplicated'] or report['unknown'])
+    return report
+
+
+def print_check(report):
+    """
+    Print the result of check_shards
+    """
+    if not report['manifests']:
+        print('No shard manifest found')
+        return
+    print('Shards: %d expected, %d manifests' % (report['count'], report['manifests']))
+    for name, label in (('missing_shards', 'Missing shards'), ('stale_shards', 'Shards planned from other inputs'),
+                        ('incomplete', 'Units not done'), ('duplicated', 'Units done twice'),
+                        ('unknown', 'Units not in the inputs')):
+        if report[name]:
+            print('%s (%d): %s' % (label, len(report[name]), ', '.join(str(item) for item in report[name][:20])))
+    print(report['ok'] and 'All units covered exactly once' or 'Shards do not cover the run')
@@ -0,0 +1,360 @@
+"""
+Decoded markets published in shared memory for local consumer processes.
+
+A loader decodes every market under the input directory once, into one
+multiprocessing.shared_memory segment per market, and writes a JSON manifest:
+
+    segments    segment name -> market and size in bytes
+    markets     market -> symbol -> segment, count and, for every column,
+                its offset in the segment, length (values), array typecode and numpy dtype
+
+Consumers attach to the segments read-only and get the columns as memoryviews
+over the shared pages, nothing is copied or decoded again (numpy.frombuffer
+wraps a column without a copy either).
+
+The segments belong to the loader: it unlinks them when it stops, unless it
+detaches them, in which case they live until unlink_manifest is called.
+"""
+
+import datetime
+import json
+import os
+import os.path
+import sys
+from array import array
+from multiprocessing import shared_memory
+
+from .files import MSEMasterFile, MSXMasterFile
+from .stats import RunStats
+from .store import typed_columns, ALIGNMENT
+
+MANIFEST_VERSION = 1
+
+_ENDIAN = sys.byteorder == 'little' and '<' or '>'
+_DTYPES = {'i': 'i4', 'q': 'i8', 'f': 'f4', 'd': 'f8'}
+
+
+def _dtype(name, typecode):
+    """
+    numpy dtype string of a column, intraday timestamps are datetime64[m]
+    """
+    if name == 'Timestamp':
+        return _ENDIAN + 'M8[m]'
+    return _ENDIAN + _DTYPES[typecode]
+
+
+def _untrack(segment):
+    """
+    Stop the resource tracker of this process from unlinking `segment` when the process exits
+    """
+    if os.name == 'posix':
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(segment._name, 'shared_memory')
+
+
+def _attach(name):
+    """
+    Open an existing segment without taking ownership of it
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before Python 3.13 attaching registers the segment like creating it
+        segment = shared_memory.SharedMemory(name=name)
+        _untrack(segment)
+        return segment
+
+
+def unlink_manifest(path):
+    """
+    Unlink the segments listed in the manifest at `path`, then remove the manifest
+
+    Returns
+    -------
+    int
+        Number of segments unlinked, segments already gone are skipped
+
+    """
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    unlinked = 0
+    for name in manifest['segments']:
+        try:
+            segment = _attach(name)
+        except FileNotFoundError:
+            continue
+        segment.close()
+        segment.unlink()
+        unlinked += 1
+    os.unlink(path)
+    return unlinked
+
+
+class SharedMarketPublisher(object):
+    """
+    Decode the markets under options.input_dir into shared memory segments
+
+    The size of a segment is planned from the DAT file sizes before anything
+    is decoded, so every symbol is decoded once, straight into its block.
+
+    Private Variables
+    ----------
+    options
+        Command line options (input_dir, precision)
+
+    stats : RunStats
+        Collect per-stage timing
+
+    segments : list(SharedMemory)
+        Segments created by this process
+
+    manifest : dict
+        Description of the published segments and columns
+
+    """
+    def __init__(self, options, stats=None):
+        self.options = options
+        self.stats = stats or RunStats()
+        self.segments = []
+        self.manifest = None
+        self.manifest_path = None
+
+    def _markets(self):
+        """
+        Yield the name and the master files of every MetaStock directory
+        """
+        for dirpath, dirnames, filenames in sorted(os.walk(self.options.input_dir)):
+            masters = []
+            subdir = os.path.relpath(dirpath, self.options.input_dir)
+            if 'EMASTER' in filenames:
+                masters.append(MSEMasterFile(self.options, subdir))
+            if 'XMASTER' in filenames:
+                masters.append(MSXMasterFile(self.options, subdir))
+            if masters:
+                yield subdir == '.' and os.path.basename(os.path.normpath(dirpath)) or subdir, masters
+
+    def _plan(self, masters):
+        """
+        Offsets of the columns of every symbol, for the number of records its DAT file can hold
+
+        Returns
+        -------
+        tuple
+            ([(master, stock, records, offsets), ...], size of the segment)
+
+        """
+        plan = []
+        size = 0
+        for master in masters:
+            for stock in master.stocks:
+                try:
+                    with self.stats.measure('dop', stock.stock_symbol):
+                        stock._load_columns(master.input_dir)
+                    records = max(os.path.getsize(stock.dat_path(master.input_dir)) - stock.header_size, 0) \
+                        // stock.layout.record_size
+                except Exception:
+                    print("Error while reading symbol", stock.stock_symbol)
+                    continue
+                offsets = []
+                for name, values in typed_columns(stock.layout.decode(b'')):
+                    size += -size % ALIGNMENT
+                    offsets.append(size)
+                    size += records * values.itemsize
+                plan.append((master, stock, records, offsets))
+        return plan, size
+
+    def _publish_market(self, market, masters):
+        plan, size = self._plan(masters)
+        name = 'ms_%d_%d' % (os.getpid(), len(self.segments))
+        segment = shared_memory.SharedMemory(name=name, create=True, size=max(size, 1))
+        self.segments.append(segment)
+        symbols = {}
+        for master, stock, records, offsets in plan:
+            print("Processing %s (fileNo %d)" % (stock.stock_symbol, stock.file_num))
+            try:
+                data = stock.read_candles(master.input_dir, self.stats)
+                decoded = data is not None and stock.decode_candles(data, self.stats) or stock.layout.decode(b'')
+            except Exception:
+                print("Error while converting symbol", stock.stock_symbol)
+                continue
+            with self.stats.measure('shm', stock.stock_symbol) as m:
+                columns = []
+                count = decoded_count = 0
+                for (column_name, values), offset in zip(typed_columns(decoded), offsets):
+                    # records appended to the DAT file since _plan do not fit in the column
+                    decoded_count = len(values)
+                    count = min(decoded_count, records)
+                    with memoryview(values) as view, view.cast('B') as raw, \
+                            raw[:count * values.itemsize] as written:
+                        segment.buf[offset:offset + len(written)] = written
+                        m.nbytes += len(written)
+                    columns.append({'name': column_name, 'offset': offset, 'length': count,
+                                    'typecode': values.typecode, 'dtype': _dtype(column_name, values.typecode)})
+                symbols[stock.stock_symbol] = {'segment': name, 'count': count, 'columns': columns}
+                m.records = count
+                if count < decoded_count:
+                    print("%s: %d records added while publishing, published the first %d"
+                          % (stock.stock_symbol, decoded_count - count, count))
+        self.manifest['segments'][name] = {'market': market, 'size': segment.size}
+        self.manifest['markets'][market] = symbols
+
+    def publish(self, manifest_path):
+        """
+        Decode every market into its segment and write the manifest
+
+        Parameters
+        ----------
+        manifest_path : str
+            Where to write the manifest, replaced atomically once all the segments are filled
+
+        Returns
+        -------
+        dict
+            The manifest
+
+        """
+        self.manifest = {'version': MANIFEST_VERSION, 'pid': os.getpid(),
+                         'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                         'segments': {}, 'markets': {}}
+        try:
+            for market, masters in self._markets():
+                self._publish_market(market, masters)
+        except BaseException:
+            self.unlink()
+            raise
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_path, manifest_path)
+        self.manifest_path = manifest_path
+        return self.manifest
+
+    def unlink(self):
+        """
+        Remove the manifest and destroy the segments, consumers keep their
+        mappings until they close them
+        """
+        if self.manifest_path is not None and os.path.exists(self.manifest_path):
+            os.unlink(self.manifest_path)
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+        self.segments = []
+
+    def detach(self):
+        """
+        Leave the segments alive after this process exits, see unlink_manifest
+        """
+        for segment in self.segments:
+            _untrack(segment)
+            segment.close()
+        self.segments = []
+
+
+class SharedMarket(object):
+    """
+    Read-only access to the markets published by a SharedMarketPublisher
+
+    Example
+    -------
+    with SharedMarket('/dev/shm/markets.json') as markets:
+        columns = dict(markets.read('PTT'))
+        closes = numpy.frombuffer(columns['Close'], dtype='<f4')
+
+    close releases the memoryviews returned by read, arrays created over them
+    (numpy.frombuffer) must be deleted first.
+
+    Private Variables
+    ----------
+    manifest : dict
+        See SharedMarketPublisher.publish
+
+    segments : dict
+        Mapping segment name -> attached SharedMemory
+
+    views : list(memoryview)
+        Views handed out by read, released by close
+
+    """
+    def __init__(self, manifest_path):
+        with open(manifest_path, 'r') as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('version') != MANIFEST_VERSION:
+            raise ValueError('%s: unsupported manifest version %r' % (manifest_path, self.manifest.get('version')))
+        self.segments = {}
+        self.views = []
+        try:
+            for name in self.manifest['segments']:
+                self.segments[name] = _attach(name)
+        except FileNotFoundError:
+            self.close()
+            raise
+
+    def markets(self):
+        return sorted(self.manifest['markets'])
+
+    def symbols(self, market=None):
+        if market is not None:
+            return sorted(self.manifest['markets'][market])
+        return sorted(set(symbol for symbols in self.manifest['markets'].values() for symbol in symbols))
+
+    def info(self, symbol, market=None):
+        """
+        Return the manifest entry of `symbol` (segment, count and columns)
+
+        Raises
+        ------
+        KeyError
+            When the symbol is unknown
+
+        ValueError
+            When `market` is omitted and the symbol is published by several markets
+
+        """
+        if market is not None:
+            return self.manifest['markets'][market][symbol]
+        entries = [symbols[symbol] for symbols in self.manifest['markets'].values() if symbol in symbols]
+        if not entries:
+            raise KeyError(symbol)
+        if len(entries) > 1:
+            raise ValueError('%s is published by several markets, give the market' % symbol)
+        return entries[0]
+
+    def read(self, symbol, market=None):
+        """
+        Return the columns of `symbol` as read-only memoryviews over the shared segment
+
+        Returns
+        -------
+        list(tuple(str, memoryview))
+
+        """
+        entry = self.info(symbol, market)
+        buf = self.segments[entry['segment']].buf
+        columns = []
+        for column in entry['columns']:
+            size = column['length'] * array(column['typecode']).itemsize
+            block = buf[column['offset']:column['offset'] + size]
+            readonly = block.toreadonly()
+            values = readonly.cast(column['typecode'])
+            self.views.extend((values, readonly, block))
+            columns.append((column['name'], values))
+        return columns
+
+    def close(self):
+        """
+        Detach from the segments, they stay alive for the other processes
+        """
+        for view in self.views:
+            view.release()
+        self.views = []
+        for segment in self.segments.values():
+            segment.close()
+        self.segments = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
@@ -0,0 +1,196 @@
+"""
+Per-stage timing counters and run report.
+"""
+
+import json
+import threading
+import time
+
+
+class StageTimer(object):
+    """
+    Context manager measuring a single stage of work
+
+    The caller may fill `records` and `nbytes` while inside the block,
+    they are added to the counters when the block exits.
+
+    Private Variables
+    ----------
+    stats : RunStats
+        Owner of the counters
+
+    stage : str
+        Stage name (f.e. 'dat_read')
+
+    symbol : str
+        Symbol the work belongs to, None for run-level work
+
+    records : int
+        Number of records handled
+
+    nbytes : int
+        Number of bytes handled
+
+    """
+    def __init__(self, stats, stage, symbol=None):
+        self.stats = stats
+        self.stage = stage
+        self.symbol = symbol
+        self.records = 0
+        self.nbytes = 0
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stats.add(self.stage, self.symbol, time.perf_counter() - self.started,
+                       self.records, self.nbytes)
+        return False
+
+
+class RunStats(object):
+    """
+    Collect per-symbol and aggregate counters (records, bytes, seconds)
+    for every instrumented stage and emit them as JSON lines.
+
+    Stages used by the converter: 'master', 'dop', 'dat_read', 'decode', 'indicators', 'write',
+    'compress', 'verify', 'resample', 'panel_calendar', 'panel', 'shm'.
+    Stages used by the uploader: 'db_query', 'db_write', 'db_commit', and in diff mode 'diff', 'diff_wait'.
+    Stages used by ms2rds.py between the two: 'handoff_put', 'handoff_get'.
+
+    Private Variables
+    ----------
+    report_path : str
+        Where to write the JSON lines report, None to skip the report
+
+    profile_symbol : str
+        Symbol to run under cProfile, None to disable profiling
+
+    profile_path : str
+        Where to dump the cProfile statistics
+
+    """
+    def __init__(self, report_path=None, profile_symbol=None, profile_path=None):
+        self.report_path = report_path
+        self.profile_symbol = profile_symbol
+        self.profile_path = profile_path or (profile_symbol and '%s.prof' % profile_symbol.replace('/', '_'))
+        self.started = time.perf_counter()
+        self.symbols = {}
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def measure(self, stage, symbol=None):
+        """
+        Return a context manager timing `stage` for `symbol`
+
+        Example
+        -------
+        with stats.measure('dat_read', 'PTT') as m:
+            data = f.read()
+            m.nbytes = len(data)
+
+        """
+        return StageTimer(self, stage, symbol)
+
+    def add(self, stage, symbol, seconds, records=0, nbytes=0):
+        """
+        Add measured values to the per-symbol and aggregate counters
+        """
+        with self._lock:
+            keys = [(self.stages, stage)]
+            if symbol is not None:
+                keys.append((self.symbols, (symbol, stage)))
+            for table, key in keys:
+                counter = table.get(key)
+                if counter is None:
+                    counter = table[key] = [0, 0, 0, 0.0]
+                counter[0] += 1
+                counter[1] += records
+                counter[2] += nbytes
+                counter[3] += seconds
+
+    def count(self, name, value=1):
+        """
+        Increment a plain run-level counter (f.e. number of skipped symbols)
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def profile(self, symbol):
+        """
+        Return a context manager running the block under cProfile
+        when `symbol` is the chosen one, a no-op context otherwise
+        """
+        if self.profile_symbol is None or symbol != self.profile_symbol:
+            return _NoProfile()
+        return _Profile(self.profile_path)
+
+    @staticmethod
+    def _entry(kind, counter, **extra):
+        calls, records, nbytes, seconds = counter
+        entry = {'type': kind}
+        entry.update(extra)
+        entry.update({
+            'calls': calls,
+            'records': records,
+            'bytes': nbytes,
+            'seconds': round(seconds, 6),
+            'records_per_sec': seconds > 0 and round(records / seconds, 1) or None,
+        })
+        return entry
+
+    def entries(self):
+        """
+        Return the report as a list of dicts, symbol entries first,
+        then stage aggregates and finally the run summary
+        """
+        with self._lock:
+            lines = [self._entry('symbol', counter, symbol=symbol, stage=stage)
+                     for (symbol, stage), counter in sorted(self.symbols.items())]
+            lines += [self._entry('stage', counter, stage=stage)
+                      for stage, counter in sorted(self.stages.items())]
+            run = {'type': 'run', 'wall_seconds': round(time.perf_counter() - self.started, 6),
+                   'symbols': len(set(symbol for symbol, _ in self.symbols))}
+            run.update(self.counters)
+            lines.append(run)
+        return lines
+
+    def write_report(self):
+        """
+        Write the JSON lines report to self.report_path ('-' means stdout)
+        """
+        if self.report_path is None:
+            return
+        lines = [json.dumps(entry, sort_keys=True) for entry in self.entries()]
+        if self.report_path == '-':
+            print('\n'.join(lines))
+            return
+        with open(self.report_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+class _NoProfile(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+class _Profile(object):
+    def __init__(self, path):
+        self.path = path
+        import cProfile
+        self.profiler = cProfile.Profile()
+
+    def __enter__(self):
+        self.profiler.enable()
+        return self.profiler
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.profiler.disable()
+        self.profiler.dump_stats(self.path)
+        return False
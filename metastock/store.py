@@ -0,0 +1,360 @@
+"""
+Packed single-file market store.
+
+Layout of a store file:
+    header      magic, index offset, index length
+    blocks      for every symbol, its columns as contiguous little-endian typed arrays
+    index       JSON mapping symbol -> offset, count, first and last date, column layout
+
+Writing a store that already exists builds a new file next to it: the symbols
+written in this run, then the blocks of the other symbols copied from the old
+file, the index, and the header pointing to it; the new file then replaces the
+old one. Re-running a conversion does not make the store grow.
+A reader memory-maps the file once and serves any symbol without copying.
+
+Blocks may be compressed as a whole (gzip/zstd), such symbols are decompressed
+when read instead of being served from the map.
+"""
+
+import json
+import mmap
+import os
+import os.path
+import struct
+import sys
+import threading
+from array import array
+
+from .compress import decompress
+from .files import DataFileInfo
+from .stats import RunStats
+from .utils import minutes2datetime
+
+STORE_MAGIC = b'MSSTORE1'
+store_header = struct.Struct('<8sQQ')
+ALIGNMENT = 8
+
+
+def typed_columns(decoded):
+    """
+    Convert columns returned by DataFileInfo.decode_candles to typed arrays
+
+    Dates and times become YYYYMMDD/HHMM integers ('i'), intraday timestamps
+    minutes since 1970-01-01 ('q', the layout of numpy datetime64[m]),
+    prices float32 ('f') and volumes int64 ('q').
+
+    Parameters
+    ----------
+    decoded : list(tuple(Column, sequence))
+
+    Returns
+    -------
+    list(tuple(str, array))
+
+    """
+    columns = []
+    for column, values in decoded:
+        if isinstance(column, DataFileInfo.DateColumn):
+            values = array('i', values)
+        elif isinstance(column, DataFileInfo.TimeColumn):
+            values = array('i', values)
+        elif isinstance(column, DataFileInfo.FloatColumn):
+            values = array('f', values)
+        else:
+            values = array('q', values)
+        columns.append((column.name, values))
+    return columns
+
+
+def _day(columns, position):
+    """
+    YYYYMMDD date of the row at `position`, from the Date or Timestamp column
+    """
+    for name, values in columns:
+        if name == 'Date':
+            return values[position]
+        if name == 'Timestamp':
+            return int(minutes2datetime(values[position]).strftime('%Y%m%d'))
+    return None
+
+
+class MarketStoreWriter(object):
+    """
+    Write symbols to a store file, keeping the other symbols of an existing store
+
+    Private Variables
+    ----------
+    path : str
+        Store file, written to <path>.tmp and replaced on close
+
+    index : dict
+        Symbol index of the new file
+
+    old_index : dict
+        Symbol index of the existing file, its blocks not rewritten are copied on close
+
+    precision : int
+        Digits after the decimal point used by readers to format prices
+
+    pool : CompressionPool, optional
+        Compress symbol blocks in the background
+
+    pending : list
+        Compressed blocks waiting to be appended, in submission order
+
+    """
+    def __init__(self, path, precision=None, pool=None):
+        self.path = path
+        self.precision = precision is not None and precision or DataFileInfo.FloatColumn.precision
+        self.pool = pool
+        self.pending = []
+        self._lock = threading.Lock()
+        self.index = {}
+        self.old_index = {}
+        self.old_handle = None
+        if os.path.isfile(path) and os.path.getsize(path) >= store_header.size:
+            self.old_handle = open(path, 'rb')
+            magic, index_offset, index_length = store_header.unpack(self.old_handle.read(store_header.size))
+            if magic != STORE_MAGIC:
+                self.old_handle.close()
+                raise ValueError('%s is not a market store' % path)
+            self.old_handle.seek(index_offset)
+            self.old_index = json.loads(self.old_handle.read(index_length).decode('utf-8'))['symbols']
+        self.tmp_path = path + '.tmp'
+        self.file_handle = open(self.tmp_path, 'w+b')
+        self.file_handle.write(store_header.pack(STORE_MAGIC, 0, 0))
+
+    def _align(self):
+        padding = -self.file_handle.tell() % ALIGNMENT
+        if padding:
+            self.file_handle.write(b'\0' * padding)
+
+    def write(self, stock, decoded, stats=None):
+        """
+        Append the decoded columns of `stock`, replacing its previous version
+
+        Parameters
+        ----------
+        stock : DataFileInfo
+
+        decoded : list(tuple(Column, list))
+            Columns returned by DataFileInfo.decode_candles
+
+        stats : RunStats, optional
+            Collect 'write' timing
+
+        """
+        self._write_typed(stock, typed_columns(decoded), stats or RunStats())
+
+    def write_chunks(self, stock, chunks, stats=None):
+        """
+        Append `stock` decoded in chunks, see write
+
+        The typed arrays of all the chunks are gathered before the block is
+        written, which takes a few bytes per value instead of Python objects.
+        """
+        stats = stats or RunStats()
+        columns = []
+        for decoded in chunks:
+            with stats.measure('write', stock.stock_symbol):
+                typed = typed_columns(decoded)
+                if not columns:
+                    columns = typed
+                else:
+                    for (_, values), (_, more) in zip(columns, typed):
+                        values.extend(more)
+        self._write_typed(stock, columns, stats)
+
+    def _write_typed(self, stock, columns, stats):
+        """
+        Build the block of the typed `columns` of `stock` and append it
+        """
+        with stats.measure('write', stock.stock_symbol) as m:
+            count = columns and len(columns[0][1]) or 0
+            parts = []
+            size = 0
+            layout = []
+            for name, values in columns:
+                padding = -size % ALIGNMENT
+                parts.append(b'\0' * padding)
+                size += padding
+                layout.append([name, values.typecode, size])
+                if sys.byteorder != 'little':
+                    values = array(values.typecode, values)
+                    values.byteswap()
+                parts.append(values.tobytes())
+                size += len(parts[-1])
+            entry = {
+                'count': count,
+                'first': count and _day(columns, 0) or None,
+                'last': count and _day(columns, -1) or None,
+                'columns': layout,
+            }
+            block = b''.join(parts)
+            m.records = count
+            m.nbytes = len(block)
+
+        with self._lock:
+            if self.pool is None:
+                self._append(stock.stock_symbol, entry, block)
+            else:
+                entry['compression'] = self.pool.method
+                self.pending.append((stock.stock_symbol, entry,
+                                     self.pool.compress_async(block, stock.stock_symbol)))
+                self._drain(False)
+
+    def _append(self, symbol, entry, block):
+        self._align()
+        entry['offset'] = self.file_handle.tell()
+        entry['length'] = len(block)
+        self.file_handle.write(block)
+        self.index[symbol] = entry
+
+    def _drain(self, wait):
+        """
+        Append the compressed blocks that are ready, keeping the submission order
+        """
+        while self.pending and (wait or self.pending[0][2].done()):
+            symbol, entry, future = self.pending.pop(0)
+            self._append(symbol, entry, future.result())
+
+    def _copy_old(self):
+        """
+        Append the blocks of the existing store whose symbols were not written in this run
+        """
+        for symbol, entry in sorted(self.old_index.items()):
+            if symbol in self.index:
+                continue
+            self.old_handle.seek(entry['offset'])
+            self._append(symbol, dict(entry), self.old_handle.read(entry['length']))
+        self.old_handle.close()
+        self.old_handle = None
+
+    def close(self):
+        """
+        Copy the symbols kept from the existing store, write the index, point
+        the header to it and replace the store with the new file
+        """
+        self._drain(True)
+        if self.old_handle is not None:
+            self._copy_old()
+        self._align()
+        index_offset = self.file_handle.tell()
+        data = json.dumps({'precision': self.precision, 'symbols': self.index}).encode('utf-8')
+        self.file_handle.write(data)
+        self.file_handle.flush()
+        os.fsync(self.file_handle.fileno())
+        self.file_handle.seek(0)
+        self.file_handle.write(store_header.pack(STORE_MAGIC, index_offset, len(data)))
+        self.file_handle.close()
+        os.replace(self.tmp_path, self.path)
+
+
+class MarketStore(object):
+    """
+    Read-only access to a store file through a single memory map
+
+    Example
+    -------
+    with MarketStore('SET.MSS') as store:
+        for name, values in store.read('PTT'):
+            ...
+
+    close releases the memoryviews returned by read, arrays created over them
+    (numpy.frombuffer) must be deleted first.
+
+    Private Variables
+    ----------
+    index : dict
+        Mapping symbol -> offset, count, first, last, columns
+
+    precision : int
+        Digits after the decimal point the prices were converted with
+
+    views : list(memoryview)
+        Views over the map handed out by read, released by close
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.views = []
+        self.mm = None
+        self.file_handle = open(path, 'rb')
+        self.mm = mmap.mmap(self.file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, index_length = store_header.unpack_from(self.mm, 0)
+        if magic != STORE_MAGIC:
+            self.close()
+            raise ValueError('%s is not a market store' % path)
+        meta = json.loads(self.mm[index_offset:index_offset + index_length].decode('utf-8'))
+        self.precision = meta['precision']
+        self.index = meta['symbols']
+
+    def symbols(self):
+        return sorted(self.index)
+
+    def info(self, symbol):
+        """
+        Return the index entry of `symbol` (offset, count, first and last date)
+        """
+        return self.index[symbol]
+
+    def read(self, symbol):
+        """
+        Return the columns of `symbol` as memoryviews over the mapped file
+        (no copy unless the block is compressed)
+
+        Returns
+        -------
+        list(tuple(str, memoryview))
+
+        """
+        entry = self.index[symbol]
+        columns = []
+        compressed = 'compression' in entry
+        if compressed:
+            # the columns are views over the decompressed copy, they do not hold the map
+            view = memoryview(decompress(entry['compression'],
+                                         self.mm[entry['offset']:entry['offset'] + entry['length']]))
+            entry = dict(entry, offset=0)
+        else:
+            view = memoryview(self.mm)
+        with view:
+            for name, typecode, offset in entry['columns']:
+                start = entry['offset'] + offset
+                size = entry['count'] * array(typecode).itemsize
+                block = view[start:start + size]
+                values = block.cast(typecode)
+                if sys.byteorder != 'little':
+                    swapped = array(typecode, values)
+                    swapped.byteswap()
+                    values.release()
+                    block.release()
+                    values = swapped
+                elif not compressed:
+                    self.views.extend((values, block))
+                columns.append((name, values))
+        return columns
+
+    def rows(self, symbol):
+        """
+        Yield the records of `symbol` as tuples in column order
+        """
+        return zip(*[values for _, values in self.read(symbol)])
+
+    def close(self):
+        """
+        Release the views handed out by read and unmap the file
+        """
+        for view in self.views:
+            view.release()
+        self.views = []
+        if self.mm is not None:
+            self.mm.close()
+        self.file_handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
@@ -0,0 +1,105 @@
+"""
+Columnar storage of the entries read from EMASTER/XMASTER files.
+"""
+
+import datetime
+from array import array
+
+
+class SymbolTable(object):
+    """
+    I keep every field of the master file entries in its own compact column
+    instead of one Python object per symbol. DataFileInfo objects are created
+    on demand as lightweight views over a single row.
+
+    Private Variables
+    ----------
+    file_num : array('H')
+        Symbol numbers
+
+    num_fields : array('B')
+        Number of columns in DAT file, 0 when unknown
+
+    stock_symbol : list(str)
+        Stock symbols
+
+    stock_name : list(str)
+        Full stock names
+
+    time_frame : bytearray
+        Tick time frames, one byte per symbol (f.e. b'D' means EOD data)
+
+    first_date : array('l')
+        First tick dates as proleptic Gregorian ordinals, 0 when unknown
+
+    last_date : array('l')
+        Last tick dates as proleptic Gregorian ordinals, 0 when unknown
+
+    """
+    def __init__(self):
+        self.file_num = array('H')
+        self.num_fields = array('B')
+        self.stock_symbol = []
+        self.stock_name = []
+        self.time_frame = bytearray()
+        self.first_date = array('l')
+        self.last_date = array('l')
+
+    @staticmethod
+    def _ordinal(date):
+        return date is not None and date.toordinal() or 0
+
+    def append(self, file_num=0, num_fields=None, stock_symbol=None, stock_name=None,
+               time_frame=None, first_date=None, last_date=None):
+        """
+        Add a row and return its index
+        """
+        self.file_num.append(file_num or 0)
+        self.num_fields.append(num_fields or 0)
+        self.stock_symbol.append(stock_symbol)
+        self.stock_name.append(stock_name)
+        self.time_frame.append(time_frame and time_frame[0] or 0)
+        self.first_date.append(self._ordinal(first_date))
+        self.last_date.append(self._ordinal(last_date))
+        return len(self.file_num) - 1
+
+    def get(self, field, index):
+        """
+        Return the value of `field` in row `index` converted back to the DataFileInfo type
+        """
+        value = getattr(self, field)[index]
+        if field in ('first_date', 'last_date'):
+            return value and datetime.date.fromordinal(value) or None
+        if field == 'time_frame':
+            return value and bytes((value,)) or None
+        if field == 'num_fields':
+            return value or None
+        return value
+
+    def set(self, field, index, value):
+        """
+        Store `value` of `field` in row `index`
+        """
+        if field in ('first_date', 'last_date'):
+            value = self._ordinal(value)
+        elif field == 'time_frame':
+            value = value and value[0] or 0
+        elif field in ('file_num', 'num_fields'):
+            value = value or 0
+        getattr(self, field)[index] = value
+
+    def __len__(self):
+        return len(self.file_num)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('symbol table index out of range')
+        from .files import DataFileInfo
+        return DataFileInfo(self, index)
+
+    def __iter__(self):
+        from .files import DataFileInfo
+        for index in range(len(self)):
+            yield DataFileInfo(self, index)
@@ -3,7 +3,9 @@ Helper methods
 """
 
 import struct
+import sys
 import datetime
+from array import array
 
 
 def fmsbin2ieee(b):
@@ -36,6 +38,54 @@ def fmsbin2ieee(b):
     return struct.unpack('f', bytes2)[0]
 
 
+# byte translation tables used by fmsbin2ieee_array, MBF byte 2 holds the sign and the
+# top 7 mantissa bits, byte 3 the exponent (biased by 2 more than IEEE)
+_MBF_MANTISSA = bytes(b & 0x7f for b in range(256))
+_MBF_SIGN = bytes(b & 0x80 for b in range(256))
+_MBF_EXP_LOW = bytes(b and (((b - 2) & 1) << 7) for b in range(256))
+_MBF_EXP_HIGH = bytes(b and ((((b - 2) & 0xff) >> 1) | (b == 1 and 0x80 or 0)) for b in range(256))
+
+
+def _or_bytes(a, b):
+    """
+    Bitwise OR of two equally long byte strings
+    """
+    return (int.from_bytes(a, 'little') | int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+def fmsbin2ieee_array(b):
+    """
+    Convert a buffer of consecutive 4-byte Microsoft Binary floating point
+    numbers at once, without a Python call per number.
+
+    Gives the same results as fmsbin2ieee, except for numbers with a zero
+    exponent byte that decode to zero (or a denormal close to zero).
+
+    Parameters
+    ----------
+    b : bytes
+        Length must be a multiple of 4
+
+    Returns
+    -------
+    array('f')
+
+    """
+    b = bytes(b)
+    exp = b[3::4]
+    high = b[2::4]
+    ieee = bytearray(len(b))
+    ieee[0::4] = b[0::4]
+    ieee[1::4] = b[1::4]
+    ieee[2::4] = _or_bytes(high.translate(_MBF_MANTISSA), exp.translate(_MBF_EXP_LOW))
+    ieee[3::4] = _or_bytes(high.translate(_MBF_SIGN), exp.translate(_MBF_EXP_HIGH))
+    values = array('f')
+    values.frombytes(ieee)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
 def float2date(date):
     """
     Metastock stores date as a float number.
@@ -58,6 +108,24 @@ def float2date(date):
     return datetime.date(year, month, day)
 
 
+def date2float(date):
+    """
+    Inverse of float2date, convert a python datetime.date object
+    to the number used by Metastock to store dates.
+
+    Parameters
+    ----------
+    date : datetime.date
+
+    Returns
+    -------
+    int
+        YYYMMDD format (years since 1900)
+
+    """
+    return (date.year - 1900) * 10000 + date.month * 100 + date.day
+
+
 def int2date(date):
     """
     Int to date use in XMASTER header format.
@@ -97,6 +165,44 @@ def float2time(time):
     return datetime.time(hour, minute)
 
 
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def date2minutes(date):
+    """
+    Convert a python datetime.date object to the number of minutes
+    since 1970-01-01, the representation of numpy datetime64[m]
+
+    Parameters
+    ----------
+    date : datetime.date
+
+    Returns
+    -------
+    int
+
+    """
+    return (date.toordinal() - _EPOCH_ORDINAL) * 1440
+
+
+def minutes2datetime(minutes):
+    """
+    Inverse of date2minutes, including the time of the day
+
+    Parameters
+    ----------
+    minutes : int
+        Minutes since 1970-01-01
+
+    Returns
+    -------
+    datetime.datetime
+
+    """
+    days, minutes = divmod(minutes, 1440)
+    return datetime.datetime.fromordinal(_EPOCH_ORDINAL + days) + datetime.timedelta(minutes=minutes)
+
+
 def readstr(b):
     """
     Read string block from MetaStock data
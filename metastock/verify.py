@@ -0,0 +1,342 @@
+"""
+DAT integrity scanner and quarantine of corrupt symbols.
+"""
+
+import datetime
+import json
+import mmap
+import operator
+import os.path
+import time
+from itertools import repeat
+
+from .stats import RunStats
+from .utils import fmsbin2ieee_array, readshort
+
+ERROR = 'error'
+WARNING = 'warning'
+
+# translation tables over the MBF exponent byte plane: 0 encodes zero (any mantissa
+# bits are garbage), 1 is below the float32 range and decodes to NaN/inf
+_EXP_ZERO = bytes(b == 0 and 0xff or 0 for b in range(256))
+_EXP_ONE = bytes(b == 1 and 0xff or 0 for b in range(256))
+_NONZERO = bytes(b and 0xff or 0 for b in range(256))
+
+
+def _and_bytes(a, b):
+    """
+    Bitwise AND of two equally long byte strings
+    """
+    return (int.from_bytes(a, 'little') & int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+def _or_planes(*planes):
+    value = 0
+    for plane in planes:
+        value |= int.from_bytes(plane, 'little')
+    return value.to_bytes(len(planes[0]), 'little')
+
+
+def _first_set(mask):
+    """
+    Index of the first non-zero byte of `mask`, None when all bytes are zero
+    """
+    stripped = mask.lstrip(b'\0')
+    if not stripped:
+        return None
+    return len(mask) - len(stripped)
+
+
+def _first_true(flags, offset=0):
+    for i, flag in enumerate(flags):
+        if flag:
+            return i + offset
+    return None
+
+
+def _valid_date(value):
+    """
+    Check a date stored in Metastock YYYMMDD format
+    """
+    if value != value or value <= 0 or value != int(value):
+        return False
+    year, rest = divmod(int(value), 10000)
+    month, day = divmod(rest, 100)
+    try:
+        datetime.date(1900 + year, month, day)
+    except ValueError:
+        return False
+    return True
+
+
+def _valid_time(value):
+    """
+    Check a time stored in Metastock HHMMSS format
+    """
+    if value != value or value < 0 or value != int(value):
+        return False
+    hour, rest = divmod(int(value), 10000)
+    minute, second = divmod(rest, 100)
+    return hour < 24 and minute < 60 and second < 60
+
+
+def _issue(check, severity, count, first=None, detail=None):
+    issue = {'check': check, 'severity': severity, 'count': count}
+    if first is not None:
+        issue['first'] = first
+    if detail is not None:
+        issue['detail'] = detail
+    return issue
+
+
+def scan_dat(input_dir, stock):
+    """
+    Check the DAT/MWD file of a symbol without decoding it row by row
+
+    Every check works on whole byte planes or columns at once: the header
+    record count against the file size, MBF values outside the float32
+    range (NaN/denormal), invalid and non-increasing dates (timestamps for
+    intraday files), high < low and open/close outside [low, high].
+
+    Parameters
+    ----------
+    input_dir : str
+        Path of MetaStock directory input
+
+    stock : DataFileInfo
+        Its columns are loaded from the DOP file when needed
+
+    Returns
+    -------
+    tuple(int, list(dict))
+        Number of records scanned and the issues found, every issue has a
+        'check' name, a 'severity' ('error' or 'warning'), a 'count' and
+        optionally the index of the 'first' bad record and a 'detail'
+
+    """
+    issues = []
+    if stock.columns is None:
+        stock._load_columns(input_dir)
+    layout = stock.layout
+    path = stock.dat_path(input_dir)
+    if not os.path.isfile(path):
+        return 0, [_issue('missing', ERROR, 1, detail='%s not found' % os.path.basename(path))]
+    size = os.path.getsize(path)
+    if size < stock.header_size:
+        return 0, [_issue('header', ERROR, 1, detail='file has %d bytes, the header needs %d'
+                                                       % (size, stock.header_size))]
+
+    with open(path, 'rb') as file_handle:
+        header = file_handle.read(stock.header_size)
+        expected = max(readshort(header[2:4]) - 1, 0)
+        available, partial = divmod(size - stock.header_size, layout.record_size)
+        if available < expected:
+            issues.append(_issue('record_count', ERROR, expected - available, available,
+                                 'header says %d records, file holds %d' % (expected, available)))
+        elif available > expected:
+            issues.append(_issue('record_count', WARNING, available - expected, expected,
+                                 'header says %d records, file holds %d' % (expected, available)))
+        if partial:
+            issues.append(_issue('partial_record', WARNING, 1, available,
+                                 '%d trailing bytes' % partial))
+        count = min(expected, available)
+        if not count:
+            return 0, issues
+        with mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = mm[stock.header_size:stock.header_size + count * layout.record_size]
+
+    num_fields = layout.num_fields
+    exponents = data[3::4]
+    mask = exponents.translate(_EXP_ONE)
+    bad = len(mask) - mask.count(0)
+    if bad:
+        issues.append(_issue('non_finite', ERROR, bad, _first_set(mask) // num_fields,
+                             'MBF exponent 1 decodes to NaN/inf'))
+    mask = _and_bytes(exponents.translate(_EXP_ZERO),
+                      _or_planes(data[0::4], data[1::4], data[2::4]).translate(_NONZERO))
+    bad = len(mask) - mask.count(0)
+    if bad:
+        issues.append(_issue('denormal', WARNING, bad, _first_set(mask) // num_fields,
+                             'MBF zero with non-zero mantissa bits'))
+
+    words = fmsbin2ieee_array(data)
+    fields = dict((name, words[i::num_fields]) for i, name in enumerate(layout.names))
+
+    dates = fields.get('DATE')
+    if dates is not None:
+        invalid = set(value for value in set(dates) if not _valid_date(value))
+        if invalid:
+            issues.append(_issue('invalid_date', ERROR, sum(map(invalid.__contains__, dates)),
+                                 _first_true(map(invalid.__contains__, dates))))
+        keys = dates
+        times = fields.get('TIME')
+        if times is not None:
+            invalid = set(value for value in set(times) if not _valid_time(value))
+            if invalid:
+                issues.append(_issue('invalid_time', ERROR, sum(map(invalid.__contains__, times)),
+                                     _first_true(map(invalid.__contains__, times))))
+            keys = [date * 1000000 + time for date, time in zip(dates, times)]
+        bad = sum(map(operator.le, keys[1:], keys))
+        if bad:
+            issues.append(_issue('non_monotonic', ERROR, bad, _first_true(map(operator.le, keys[1:], keys), 1),
+                                 'dates must be strictly increasing'))
+
+    highs, lows = fields.get('HIGH'), fields.get('LOW')
+    if highs is not None and lows is not None:
+        bad = sum(map(operator.lt, highs, lows))
+        if bad:
+            issues.append(_issue('high_low', WARNING, bad, _first_true(map(operator.lt, highs, lows)),
+                                 'high < low'))
+        for name in ('OPEN', 'CLOSE'):
+            prices = fields.get(name)
+            if prices is None:
+                continue
+            flags = [below or above for below, above in
+                     zip(map(operator.lt, prices, lows), map(operator.gt, prices, highs))]
+            bad = sum(flags)
+            if bad:
+                issues.append(_issue('price_range', WARNING, bad, _first_true(flags),
+                                     '%s outside [low, high]' % name.lower()))
+        bad = sum(map(operator.le, lows, repeat(0.0)))
+        if bad:
+            issues.append(_issue('price_range', WARNING, bad, _first_true(map(operator.le, lows, repeat(0.0))),
+                                 'low <= 0'))
+    return count, issues
+
+
+class Quarantine(object):
+    """
+    Symbols whose DAT files failed verification, kept next to the outputs
+    so that the conversion and the upload skip them until they verify again
+
+    Private Variables
+    ----------
+    path : str
+        JSON file where the quarantine is stored
+
+    entries : dict
+        Mapping '<input_dir>:<file_num>' -> symbol and issues
+
+    """
+    FILENAME = '.ms2csv-quarantine.json'
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                print('Ignoring unreadable quarantine %s' % path)
+
+    @staticmethod
+    def key(input_dir, stock):
+        return '%s:%d' % (input_dir, stock.file_num)
+
+    def add(self, input_dir, stock, issues):
+        self.entries[self.key(input_dir, stock)] = {
+            'symbol': stock.stock_symbol,
+            'issues': issues,
+        }
+
+    def discard(self, input_dir, stock):
+        self.entries.pop(self.key(input_dir, stock), None)
+
+    def symbols(self):
+        """
+        Set of quarantined symbol names
+        """
+        return set(entry['symbol'] for entry in self.entries.values())
+
+    def save(self):
+        """
+        Write the quarantine file, replacing the previous one atomically
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+class IntegrityScanner(object):
+    """
+    Verify symbols before they are converted and write a JSON lines report
+
+    A symbol with at least one error is quarantined, warnings are only reported.
+
+    Private Variables
+    ----------
+    report_path : str
+        Where to write the JSON lines report ('-' means stdout), None to skip the report
+
+    quarantine : Quarantine, optional
+        Updated with the result of every scanned symbol
+
+    stats : RunStats
+        Collect 'verify' timing
+
+    results : list(dict)
+        Report entry of every scanned symbol
+
+    """
+    def __init__(self, report_path=None, quarantine=None, stats=None):
+        self.report_path = report_path
+        self.quarantine = quarantine
+        self.stats = stats or RunStats()
+        self.results = []
+        self.started = time.perf_counter()
+
+    def check(self, input_dir, stock):
+        """
+        Scan a symbol and record the result
+
+        Returns
+        -------
+        bool
+            False when the symbol has been quarantined
+
+        """
+        with self.stats.measure('verify', stock.stock_symbol) as m:
+            try:
+                records, issues = scan_dat(input_dir, stock)
+            except Exception as e:
+                records, issues = 0, [_issue('unreadable', ERROR, 1, detail='%s: %s' % (type(e).__name__, e))]
+            m.records = records
+        errors = [issue for issue in issues if issue['severity'] == ERROR]
+        status = errors and 'quarantined' or issues and 'warning' or 'ok'
+        self.results.append({'type': 'symbol', 'directory': input_dir, 'symbol': stock.stock_symbol,
+                             'file_num': stock.file_num, 'records': records, 'status': status,
+                             'issues': issues})
+        if errors:
+            print('Quarantined %s (fileNo %d): %s' % (stock.stock_symbol, stock.file_num,
+                                                      ', '.join(issue['check'] for issue in errors)))
+        if self.quarantine is not None:
+            if errors:
+                self.quarantine.add(input_dir, stock, issues)
+            else:
+                self.quarantine.discard(input_dir, stock)
+        return not errors
+
+    def summary(self):
+        run = {'type': 'run', 'scanned': len(self.results),
+               'wall_seconds': round(time.perf_counter() - self.started, 6)}
+        for status in ('ok', 'warning', 'quarantined'):
+            run[status] = sum(1 for result in self.results if result['status'] == status)
+        return run
+
+    def write_report(self):
+        """
+        Write the symbol entries and the run summary as JSON lines
+        """
+        run = self.summary()
+        print('Symbols verified: %d, with warnings: %d, quarantined: %d'
+              % (run['scanned'], run['warning'], run['quarantined']))
+        if self.report_path is None:
+            return
+        lines = [json.dumps(entry, sort_keys=True) for entry in self.results + [run]]
+        if self.report_path == '-':
+            print('\n'.join(lines))
+            return
+        with open(self.report_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
@@ -0,0 +1,309 @@
+"""
+Watch MetaStock directories and convert changed symbols continuously.
+"""
+
+import os
+import os.path
+import select
+import struct
+import time
+
+from .changes import ChangeSet
+from .files import MSEMasterFile, MSXMasterFile
+
+
+class InotifyWatcher(object):
+    """
+    Report files closed after writing or moved into the watched directories
+    and the directories created there (Linux only)
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    event_header = struct.Struct('iIII')
+
+    def __init__(self, directories):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self.fd = libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.paths = {}
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                                        self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for %s' % directory)
+            self.paths[wd] = directory
+
+    def wait(self, timeout):
+        """
+        Return the set of paths changed within `timeout` seconds
+        """
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & self.IN_CREATE and not mask & self.IN_ISDIR:
+                continue
+            if wd in self.paths and name:
+                changed.add(os.path.join(self.paths[wd], os.fsdecode(name)))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """
+    Report changed files by comparing size and mtime of every directory entry,
+    and the new sub directories
+    """
+    def __init__(self, directories, interval=1.0):
+        self.directories = directories
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for directory in self.directories:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        st = entry.stat()
+                        snapshot[entry.path] = (st.st_size, st.st_mtime_ns)
+                    elif entry.is_dir():
+                        snapshot[entry.path] = None
+        return snapshot
+
+    def wait(self, timeout):
+        """
+        Return the set of paths changed within `timeout` seconds
+        """
+        time.sleep(min(timeout, self.interval))
+        snapshot = self._scan()
+        changed = set(path for path, state in snapshot.items()
+                      if path not in self.snapshot or self.snapshot[path] != state)
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class ConversionDaemon(object):
+    """
+    Keep the master files of every MetaStock directory in memory and
+    reconvert the affected symbols when files change.
+
+    Bursts of changes (f.e. an rsync run) are collected until no new change
+    arrives for `debounce` seconds and converted in one batch. EMASTER/XMASTER
+    are reloaded only when they change; then only the entries that differ from
+    the previous version are converted, together with the symbols whose data
+    files changed. A directory created or a master file written where there
+    was none rescans the input directory, every symbol of a new MetaStock
+    directory is converted.
+
+    A batch that fails is logged and each of its files is retried on its own,
+    after 2, 4, 8... debounce periods (at most MAX_BACKOFF seconds); a file
+    that still fails after MAX_RETRIES retries is dropped until it changes
+    again.
+
+    Private Variables
+    ----------
+    options
+        ms2csv command line options
+
+    symbols : list(str)
+        Symbols to convert, all symbols when options.all is set
+
+    masters : dict
+        Mapping directory -> list of loaded master files
+
+    directories : set(str)
+        Every directory under options.input_dir, the watched ones
+
+    watcher : InotifyWatcher or PollingWatcher
+        Watcher of `directories`, replaced when they change
+
+    """
+    MAX_RETRIES = 5
+    MAX_BACKOFF = 300.0
+
+    def __init__(self, options, symbols, debounce=2.0, polling=False, interval=1.0):
+        self.options = options
+        self.symbols = symbols
+        self.debounce = debounce
+        self.polling = polling
+        self.interval = interval
+        self.masters = {}
+        self.directories = set()
+        self.watcher = None
+        for directory in self._scan():
+            self._load_masters(directory)
+
+    def _scan(self):
+        """
+        Walk options.input_dir into `directories`, return the MetaStock directories not loaded yet
+        """
+        directories = set()
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.options.input_dir):
+            directory = os.path.realpath(dirpath)
+            directories.add(directory)
+            if ('EMASTER' in filenames or 'XMASTER' in filenames) and directory not in self.masters:
+                found.append(directory)
+        self.directories = directories
+        return found
+
+    def _load_masters(self, directory):
+        subdir = os.path.relpath(directory, self.options.input_dir)
+        masters = []
+        if os.path.isfile(os.path.join(directory, 'EMASTER')):
+            masters.append(MSEMasterFile(self.options, subdir))
+        if os.path.isfile(os.path.join(directory, 'XMASTER')):
+            masters.append(MSXMasterFile(self.options, subdir))
+        self.masters[directory] = masters
+
+    @staticmethod
+    def _entries(masters):
+        return dict((stock.file_num, (stock.stock_symbol, stock.stock_name, stock.time_frame,
+                                      stock.num_fields, stock.first_date, stock.last_date))
+                    for master in masters for stock in master.stocks)
+
+    def _watcher(self):
+        directories = sorted(self.directories)
+        if not self.polling:
+            try:
+                return InotifyWatcher(directories)
+            except OSError as e:
+                print('inotify unavailable (%s), falling back to polling' % e)
+        return PollingWatcher(directories, self.interval)
+
+    def _rewatch(self):
+        """
+        Watch the directories found by the last _scan
+        """
+        if self.watcher is not None:
+            self.watcher.close()
+        self.watcher = self._watcher()
+
+    def process(self, paths):
+        """
+        Convert the symbols affected by the changed `paths`
+        """
+        changes = ChangeSet(self.options.input_dir)
+        for path in paths:
+            changes.add(path)
+
+        batch = ChangeSet(self.options.input_dir)
+        # masters replaced by this batch, put back when it fails so that the retry sees the same differences
+        previous = {}
+        try:
+            if any(os.path.isdir(path) for path in paths) or \
+                    any(directory not in self.masters for directory in changes.directories):
+                directories = self.directories
+                found = self._scan()
+                if self.directories != directories:
+                    self._rewatch()
+                for directory in found:
+                    previous[directory] = None
+                    self._load_masters(directory)
+                    batch.masters.add(directory)
+                    batch.directories[directory] = set()
+                    print('New MetaStock directory %s' % directory)
+
+            for directory, file_nums in changes.directories.items():
+                if directory not in self.masters or directory in batch.masters:
+                    continue
+                if directory in changes.masters:
+                    previous[directory] = self.masters[directory]
+                    before = self._entries(self.masters[directory])
+                    self._load_masters(directory)
+                    after = self._entries(self.masters[directory])
+                    file_nums = file_nums | set(num for num, entry in after.items() if before.get(num) != entry)
+                if file_nums:
+                    batch.directories[directory] = file_nums
+
+            self.options.changes = batch
+            for directory in sorted(batch.directories):
+                for master in self.masters[directory]:
+                    master.output_ascii(self.options.all, self.symbols)
+            if self.options.cache is not None:
+                self.options.cache.save()
+            if getattr(self.options, 'indicator_state', None) is not None:
+                self.options.indicator_state.save()
+            if getattr(self.options, 'scanner', None) is not None:
+                self.options.scanner.quarantine.save()
+                self.options.scanner.write_report()
+            self.options.stats.write_report()
+        except BaseException:
+            for directory, masters in previous.items():
+                if masters is None:
+                    self.masters.pop(directory, None)
+                else:
+                    self.masters[directory] = masters
+            raise
+
+    def _attempt(self, paths, retries, now):
+        """
+        Process `paths`, schedule their retry in `retries` (path -> [failures, time of the next try]) when it fails
+        """
+        try:
+            self.process(paths)
+        except Exception as e:
+            print('Conversion of %d changed files failed (%s: %s)' % (len(paths), type(e).__name__, e))
+            for path in paths:
+                failures = retries.get(path, [0])[0] + 1
+                if failures > self.MAX_RETRIES:
+                    print('Giving up on %s after %d failures, waiting for it to change again' % (path, failures))
+                    del retries[path]
+                else:
+                    retries[path] = [failures, now + min(self.debounce * 2 ** failures, self.MAX_BACKOFF)]
+        else:
+            for path in paths:
+                retries.pop(path, None)
+
+    def run(self):
+        """
+        Watch until interrupted
+        """
+        self._rewatch()
+        print('Watching %d directories' % len(self.masters))
+        pending = set()
+        retries = {}
+        last_change = None
+        try:
+            while True:
+                changed = self.watcher.wait(self.debounce)
+                now = time.monotonic()
+                if changed:
+                    pending |= changed
+                    last_change = now
+                    # a file that changed again starts over
+                    for path in changed:
+                        retries.pop(path, None)
+                elif pending and now - last_change >= self.debounce:
+                    self._attempt(pending, retries, now)
+                    pending = set()
+                # failed files are retried one by one, a corrupt file does not hold back the others
+                for path in sorted(path for path, (_, retry_at) in retries.items()
+                                   if retry_at <= now and path not in pending):
+                    self._attempt(set([path]), retries, now)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.watcher.close()
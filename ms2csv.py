@@ -6,17 +6,80 @@ in text format.
 
 import sys
 import os.path
-from optparse import OptionParser
+import datetime
+from optparse import OptionParser, OptionValueError
 
-from metastock.files import MSEMasterFile, MSXMasterFile
+from metastock.catalog import SymbolCatalog, print_symbols
+from metastock.stats import RunStats
+from metastock.cache import ConversionCache
+from metastock.changes import ChangeSet
+from metastock.verify import IntegrityScanner, Quarantine
+from metastock.shard import Shard, ShardPlan, parse_shard, check_shards, print_check, unit_key
 
 Usage = """usage: %prog [options] [symbol1] [symbol2] ....
 
 Examples:
     %prog -p 2 --all        extract all symbols from EMASTER file
     %prog FW20 "S&P500"     extract FW20 and S&P500 from EMASTER file
+    %prog --from 20190101 --to 20191231 PTT
+                            extract the 2019 candles of PTT
+    %prog -a -n 20          extract the latest 20 candles of every symbol
+    %prog -a -f store       pack every market into a single <MARKET>.MSS file
+    %prog -a -f panel       write date x symbol matrices of every market
+    %prog -a -z gzip        write gzip compressed <SYMBOL>.TXT.gz files
+    %prog -a --resample W,M also write weekly and monthly bars
+    %prog -a --indicators sma:20,ema:50,ret:1,atr:14
+                            append indicator columns to every output
+    %prog -a -r run.jsonl   extract all symbols and write a timing report
+    %prog -a -u             extract only the symbols changed since the last run
+    %prog -c rsync.log      extract only the symbols rsync changed
+    %prog -w -u             keep converting symbols whose files change
+    %prog --verify          check every DAT file and quarantine the corrupt symbols
+    %prog -a --verify       convert all symbols except the corrupt ones
+    %prog -a --shard 2/4    convert the second quarter of the symbols (by DAT size)
+    %prog --check-shards    check that the shard manifests in OUTPUT cover every symbol
+    %prog --no-catalog -l   list the symbols without using the symbol catalog
+    %prog --catalog /var/cache/ms.json -l
+                            list the symbols, keeping the symbol catalog up to date in that file
 """
 
+VERIFY_REPORT = 'ms2csv-verify.jsonl'
+
+
+def parse_date(option, opt_str, value, parser):
+    """
+    optparse callback converting YYYYMMDD or YYYY-MM-DD to datetime.date
+    """
+    try:
+        date = datetime.datetime.strptime(value.replace('-', ''), '%Y%m%d').date()
+    except ValueError:
+        raise OptionValueError('%s: invalid date %r, expected YYYYMMDD' % (opt_str, value))
+    setattr(parser.values, option.dest, date)
+
+
+def shard_weights(options):
+    """
+    Map the 'market/symbol' key of every symbol under options.input_dir to the size of its DAT file,
+    the market being the path of its directory relative to options.input_dir
+    """
+    from metastock.files import MSEMasterFile, MSXMasterFile
+    weights = {}
+    # the directories the conversion walk scans, options.input_dir itself is not one of them
+    subdirs = []
+    for dirpath, dirnames, filenames in os.walk(options.input_dir):
+        subdirs.extend(name for name in dirnames if name not in subdirs)
+    for subdir in subdirs:
+        masters = []
+        if os.path.isfile(os.path.join(options.input_dir, subdir, 'EMASTER')):
+            masters.append(MSEMasterFile(options, subdir))
+        if os.path.isfile(os.path.join(options.input_dir, subdir, 'XMASTER')):
+            masters.append(MSXMasterFile(options, subdir))
+        for master in masters:
+            for stock in master.stocks:
+                path = stock.dat_path(master.input_dir)
+                weights[unit_key(subdir, stock.stock_symbol)] = os.path.isfile(path) and os.path.getsize(path) or 0
+    return weights
+
 
 def main():
     """
@@ -34,26 +97,208 @@ def main():
                       help='input directory')
     parser.add_option('-o', '--output', type='string', dest='output_dir',
                       help='output directory')
+    parser.add_option('--from', type='string', dest='date_from', action='callback', callback=parse_date,
+                      help='extract only the candles on or after DATE_FROM (YYYYMMDD)')
+    parser.add_option('--to', type='string', dest='date_to', action='callback', callback=parse_date,
+                      help='extract only the candles on or before DATE_TO (YYYYMMDD)')
+    parser.add_option('-f', '--format', type='choice', choices=['txt', 'store', 'panel'], dest='format', default='txt',
+                      help='txt: one <SYMBOL>.TXT per symbol (default), '
+                           'store: one packed <MARKET>.MSS file per market, '
+                           'panel: date x symbol .npy matrices in a <MARKET>.panel directory per market')
+    parser.add_option('--panel-fields', type='string', dest='panel_fields',
+                      help='comma separated columns exported by --format panel (default: Open,High,Low,Close,Volume)')
+    parser.add_option('-z', '--compress', type='choice', choices=['gzip', 'zstd'], dest='compress',
+                      help='compress the outputs with gzip or zstd (requires the zstandard module) '
+                           'in background threads')
+    parser.add_option('--compress-workers', type='int', dest='compress_workers',
+                      help='number of compression threads (default: number of CPUs, at most 8)')
+    parser.add_option('-t', '--time-format', type='choice', choices=['hhmm', 'iso'], dest='time_format',
+                      help='intraday timestamps, hhmm: separate YYYYMMDD and HHMM fields (default), '
+                           'iso: a single YYYY-MM-DDTHH:MM field')
+    parser.add_option('--chunk-size', type='int', dest='chunk_records', default=16384,
+                      help='stream DAT/MWD files with more than CHUNK_RECORDS records in chunks '
+                           'of this size (default: 16384)')
+    parser.add_option('--resample', type='string', dest='resample',
+                      help='also write W (weekly), M (monthly) and/or Q (quarterly) bars, comma separated, '
+                           'to the weekly/monthly/quarterly sub directories of the output')
+    parser.add_option('--indicators', type='string', dest='indicators',
+                      help='append indicator columns, comma separated KIND:PERIOD with KIND one of '
+                           'sma, ema, ret, atr (f.e. sma:20,ema:50,ret:1,atr:14)')
+    parser.add_option('-n', '--last', type='int', dest='last',
+                      help='extract only the latest LAST candles of each symbol')
+    parser.add_option('--pipeline', action='store_true', dest='pipeline',
+                      help='overlap reading, decoding and writing of different symbols')
+    parser.add_option('--queue-depth', type='int', dest='queue_depth',
+                      help='symbols buffered between pipeline stages (default: 4)')
+    parser.add_option('-u', '--incremental', action='store_true', dest='incremental',
+                      help='skip symbols whose DAT/DOP files and options did not change since the last run')
+    parser.add_option('--cache', type='string', dest='cache_path',
+                      help='conversion cache file (default: OUTPUT/%s), implies --incremental' % ConversionCache.FILENAME)
+    parser.add_option('--hash', action='store_true', dest='hash',
+                      help='also compare a CRC32 of the DAT/DOP content, not only size and mtime')
+    parser.add_option('-c', '--changes', type='string', dest='changes_path',
+                      help='convert only the symbols whose files are listed in CHANGES '
+                           '(rsync --itemize-changes output or one path per line, - for stdin)')
+    parser.add_option('-w', '--watch', action='store_true', dest='watch',
+                      help='keep running and convert symbols as soon as their files change')
+    parser.add_option('--debounce', type='float', dest='debounce', default=2.0,
+                      help='seconds without new changes before a watch batch is converted (default: 2)')
+    parser.add_option('--poll', action='store_true', dest='poll',
+                      help='watch by polling the directories instead of using inotify')
+    parser.add_option('--verify', action='store_true', dest='verify',
+                      help='check the DAT files first and quarantine the corrupt symbols '
+                           '(only verify when no symbol, --all or --changes is given)')
+    parser.add_option('--verify-report', type='string', dest='verify_report',
+                      help='verification report as JSON lines (default: OUTPUT/%s, - for stdout)' % VERIFY_REPORT)
+    parser.add_option('--shard', type='string', dest='shard',
+                      help='convert only the I-th of N shards of the symbols (I/N), balanced by DAT file size, '
+                           'and write a completion manifest to the output directory')
+    parser.add_option('--check-shards', action='store_true', dest='check_shards',
+                      help='check that the shard manifests in the output directory cover every symbol once')
+    parser.add_option('--no-catalog', action='store_false', dest='catalog', default=True,
+                      help='walk the input directory and parse every master file for --list and single '
+                           'symbols instead of using the symbol catalog OUTPUT/%s' % SymbolCatalog.FILENAME)
+    parser.add_option('--catalog', type='string', dest='catalog_path',
+                      help='symbol catalog file (default: OUTPUT/%s), single symbol conversions update it, '
+                           '--list only reads it unless it is given here' % SymbolCatalog.FILENAME)
+    parser.add_option('-r', '--report', type='string', dest='report',
+                      help='write per-stage timing counters as JSON lines to REPORT (- for stdout)')
+    parser.add_option('--profile', type='string', dest='profile',
+                      help='run the conversion of PROFILE symbol under cProfile')
+    parser.add_option('--profile-output', type='string', dest='profile_output',
+                      help='cProfile statistics file (default: <PROFILE>.prof)')
 
     (options, args) = parser.parse_args()
 
     # check if the options are valid
-    if not (options.all or options.list or len(args) > 0):
+    if not (options.all or options.list or options.changes_path or options.watch or options.verify
+            or options.check_shards or len(args) > 0):
         parser.print_help()
         sys.exit(0)
 
+    # the conversion modules are imported when an option needs them, a --list or single symbol
+    # call answered from the symbol catalog starts without loading them
+    if options.compress:
+        from metastock.compress import check_method
+        try:
+            check_method(options.compress)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if options.format == 'panel':
+        if options.watch or options.resample or options.compress or options.indicators:
+            parser.error('--format panel cannot be combined with --watch, --resample, --compress or --indicators')
+        options.panel_fields = options.panel_fields and \
+            [field.strip() for field in options.panel_fields.split(',') if field.strip()] or None
+
+    if options.shard:
+        if options.watch or options.changes_path or options.format != 'txt':
+            parser.error('--shard cannot be combined with --watch, --changes or --format store/panel')
+        try:
+            options.shard = parse_shard(options.shard)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if options.resample:
+        from metastock.resample import check_periods
+        try:
+            options.resample = check_periods(options.resample)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if options.indicators:
+        from metastock.indicators import IndicatorState, parse_indicators
+        try:
+            options.indicators = parse_indicators(options.indicators)
+        except ValueError as e:
+            parser.error(str(e))
+
     options.input_dir = not options.input_dir and '.' or os.path.realpath(options.input_dir)
     options.output_dir = not options.output_dir and '.' or os.path.realpath(options.output_dir)
+    options.stats = RunStats(options.report, options.profile, options.profile_output)
 
-    print(type(options.input_dir))
-    print(options.input_dir)
-    print(os.walk(options.input_dir))
-    print(dir(os.walk(options.input_dir)))
-    for dirpath, dirnames, filenames in os.walk(options.input_dir):
-        for subdirname in dirnames:
+    if options.check_shards:
+        report = check_shards(options.output_dir, 'ms2csv', shard_weights(options))
+        print_check(report)
+        sys.exit(not report['ok'] and 1 or 0)
+
+    if options.shard:
+        index, count = options.shard
+        options.shard = Shard('ms2csv', index, ShardPlan(shard_weights(options), count))
+    options.changes = None
+    if options.changes_path:
+        options.changes = ChangeSet.load(options.changes_path, options.input_dir)
+        options.all = options.all or len(args) == 0
+    options.cache = None
+    if options.incremental or options.cache_path:
+        options.cache = ConversionCache(options.cache_path or os.path.join(options.output_dir, ConversionCache.FILENAME),
+                                        options.hash)
+
+    options.indicator_state = None
+    if options.indicators:
+        options.indicator_state = IndicatorState(os.path.join(options.output_dir, IndicatorState.FILENAME))
+
+    options.scanner = None
+    options.verify_only = options.verify and not (options.all or options.changes or options.watch or len(args) > 0)
+    if options.verify:
+        options.scanner = IntegrityScanner(options.verify_report or os.path.join(options.output_dir, VERIFY_REPORT),
+                                           Quarantine(os.path.join(options.output_dir, Quarantine.FILENAME)),
+                                           options.stats)
+        options.all = options.all or options.verify_only
+
+    if options.watch:
+        options.all = options.all or len(args) == 0
+        from metastock.watch import ConversionDaemon
+        ConversionDaemon(options, args, options.debounce, options.poll).run()
+        return
+
+    # list and single symbol commands find their directories in the catalog instead of walking the tree
+    if options.catalog and (options.list or not (options.all or options.changes or options.verify or options.shard
+                                                 or options.format == 'panel')):
+        options.catalog = SymbolCatalog(options.catalog_path or os.path.join(options.output_dir, SymbolCatalog.FILENAME),
+                                        options.input_dir)
+        options.catalog.refresh(options)
+    else:
+        options.catalog = None
+
+    if options.catalog is not None:
+        subdirnames = options.list and options.catalog.subdirs() or options.catalog.locate(args)
+        for subdirname in subdirnames:
             print('Starting to scan')
             print(subdirname)
             scan_directory(options, args, subdirname)
+        # listing writes nothing, unless the catalog file was given explicitly
+        if not options.list or options.catalog_path:
+            options.catalog.save()
+    elif options.changes is not None:
+        # only visit the directories rsync touched, files changed outside of a MetaStock directory are ignored
+        print('Changed directories: %d' % len(options.changes))
+        for directory in sorted(options.changes.directories):
+            if not any(os.path.isfile(os.path.join(directory, name)) for name in ('EMASTER', 'XMASTER')):
+                print('Skipping %s, no EMASTER/XMASTER file' % directory)
+                continue
+            print('Starting to scan')
+            print(directory)
+            scan_directory(options, args, os.path.relpath(directory, options.input_dir))
+    else:
+        for dirpath, dirnames, filenames in os.walk(options.input_dir):
+            for subdirname in dirnames:
+                print('Starting to scan')
+                print(subdirname)
+                scan_directory(options, args, subdirname)
+
+    if options.cache is not None and not (options.list or options.verify_only):
+        options.cache.save()
+    if options.indicator_state is not None and not (options.list or options.verify_only):
+        options.indicator_state.save()
+    if options.scanner is not None and not options.list:
+        options.scanner.quarantine.save()
+        options.scanner.write_report()
+    if options.shard and not options.list:
+        options.shard.write_manifest(options.output_dir)
+    options.stats.write_report()
+    if options.verify_only and options.scanner.summary()['quarantined']:
+        sys.exit(1)
 
 
 def scan_directory(options, args, subdirname=None):
@@ -76,25 +321,48 @@ def scan_directory(options, args, subdirname=None):
                 os.path.join(options.input_dir, subdirname) or \
                 os.path.join(options.input_dir)
 
-    if os.path.isfile(os.path.join(fullpath, 'EMASTER')):
+    # with --format panel, the symbols of both master files go to a single panel
+    masters = []
+    catalog = getattr(options, 'catalog', None)
+    if os.path.isfile(os.path.join(fullpath, 'EMASTER')) and options.list and catalog is not None:
+        # listed from the catalog, without parsing the master file again
+        print_symbols(catalog.symbols(subdirname, 'EMASTER'))
+    elif os.path.isfile(os.path.join(fullpath, 'EMASTER')):
+        from metastock.files import MSEMasterFile
         em_file = MSEMasterFile(options, subdirname)
         # list the symbols or extract the data
         if options.list:
             em_file.list_all_symbols()
+        elif options.verify_only:
+            em_file.verify(options.all, args)
+        elif options.format == 'panel':
+            masters.append(em_file)
         else:
             em_file.output_ascii(options.all, args)
-    else:
-        print('Could not found file %s in path %s' % ('EMASTER', options.input_dir, subdirname))
+    elif not os.path.isfile(os.path.join(fullpath, 'XMASTER')):
+        print('Could not found file %s in path %s' % ('EMASTER', fullpath))
         exit(1)
 
-    if os.path.isfile(os.path.join(fullpath, 'XMASTER')):
+    if os.path.isfile(os.path.join(fullpath, 'XMASTER')) and options.list and catalog is not None:
+        # listed from the catalog, without parsing the master file again
+        print_symbols(catalog.symbols(subdirname, 'XMASTER'))
+    elif os.path.isfile(os.path.join(fullpath, 'XMASTER')):
+        from metastock.files import MSXMasterFile
         xm_file = MSXMasterFile(options, subdirname)
         # list the symbols or extract the data
         if options.list:
             xm_file.list_all_symbols()
+        elif options.verify_only:
+            xm_file.verify(options.all, args)
+        elif options.format == 'panel':
+            masters.append(xm_file)
         else:
             xm_file.output_ascii(options.all, args)
 
+    if masters:
+        from metastock.panel import PanelBuilder
+        PanelBuilder(masters, options.panel_fields, options.stats).build(options.output_dir, options.all, args)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Command line tool converting metastock files and uploading every symbol
+to MySQL as soon as its csv is written.
+"""
+
+import sys
+import os.path
+from optparse import OptionParser
+
+from metastock.stats import RunStats
+from database.orchestrator import ConvertUploadPipeline
+
+Usage = """usage: %prog [options] [market1] [market2] ....
+
+Examples:
+    %prog -a -i /ms -o /csv             convert and upload every market under /ms
+    %prog -i /ms -o /csv SET            convert and upload the SET market
+    %prog -a -i /ms -o /csv -s PTT      convert and upload PTT only
+    %prog -a --upload-workers 4         upload over 4 database connections
+"""
+
+
+def main():
+    parser = OptionParser(usage=Usage)
+    parser.add_option('-c', '--config', type='string', dest='config_path',
+                      help='database config')
+    parser.add_option('-a', '--all', action='store_true', dest='all',
+                      help='convert and upload all markets')
+    parser.add_option('-i', '--input', type='string', dest='input_dir',
+                      help='metastock input directory')
+    parser.add_option('-o', '--output', type='string', dest='output_dir',
+                      help='csv output directory, one sub directory per market')
+    parser.add_option('-s', '--symbol', action='append', dest='symbols',
+                      help='convert and upload only this symbol (may be repeated)')
+    parser.add_option('-p', '--precision', type='int', dest='precision',
+                      help='round the floating point numbers to PRECISION digits after the decimal point (default: 2)')
+    parser.add_option('-f', '--force', action='store_true', dest='force',
+                      help='force replace')
+    parser.add_option('--convert-workers', type='int', dest='convert_workers', default=2,
+                      help='number of conversion processes (default: 2)')
+    parser.add_option('--upload-workers', type='int', dest='upload_workers', default=2,
+                      help='number of upload threads, each with its own database connection (default: 2)')
+    parser.add_option('--queue-depth', type='int', dest='queue_depth', default=8,
+                      help='converted symbols waiting for an upload before the conversions block (default: 8)')
+    parser.add_option('-r', '--report', type='string', dest='report',
+                      help='write per-stage timing counters as JSON lines to REPORT (- for stdout)')
+    (options, args) = parser.parse_args()
+
+    # check if the options are valid
+    if not (options.all or len(args) > 0):
+        parser.print_help()
+        sys.exit(0)
+
+    options.config_path = not options.config_path and 'dbconfig.json' or os.path.realpath(options.config_path)
+    options.input_dir = not options.input_dir and '.' or os.path.realpath(options.input_dir)
+    options.output_dir = not options.output_dir and '.' or os.path.realpath(options.output_dir)
+    options.stats = RunStats(options.report)
+
+    pipeline = ConvertUploadPipeline(options, options.convert_workers, options.upload_workers,
+                                     options.queue_depth, options.stats)
+    progress = pipeline.run(not options.all and args or None, options.symbols)
+    options.stats.write_report()
+    if progress['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
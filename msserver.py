@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Command line tool serving candle queries from metastock files
+to local tools over HTTP or a Unix socket.
+"""
+
+import sys
+import os.path
+import signal
+import time
+from optparse import OptionParser
+
+from metastock.server import CandleService, serve
+from metastock.shm import SharedMarketPublisher, unlink_manifest
+
+Usage = """usage: %prog [options]
+
+Examples:
+    %prog -i /path                      serve on http://127.0.0.1:8765
+    %prog -i /path -s /tmp/ms.sock      serve on a Unix socket
+    %prog -i /path -m 1024              keep up to 1 GB of decoded symbols in memory
+    %prog -i /path --shm /dev/shm/ms.json
+                                        decode every market into shared memory until interrupted
+    %prog --shm-unlink /dev/shm/ms.json remove the segments left by --shm-detach
+
+Queries:
+    GET /markets
+    GET /symbols?market=SET
+    GET /candles?symbol=PTT&market=SET&from=20190101&to=20191231&last=20
+    GET /stats
+"""
+
+
+def main():
+    parser = OptionParser(usage=Usage)
+    parser.add_option('-i', '--input', type='string', dest='input_dir',
+                      help='input directory')
+    parser.add_option('-H', '--host', type='string', dest='host', default='127.0.0.1',
+                      help='address to listen on (default: 127.0.0.1)')
+    parser.add_option('-P', '--port', type='int', dest='port', default=8765,
+                      help='port to listen on (default: 8765)')
+    parser.add_option('-s', '--socket', type='string', dest='socket_path',
+                      help='listen on a Unix socket instead of TCP')
+    parser.add_option('-m', '--cache-mb', type='int', dest='cache_mb', default=256,
+                      help='memory budget of the decoded symbols cache in MB (default: 256)')
+    parser.add_option('--shm', type='string', dest='shm_manifest',
+                      help='instead of serving queries, decode every market into shared memory segments, '
+                           'describe them in the SHM_MANIFEST JSON file and keep them until interrupted')
+    parser.add_option('--shm-detach', action='store_true', dest='shm_detach',
+                      help='with --shm, exit once published and leave the segments alive')
+    parser.add_option('--shm-unlink', type='string', dest='shm_unlink',
+                      help='remove the segments listed in a manifest written by --shm --shm-detach')
+    (options, args) = parser.parse_args()
+
+    if args:
+        parser.print_help()
+        sys.exit(0)
+
+    if options.shm_unlink:
+        print('Unlinked %d segments' % unlink_manifest(options.shm_unlink))
+        return
+
+    options.input_dir = not options.input_dir and '.' or os.path.realpath(options.input_dir)
+    options.precision = None
+
+    if options.shm_manifest:
+        publish_shared(options)
+        return
+
+    service = CandleService(options, options.cache_mb * 1024 * 1024)
+    serve(service, options.host, options.port, options.socket_path)
+
+
+def publish_shared(options):
+    """
+    Publish the decoded markets in shared memory, hold the segments until
+    SIGINT/SIGTERM unless options.shm_detach is set
+    """
+    if os.path.exists(options.shm_manifest):
+        sys.exit('%s exists: stop its loader or remove it with --shm-unlink first' % options.shm_manifest)
+    publisher = SharedMarketPublisher(options)
+    manifest = publisher.publish(options.shm_manifest)
+    size = sum(segment['size'] for segment in manifest['segments'].values())
+    print('Published %d markets (%d bytes) in %s' % (len(manifest['markets']), size, options.shm_manifest))
+    if options.shm_detach:
+        publisher.detach()
+        return
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        publisher.unlink()
+        print('Unlinked the shared memory segments')
+
+
+if __name__ == '__main__':
+    main()
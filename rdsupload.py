@@ -4,15 +4,22 @@ Command line tool used to upload csv data to MySQL
 """
 
 import sys
+import os
 import os.path
 from optparse import OptionParser
-from database.rltrader import RLTraderConnector
+from database.rltrader import RLTraderConnector, shard_weights
+from database.diffupload import DeltaUploader
+from metastock.stats import RunStats
+from metastock.shard import Shard, ShardPlan, parse_shard, check_shards, print_check
 
 Usage = """usage: %prog [options] [market1] [market2] ....
 
 Examples:
     %prog -a SET                        upload all symbols in SET market
     %prog -i /path1 -d /path2 SET       upload only changed symbols in SET market require diff directory
+    %prog -w 8 -i /path1 -d /path2 SET  compare the files in 8 processes while the changes are uploaded
+    %prog -a --shard 2/4 SET            upload the second quarter of the symbols (by file size)
+    %prog --check-shards SET            check that the shard manifests in the input directory cover every symbol
 """
 
 
@@ -28,20 +35,53 @@ def main():
                       help='input directory')
     parser.add_option('-f', '--force', action='store_true', dest='force',
                       help='force replace')
+    parser.add_option('-w', '--diff-workers', type='int', dest='diff_workers', default=os.cpu_count() or 1,
+                      help='with --diff, processes comparing the csv files while the deltas are uploaded '
+                           '(default: number of CPUs, 0 compares and uploads one file at a time)')
+    parser.add_option('-b', '--batch-rows', type='int', dest='batch_rows',
+                      help='with --diff, rows of several symbols sent in one REPLACE and commit (default: %d)'
+                           % DeltaUploader.BATCH_ROWS)
+    parser.add_option('--shard', type='string', dest='shard',
+                      help='upload only the I-th of N shards of the symbols (I/N), balanced by file size, '
+                           'and write a completion manifest to the input directory')
+    parser.add_option('--check-shards', action='store_true', dest='check_shards',
+                      help='check that the shard manifests in the input directory cover every symbol once')
+    parser.add_option('-r', '--report', type='string', dest='report',
+                      help='write per-stage timing counters as JSON lines to REPORT (- for stdout)')
     (options, args) = parser.parse_args()
 
     # check if the options are valid
-    if not (options.all or options.diff_dir and len(args) > 0):
+    if not (options.all or options.check_shards or options.diff_dir and len(args) > 0):
         parser.print_help()
         sys.exit(0)
 
+    if options.shard:
+        try:
+            options.shard = parse_shard(options.shard)
+        except ValueError as e:
+            parser.error(str(e))
+
     options.config_path = not options.config_path and 'dbconfig.json' or os.path.realpath(options.config_path)
     options.input_dir = not options.input_dir and '.' or os.path.realpath(options.input_dir)
-    options.diff_dir = not options.diff_dir and None or os.path.realpath(options.diff_dir)
+    options.diff_dir = options.diff_dir and os.path.realpath(options.diff_dir) or None
+
+    options.stats = RunStats(options.report)
+
+    if options.check_shards:
+        report = check_shards(options.input_dir, 'rdsupload', shard_weights(options.input_dir, args))
+        print_check(report)
+        sys.exit(not report['ok'] and 1 or 0)
+
+    if options.shard:
+        index, count = options.shard
+        options.shard = Shard('rdsupload', index, ShardPlan(shard_weights(options.input_dir, args), count))
 
     # Run Application
     trader = RLTraderConnector(options)
     trader.walk_market(args)
+    if options.shard:
+        options.shard.write_manifest(options.input_dir)
+    options.stats.write_report()
 
 
 if __name__ == '__main__':